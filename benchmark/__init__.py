@@ -0,0 +1,5 @@
+""" Benchmark of the CAMELYON pipeline on synthetic whole-slide fixtures
+
+    - synthetic.py: pyramidal TIFF slides + ASAP XML annotations
+    - run.py: times every stage and writes a JSON result
+"""
@@ -0,0 +1,329 @@
+""" End-to-end benchmark on synthetic slides (CPU only, no CAMELYON17 data)
+
+usage :
+    python -m benchmark.run --size 8192 --slides 2 --output bench.json
+    python -m benchmark.run --compare bench_of_master.json
+
+Every stage of the pipeline is timed on the same generated fixtures and the
+result is written as JSON together with the commit it was measured on, so
+two runs on different commits can be compared with --compare.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import csv
+
+import numpy as np
+import cv2
+import openslide
+import torch
+import torch.nn as nn
+import torch.optim as optim
+import torchvision.transforms as transforms
+
+from user_define import Config as cf
+from user_define import Hyperparams as hp
+from profiler import profiler, merge_reports
+
+from benchmark.synthetic import create_synthetic_case
+
+
+"""
+point every path of the config into work_dir
+"""
+def configure_paths(work_dir):
+    data_dir = os.path.join(work_dir, 'Data')
+    cf.path_of_slide = os.path.join(data_dir, 'slide')
+    cf.path_of_annotation = os.path.join(data_dir, 'annotation')
+    cf.path_of_task_1 = os.path.join(data_dir, 'task', 'task_1')
+    cf.path_of_task_2 = os.path.join(data_dir, 'task', 'task_2')
+    cf.path_for_result = os.path.join(data_dir, 'result')
+    cf.path_of_train_dataset = os.path.join(data_dir, 'dataset', 'train')
+    cf.path_of_val_dataset = os.path.join(data_dir, 'dataset', 'val')
+    cf.path_of_test_dataset = os.path.join(data_dir, 'dataset', 'test')
+    cf.path_of_slide_catalog = os.path.join(data_dir, 'result',
+                                            'slide_catalog.json')
+    cf.path_of_patch_index = os.path.join(data_dir, 'dataset',
+                                          'patch_index.sqlite')
+    cf.path_of_patch_store = os.path.join(data_dir, 'dataset', 'store')
+    cf.path_of_profile = os.path.join(work_dir, 'profile')
+    cf.path_of_log = os.path.join(work_dir, 'logs')
+    cf.path_of_job_log = os.path.join(work_dir, 'logs', 'job_log.jsonl')
+
+    cf.save_tissue_mask_image = False
+    cf.save_tumor_mask_image = False
+    cf.save_patch_images = False
+    cf.save_thumbnail_image = False
+
+    for path in (cf.path_of_slide, cf.path_of_annotation, cf.path_of_task_2,
+                 cf.path_for_result, cf.path_of_test_dataset):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Stages(object):
+    """wall clock seconds and number of items per stage"""
+
+    def __init__(self):
+        self.result = {}
+
+    def add(self, name, seconds, items=None):
+        stage = self.result.setdefault(name, {'seconds': 0., 'items': 0})
+        stage['seconds'] += seconds
+        if items is not None:
+            stage['items'] += items
+            stage['items_per_sec'] = stage['items'] / max(stage['seconds'],
+                                                          1e-12)
+        print("%-20s %10.3f sec" % (name, stage['seconds']))
+
+
+def bench_create_dataset(stages, list_of_slide, number_of_patch):
+    from create_dataset import CAMELYON_PREPRO
+
+    CAMELYON_PREPRO.num_of_patch = number_of_patch
+    list_of_report = []
+    for slide_fn in list_of_slide:
+        start = time.perf_counter()
+        CAMELYON_PREPRO('train', slide_fn)
+        stages.add('create_dataset', time.perf_counter() - start,
+                   number_of_patch)
+        list_of_report.append(
+            os.path.join(cf.path_of_profile, 'train_' + slide_fn + '.json'))
+        # CAMELYON_PREPRO dumps and resets, keep the benchmark enabled
+        profiler.enable()
+
+    report = merge_reports(list_of_report)
+    for name, key in (('tissue_mask', 'tissue_mask'),
+                      ('tumor_mask', 'tumor_mask'),
+                      ('sampling', 'sampling'),
+                      ('patch_extraction', 'read_region')):
+        if key in report['stages']:
+            d = report['stages'][key]
+            stages.add(name, d['total_sec'], d['count'])
+    return report
+
+
+def bench_loader(stages, slide_path, batch_size, number_of_batch, num_workers):
+    from load_dataset import CUSTOM_DATASET
+
+    trainset = CUSTOM_DATASET('train', slide_path, None,
+                              transforms.Compose([transforms.ToTensor()]))
+    loader = torch.utils.data.DataLoader(trainset, batch_size,
+                                         shuffle=True,
+                                         num_workers=num_workers)
+    start = time.perf_counter()
+    samples = 0
+    for batch_idx, (inputs, targets) in enumerate(loader):
+        samples += inputs.size(0)
+        if batch_idx + 1 >= number_of_batch:
+            break
+    stages.add('loader', time.perf_counter() - start, samples)
+
+
+def bench_train_step(stages, batch_size, number_of_batch):
+    from models import resnet18
+
+    net = resnet18()
+    net.train()
+    criterion = nn.BCELoss()
+    optimizer = optim.SGD(net.parameters(), lr=hp.learning_rate,
+                          momentum=hp.momentum, weight_decay=hp.weight_decay)
+    inputs = torch.rand(batch_size, 3, hp.patch_size[1], hp.patch_size[0])
+    targets = (torch.rand(batch_size) > 0.5).float()
+
+    def step():
+        optimizer.zero_grad()
+        outputs = torch.squeeze(net(inputs), 1)
+        loss = criterion(outputs, targets)
+        loss.backward()
+        optimizer.step()
+
+    step()  # warm up
+    start = time.perf_counter()
+    for _ in range(number_of_batch):
+        step()
+    stages.add('train_step', time.perf_counter() - start,
+               batch_size * number_of_batch)
+    return net
+
+
+def bench_grid_filter(stages, slide_path):
+    from prepro_for_test2 import get_pos_of_patch_in_tissue
+
+    slide = openslide.OpenSlide(slide_path)
+
+    # items are the patches kept, the same on every commit
+    start = time.perf_counter()
+    set_of_real_pos = get_pos_of_patch_in_tissue(slide)
+    stages.add('grid_filter', time.perf_counter() - start,
+               len(set_of_real_pos))
+    return set_of_real_pos
+
+
+def bench_inference(stages, net, slide_path, set_of_real_pos, batch_size,
+                    number_of_batch, num_workers):
+    from load_dataset import CUSTOM_DATASET
+
+    set_of_real_pos = set_of_real_pos[:batch_size * number_of_batch]
+    testset = CUSTOM_DATASET('test', slide_path, set_of_real_pos,
+                             transforms.Compose([transforms.ToTensor()]))
+    loader = torch.utils.data.DataLoader(testset, batch_size,
+                                         shuffle=False,
+                                         num_workers=num_workers)
+    net.eval()
+    set_of_output = []
+    start = time.perf_counter()
+    with torch.no_grad():
+        for inputs, _ in loader:
+            outputs = net(inputs).view(-1)
+            set_of_output.append(outputs.numpy())
+    stages.add('inference', time.perf_counter() - start, len(set_of_real_pos))
+    return set_of_real_pos, np.concatenate(set_of_output)
+
+
+def bench_heatmap(stages, slide_fn, set_of_real_pos, set_of_output):
+    from create_heatmap_from_csv import create_heatmap
+
+    result_dir = os.path.join(cf.path_for_result, slide_fn)
+    if not os.path.isdir(result_dir):
+        os.makedirs(result_dir)
+    csv_path = os.path.join(result_dir, slide_fn + "_result.csv")
+    with open(csv_path, 'w', encoding='utf-8', newline='') as fo:
+        fw = csv.writer(fo)
+        predicted = np.floor(set_of_output + 1 - hp.threshold_for_eval)
+        for (x, y), output in zip(set_of_real_pos, predicted):
+            fw.writerow([x, y, output])
+
+    start = time.perf_counter()
+    create_heatmap(slide_fn)
+    stages.add('heatmap', time.perf_counter() - start, len(set_of_real_pos))
+
+
+def run_benchmark(args):
+    # the tissue mask is made at cf.level_for_preprocessing of the slide
+    min_size = max(max(hp.patch_size), 2 ** cf.level_for_preprocessing)
+    if args.size < min_size:
+        raise RuntimeError("--size %d is too small, at least %d for a patch "
+                           "of %s and level %d of preprocessing"
+                           % (args.size, min_size, hp.patch_size,
+                              cf.level_for_preprocessing))
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='camelyon_bench_')
+    configure_paths(work_dir)
+    torch.set_num_threads(args.threads)
+    profiler.enable()
+
+    print("==> Creating synthetic slides in", work_dir)
+    list_of_slide = []
+    for i in range(args.slides):
+        slide_fn = 'b_%d' % (i + 1)
+        create_synthetic_case(slide_fn, cf.path_of_slide,
+                              cf.path_of_annotation,
+                              args.size, args.size, seed=args.seed + i,
+                              number_of_level=cf.level_for_preprocessing + 1)
+        list_of_slide.append(slide_fn)
+    slide_path = os.path.join(cf.path_of_slide, list_of_slide[0] + '.tif')
+    test_fn = 't_1'
+    test_path = os.path.join(cf.path_of_task_2, test_fn + '.tif')
+    shutil.copyfile(slide_path, test_path)
+
+    stages = Stages()
+    print("==> Running stages")
+    report = bench_create_dataset(stages, list_of_slide, args.patches)
+    bench_loader(stages, slide_path, args.batch_size, args.batches,
+                 args.workers)
+    net = bench_train_step(stages, args.batch_size, args.batches)
+    set_of_real_pos = bench_grid_filter(stages, test_path)
+    set_of_real_pos, set_of_output = bench_inference(
+        stages, net, test_path, set_of_real_pos, args.batch_size,
+        args.batches, args.workers)
+    bench_heatmap(stages, test_fn, set_of_real_pos, set_of_output)
+
+    result = {'commit': get_commit(),
+              'time': time.time(),
+              'environment': {'python': platform.python_version(),
+                              'platform': platform.platform(),
+                              'cpu_count': os.cpu_count(),
+                              'threads': args.threads,
+                              'numpy': np.__version__,
+                              'torch': torch.__version__,
+                              'opencv': cv2.__version__,
+                              'openslide': openslide.__library_version__},
+              'params': {'size': args.size,
+                         'slides': args.slides,
+                         'patches': args.patches,
+                         'batch_size': args.batch_size,
+                         'batches': args.batches,
+                         'workers': args.workers,
+                         'seed': args.seed},
+              'stages': stages.result,
+              'profile': report}
+
+    if not args.keep:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return result
+
+
+def compare(result, baseline):
+    print("%-20s %12s %12s %8s" % ('stage', 'base (s)', 'new (s)', 'ratio'))
+    for name, stage in result['stages'].items():
+        base = baseline['stages'].get(name)
+        if base is None:
+            print("%-20s %12s %12.3f" % (name, '-', stage['seconds']))
+            continue
+        print("%-20s %12.3f %12.3f %8.2f"
+              % (name, base['seconds'], stage['seconds'],
+                 stage['seconds'] / max(base['seconds'], 1e-12)))
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='CAMELYON pipeline benchmark')
+    parser.add_argument('--size', type=int, default=8192,
+                        help='width and height of level 0 of each slide')
+    parser.add_argument('--slides', type=int, default=2)
+    parser.add_argument('--patches', type=int, default=200,
+                        help='patches extracted per slide')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--batches', type=int, default=4,
+                        help='batches timed for loader, train and inference')
+    parser.add_argument('--workers', type=int, default=0)
+    parser.add_argument('--threads', type=int, default=torch.get_num_threads())
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--work-dir', default=None)
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the generated slides and datasets')
+    parser.add_argument('--output', default='benchmark_result.json')
+    parser.add_argument('--compare', default=None,
+                        help='result json of a previous run to compare with')
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+    result = run_benchmark(args)
+
+    with open(args.output, 'w') as fo:
+        json.dump(result, fo, indent=2, sort_keys=True)
+    print("result is saved at", args.output)
+
+    if args.compare is not None:
+        with open(args.compare) as fo:
+            compare(result, json.load(fo))
@@ -0,0 +1,181 @@
+""" Synthetic whole-slide fixtures for the benchmark
+
+A slide is a tiled pyramidal TIFF (one TIFF directory per level, each level
+half the size of the previous one) that openslide opens as a generic tiled
+TIFF, and an ASAP style XML with the tumor polygons in level 0 coordinates,
+like the CAMELYON17 annotations.
+
+Tiles are rendered procedurally level by level, so slides much larger than
+memory can be written.
+"""
+import os
+
+import numpy as np
+import cv2
+import tifffile
+
+
+BACKGROUND_COLOR = (242, 242, 242)
+TISSUE_COLOR = (222, 160, 200)
+TUMOR_COLOR = (120, 60, 150)
+
+
+"""
+param : center (x, y), axes (a, b) in level 0 coordinates
+
+return : randomly rotated, wobbly ellipse (numpy array, N x 2, float)
+"""
+def make_blob(rng, center, axes, number_of_vertex=48):
+    theta = np.linspace(0, 2 * np.pi, number_of_vertex, endpoint=False)
+    # wobble the radius so contours are not perfect ellipses
+    radius = 1 + 0.15 * np.sin(3 * theta + rng.uniform(0, 2 * np.pi))
+    angle = rng.uniform(0, np.pi)
+    x = axes[0] * radius * np.cos(theta)
+    y = axes[1] * radius * np.sin(theta)
+    xr = x * np.cos(angle) - y * np.sin(angle) + center[0]
+    yr = x * np.sin(angle) + y * np.cos(angle) + center[1]
+    return np.stack([xr, yr], axis=1)
+
+
+"""
+param : width, height of level 0
+        number_of_tissue (int) sections of tissue on the slide
+        number_of_tumor (int) tumor regions, placed inside tissue sections
+
+return : list of tissue polygons, list of tumor polygons
+"""
+def make_layout(width, height, number_of_tissue=3, number_of_tumor=4, seed=0):
+    rng = np.random.RandomState(seed)
+
+    set_of_tissue = []
+    for i in range(number_of_tissue):
+        # sections side by side along x, like multi-section slides
+        cx = (i + 0.5) * width / number_of_tissue
+        cy = rng.uniform(0.35, 0.65) * height
+        axes = (rng.uniform(0.2, 0.3) * width / number_of_tissue,
+                rng.uniform(0.2, 0.35) * height)
+        set_of_tissue.append(make_blob(rng, (cx, cy), axes))
+
+    set_of_tumor = []
+    for i in range(number_of_tumor):
+        tissue = set_of_tissue[i % number_of_tissue]
+        center = tissue.mean(axis=0)
+        spread = (tissue.max(axis=0) - tissue.min(axis=0)) * 0.2
+        c = center + rng.uniform(-1, 1, 2) * spread
+        axes = rng.uniform(0.03, 0.08, 2) * min(width, height)
+        set_of_tumor.append(make_blob(rng, c, axes))
+
+    return set_of_tissue, set_of_tumor
+
+
+def _fill(tile, set_of_polygon, offset, scale, color):
+    shift = 4
+    polygons = [np.round((p / scale - offset) * (1 << shift)).astype(np.int32)
+                for p in set_of_polygon]
+    cv2.fillPoly(tile, polygons, color, lineType=cv2.LINE_8, shift=shift)
+
+
+def _iter_tiles(set_of_tissue, set_of_tumor, shape, tile_size, scale, seed):
+    height, width = shape
+    for ty in range(0, height, tile_size):
+        for tx in range(0, width, tile_size):
+            tile = np.empty((tile_size, tile_size, 3), dtype=np.uint8)
+            tile[:] = BACKGROUND_COLOR
+            offset = np.array([tx, ty], dtype=np.float64)
+            _fill(tile, set_of_tissue, offset, scale, TISSUE_COLOR)
+            _fill(tile, set_of_tumor, offset, scale, TUMOR_COLOR)
+
+            # texture on tissue only, so the background still compresses
+            is_tissue = tile[:, :, 0] != BACKGROUND_COLOR[0]
+            if is_tissue.any():
+                rng = np.random.RandomState((seed, ty, tx, int(scale)))
+                noise = rng.randint(-12, 13, size=tile.shape)
+                noise[~is_tissue] = 0
+                tile = np.clip(tile + noise, 0, 255).astype(np.uint8)
+            yield tile
+
+
+"""
+param : target_path (string) ex) './Data/slide/b_1.tif'
+        width, height (int) size of level 0
+        tile_size (int)
+        min_size (int) the smallest level is at least this large
+        number_of_level (int) levels written at least, even below min_size,
+            ex) cf.level_for_preprocessing + 1
+
+return : tumor polygons (list of numpy array) in level 0 coordinates
+"""
+def create_synthetic_slide(target_path, width, height, tile_size=256,
+                           min_size=512, number_of_level=1, seed=0,
+                           number_of_tissue=3, number_of_tumor=4):
+    if min(width, height) >> (number_of_level - 1) < 1:
+        raise RuntimeError("%d x %d is too small for %d levels"
+                           % (width, height, number_of_level))
+    set_of_tissue, set_of_tumor = make_layout(width, height,
+                                              number_of_tissue,
+                                              number_of_tumor,
+                                              seed)
+
+    with tifffile.TiffWriter(target_path, bigtiff=True) as tif:
+        scale, level = 1, 0
+        while True:
+            shape = (int(height // scale), int(width // scale))
+            tif.write(_iter_tiles(set_of_tissue, set_of_tumor, shape,
+                                  tile_size, scale, seed),
+                      shape=shape + (3,),
+                      dtype=np.uint8,
+                      tile=(tile_size, tile_size),
+                      photometric='rgb',
+                      compression='zlib',
+                      subfiletype=0 if scale == 1 else 1,
+                      metadata=None)
+            level += 1
+            if min(shape) // 2 < min_size and level >= number_of_level:
+                break
+            scale *= 2
+
+    return set_of_tumor
+
+
+"""
+write tumor polygons as ASAP_Annotations xml (as in CAMELYON17)
+"""
+def write_annotation_xml(target_path, set_of_polygon):
+    lines = ['<?xml version="1.0"?>',
+             '<ASAP_Annotations>',
+             '\t<Annotations>']
+    for i, polygon in enumerate(set_of_polygon):
+        lines.append('\t\t<Annotation Name="_%d" Type="Polygon" '
+                     'PartOfGroup="metastases" Color="#F4FA58">' % i)
+        lines.append('\t\t\t<Coordinates>')
+        for order, (x, y) in enumerate(polygon):
+            lines.append('\t\t\t\t<Coordinate Order="%d" X="%.4f" Y="%.4f" />'
+                         % (order, x, y))
+        lines.append('\t\t\t</Coordinates>')
+        lines.append('\t\t</Annotation>')
+    lines += ['\t</Annotations>',
+              '\t<AnnotationGroups>',
+              '\t\t<Group Name="metastases" PartOfGroup="None" Color="#ff0000">',
+              '\t\t\t<Attributes />',
+              '\t\t</Group>',
+              '\t</AnnotationGroups>',
+              '</ASAP_Annotations>']
+    with open(target_path, 'w') as fo:
+        fo.write('\n'.join(lines) + '\n')
+
+
+"""
+create slide_fn.tif in path_of_slide and slide_fn.xml in path_of_annotation
+"""
+def create_synthetic_case(slide_fn, path_of_slide, path_of_annotation,
+                          width, height, seed=0, **kwargs):
+    for path in (path_of_slide, path_of_annotation):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+    slide_path = os.path.join(path_of_slide, slide_fn + '.tif')
+    xml_path = os.path.join(path_of_annotation, slide_fn + '.xml')
+
+    set_of_tumor = create_synthetic_slide(slide_path, width, height,
+                                          seed=seed, **kwargs)
+    write_annotation_xml(xml_path, set_of_tumor)
+    return slide_path, xml_path
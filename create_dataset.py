@@ -6,9 +6,12 @@ import openslide
 from xml.etree.ElementTree import parse
 import cv2
 from PIL import Image
+from scipy.spatial import cKDTree
 
 import pickle
+import json
 import time
+import argparse
 
 # for multiprocessing
 import multiprocessing
@@ -19,6 +22,16 @@ from itertools import repeat
 from user_define import Config as cf
 from user_define import Hyperparams as hp
 
+from profiler import profiler, enable_from_config, merge_reports
+from stain_norm import get_params_of_slide, get_path_of_params
+from mask import COMPACT_MASK
+from tissue_detector import detect_tissue
+from image_ingest import ingest_folder
+from polygon_label import POLYGON_LABELLER
+from patch_filter import get_quality_of_patch, get_reason_of_reject
+from slide_catalog import slide_catalog
+from patch_index import PATCH_INDEX, get_usage_of_folder
+
 import pdb
 
 
@@ -39,33 +52,22 @@ class CAMELYON_PREPRO():
     ratio_of_tumor_patch = hp.ratio_of_tumor_patch
     threshold_of_tumor_rate = hp.threshold_of_tumor_rate
 
+    # extra samples of each group replacing rejected patches (get_patch_data)
+    set_of_reserve = None
+    group_of_inform = None
+    # sampling source of each group, in the patch index
+    list_of_source = ('tumor', 'tissue')
+
     def __init__(self, usage, slide_filename):
         print("allocator", slide_filename)
+        enable_from_config()
         if usage != 'test':
-            target_slide_path = os.path.join(cf.path_of_slide,
-                                             slide_filename + '.tif')
-            self.slide = openslide.OpenSlide(target_slide_path)
-            self.downsamples = int(self.slide.level_downsamples[self.level])
-
-            xml_filename = slide_filename + ".xml"
-            target_xml_path = os.path.join(cf.path_of_annotation,
-                                           xml_filename)
-            self.annotation = self.get_annotation_from_xml(target_xml_path)
-
-            # for save image
-            self.patch_path = os.path.join(cf.path_for_result,
-                                           slide_filename,
-                                           cf.base_folder_for_patch)
-            self.check_path(self.patch_path)
-
-            self.etc_path = os.path.join(cf.path_for_result,
-                                         slide_filename,
-                                         cf.base_folder_for_etc)
-            self.check_path(self.etc_path)
+            self.load_slide(slide_filename)
 
             # for create patch array
             self.tissue_mask = self.create_tissue_mask(cf.save_tissue_mask_image)
             self.tumor_mask = self.create_tumor_mask(cf.save_tumor_mask_image)
+            self.labeller = self.create_labeller()
 
             num_of_patch_in_tumor = int(self.num_of_patch * self.ratio_of_tumor_patch)
             num_of_patch_in_tissue = self.num_of_patch - num_of_patch_in_tumor
@@ -75,19 +77,29 @@ class CAMELYON_PREPRO():
                 dila_of_tissue, _ = self.get_dilaero(self.tissue_mask)
                 set_of_inform_in_tumor = self.get_inform_of_random_samples(
                                             ero_of_tumor,
-                                            num_of_patch_in_tumor)
+                                            num_of_patch_in_tumor,
+                                            self.get_num_of_reserve(
+                                                num_of_patch_in_tumor))
                 set_of_inform_in_tissue = self.get_inform_of_random_samples(
-                                            dila_of_tissue - dila_of_tumor,
-                                            num_of_patch_in_tissue)
+                                            dila_of_tissue.difference(
+                                                dila_of_tumor),
+                                            num_of_patch_in_tissue,
+                                            self.get_num_of_reserve(
+                                                num_of_patch_in_tissue))
 
             elif usage == 'val':
                 dila_of_tissue, _ = self.get_dilaero(self.tissue_mask)
                 set_of_inform_in_tumor = self.get_inform_of_random_samples(
                                             self.tumor_mask,
-                                            num_of_patch_in_tumor)
+                                            num_of_patch_in_tumor,
+                                            self.get_num_of_reserve(
+                                                num_of_patch_in_tumor))
                 set_of_inform_in_tissue = self.get_inform_of_random_samples(
-                                            dila_of_tissue - self.tumor_mask,
-                                            num_of_patch_in_tissue)
+                                            dila_of_tissue.difference(
+                                                self.tumor_mask),
+                                            num_of_patch_in_tissue,
+                                            self.get_num_of_reserve(
+                                                num_of_patch_in_tissue))
 
             elif usage == 'train_incorrect' or usage == 'val_incorrect':
                 predict_filename = slide_filename + "_result.png"
@@ -97,18 +109,30 @@ class CAMELYON_PREPRO():
                                                 predict_filename,
                                                 )
                 predict_array = cv2.imread(target_pred_path, 0)
+                self.list_of_source = ('false_positive', 'tissue')
+                # keep only false positives
+                false_positive = COMPACT_MASK.from_array(
+                    predict_array).difference(self.tumor_mask)
                 set_of_inform_in_tumor = self.get_inform_of_random_samples(
-                                            (predict_array - self.tumor_mask),
-                                            num_of_patch_in_tumor)
+                                            false_positive,
+                                            num_of_patch_in_tumor,
+                                            self.get_num_of_reserve(
+                                                num_of_patch_in_tumor))
                 set_of_inform_in_tissue = self.get_inform_of_random_samples(
                                             self.tissue_mask,
-                                            num_of_patch_in_tissue)
+                                            num_of_patch_in_tissue,
+                                            self.get_num_of_reserve(
+                                                num_of_patch_in_tissue))
 
             else:
                 raise RuntimeError("usage is invalid value")
 
-            self.set_of_inform = set_of_inform_in_tumor + set_of_inform_in_tissue
+            self.set_of_inform = self.split_reserve(
+                [(set_of_inform_in_tumor, num_of_patch_in_tumor),
+                 (set_of_inform_in_tissue, num_of_patch_in_tissue)])
             self.set_of_inform = np.array(self.set_of_inform)
+            print(slide_filename, get_overlap_of_patches(
+                self.set_of_inform[:, 1:3], self.patch_size))
 
             self.set_of_patch = self.get_patch_data(cf.save_patch_images)
             self.set_of_patch = np.array(self.set_of_patch)
@@ -119,33 +143,55 @@ class CAMELYON_PREPRO():
                 self.draw_patch_pos_on_thumbnail()
 
         else :
-            file_list = os.listdir(cf.path_of_task_1)
-            file_list.sort()
-            set_of_patch = []
-            i = 0
-            # for fn in tqdm(file_list):
-            for fn in file_list:
-                fp = os.path.join(cf.path_of_task_1, fn)
-                img = cv2.imread(fp, cv2.IMREAD_COLOR)
-                img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-                set_of_patch.append(img)
-                i = i + 1
-                print("\r%d" % (i), end="")
-            print("\n")
-
+            # decoded in threads into $path_of_test_dataset/$slide.npy,
+            # file names in the .json, no pickle (see image_ingest.py)
+            self.check_path(cf.path_of_test_dataset)
+            with profiler.timer('ingest'):
+                self.set_of_patch, file_list, _ = ingest_folder(
+                    cf.path_of_task_1,
+                    os.path.join(cf.path_of_test_dataset, slide_filename))
             self.set_of_inform = np.array(file_list)
-            self.set_of_patch = np.array(set_of_patch)
 
-        self.create_dataset(usage, slide_filename)
+        if usage != 'test':
+            with profiler.timer('save_dataset'):
+                self.create_dataset(usage, slide_filename)
+
+        profiler.dump(usage + '_' + slide_filename)
+        profiler.reset()
 
     """
-    param :
+    open the slide and its annotation, and make the result folders
+    """
+    def load_slide(self, slide_filename):
+        self.slide = openslide.OpenSlide(slide_catalog.get_path(slide_filename))
+        self.slide_filename = slide_filename
+        self.downsamples = int(self.slide.level_downsamples[self.level])
+
+        xml_filename = slide_filename + ".xml"
+        self.xml_path = os.path.join(cf.path_of_annotation,
+                                     xml_filename)
+        self.annotation = self.get_annotation_from_xml(self.xml_path)
+
+        # for save image
+        self.patch_path = os.path.join(cf.path_for_result,
+                                       slide_filename,
+                                       cf.base_folder_for_patch)
+        self.check_path(self.patch_path)
+
+        self.etc_path = os.path.join(cf.path_for_result,
+                                     slide_filename,
+                                     cf.base_folder_for_etc)
+        self.check_path(self.etc_path)
+
+    """
+    param : downsamples (int) default is the one of self.level
 
     return : annotations (list of numpy)
     """
 
-    def get_annotation_from_xml(self, target_xml_path):
-        downsamples = self.downsamples
+    def get_annotation_from_xml(self, target_xml_path, downsamples=None):
+        if downsamples is None:
+            downsamples = self.downsamples
 
         annotation = []
         num_annotation = 0
@@ -186,26 +232,31 @@ class CAMELYON_PREPRO():
     """
     param :
 
-    return : tissue_mask (numpy_array)
+    return : tissue_mask (COMPACT_MASK)
     """
     def create_tissue_mask(self, save_image=False):
         slide = self.slide
         level = self.level
-        col, row = slide.level_dimensions[level]
 
-        img = np.array(slide.read_region((0, 0), level, (col, row)))
-        img = cv2.cvtColor(img, cv2.COLOR_RGBA2RGB)
-        img = cv2.cvtColor(img, cv2.COLOR_RGB2HSV)
-        img = img[:, :, 1]
-        _, tissue_mask = cv2.threshold(img,
-                                       0,
-                                       255,
-                                       cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        with profiler.timer('tissue_mask'):
+            if hp.use_stain_normalization:
+                tissue_mask, img = detect_tissue(slide, level,
+                                                 return_image=True)
+            else:
+                tissue_mask = detect_tissue(slide, level)
+
+        # stain params from the same level image, once per slide
+        if hp.use_stain_normalization:
+            with profiler.timer('stain_params'):
+                get_params_of_slide(self.slide_filename, img,
+                                    tissue_mask.to_array())
+            slide_catalog.add_artifact(self.slide_filename, 'stain_params',
+                                       get_path_of_params(self.slide_filename))
         '''
         if save_image:
             target_image_path = os.path.join(self.etc_path,
                                              "tissue_mask.jpg")
-            cv2.imwrite(target_image_path, tissue_mask)
+            cv2.imwrite(target_image_path, tissue_mask.to_image())
         '''
         return tissue_mask
 
@@ -213,7 +264,7 @@ class CAMELYON_PREPRO():
     """
     param :
 
-    return : tumor mask (numpy_array)
+    return : tumor mask (COMPACT_MASK)
     """
     def create_tumor_mask(self, save_image=False):
         slide = self.slide
@@ -221,60 +272,53 @@ class CAMELYON_PREPRO():
         annotation = self.annotation
 
         col, row = slide.level_dimensions[level]
-        tumor_mask = np.zeros((row, col))
-        cv2.drawContours(tumor_mask, annotation, -1, 255, -1)
+        with profiler.timer('tumor_mask'):
+            tumor_mask = COMPACT_MASK.from_contours((row, col), annotation)
 
         if save_image:
             target_image_path = os.path.join(self.etc_path,
                                              "tumor_mask.jpg")
-            cv2.imwrite(target_image_path, tumor_mask)
+            cv2.imwrite(target_image_path, tumor_mask.to_image())
 
 
         return tumor_mask
 
+    """
+    labels of determine_tumor, from the level 0 annotation rasterized per
+    patch at cf.level_for_label (0 is exact)
+
+    return : labeller (POLYGON_LABELLER)
+    """
+    def create_labeller(self):
+        downsamples = self.slide.level_downsamples[cf.level_for_label]
+        return POLYGON_LABELLER(self.get_annotation_from_xml(self.xml_path, 1),
+                                downsamples)
+
     """
     """
     def get_dilaero(self, mask):
-        kernel_dilation = np.ones((19, 19), np.uint8)
-        dilation = cv2.dilate(mask, kernel_dilation, iterations=1)
-        kernel_erosion = np.ones((9, 9), np.uint8)
-        erosion = cv2.erode(mask, kernel_erosion, iterations=1)
+        dilation = mask.dilate(19)
+        erosion = mask.erode(9)
         return dilation, erosion
 
 
     """
-    param : mask (numpy)
-            patch_pos (tuple(x, y, width, height))
-            percent (what percent will you determine as tumor)
-            downsamples(int)
+    param : patch_pos (tuple(x, y, width, height), level 0)
 
     return : label (int)
 
     """
     def determine_tumor(self, patch_pos):
-        downsamples = self.downsamples
         threshold = self.threshold_of_tumor_rate
-        tumor_mask = self.tumor_mask
-
-        min_x = int(patch_pos[0] / downsamples)
-        min_y = int(patch_pos[1] / downsamples)
-
-        width = int(patch_pos[2] / downsamples)
-        height = int(patch_pos[3] / downsamples)
-
-        max_x = int(min_x + width)
-        max_y = int(min_y + height)
-
-        area = width * height
 
         if threshold > 1 or threshold < 0:
             raise RuntimeError('threshold must be in 0 to 1')
 
         #
-        mask_of_patch = tumor_mask[min_y: max_y, min_x: max_x]
+        rate_of_patch = self.labeller.get_tumor_rate(*patch_pos)
 
         #
-        if np.sum(mask_of_patch) > (threshold * 255 * area):
+        if rate_of_patch > threshold:
             return 1
         else:
             return 0
@@ -285,38 +329,82 @@ class CAMELYON_PREPRO():
 
     return :
     """
-    def get_inform_of_random_samples(self, mask, num_of_patch):
-        slide = self.slide
-        level = self.level
-        downsamples = self.downsamples
+    def get_inform_of_random_samples(self, mask, num_of_patch,
+                                     num_of_reserve=0):
+        # reserve only from the pixels left over
+        num_of_reserve = min(num_of_reserve,
+                             max(0, mask.count_nonzero() - num_of_patch))
+        with profiler.timer('sampling'):
+            return self._get_inform_of_random_samples(
+                mask, num_of_patch + num_of_reserve)
+
+    """
+    return : extra samples drawn for num_of_patch, 0 without patch filter
+    """
+    def get_num_of_reserve(self, num_of_patch):
+        if not hp.use_patch_filter:
+            return 0
+        return int(np.ceil(num_of_patch * hp.ratio_of_reserve_patch))
+
+    """
+    param : list_of_group (list of (set_of_inform with reserve, num_of_patch))
+
+    return : set_of_inform (the first num_of_patch of each group), the rest
+             are kept in self.set_of_reserve, by group
+    """
+    def split_reserve(self, list_of_group):
+        set_of_inform = []
+        self.group_of_inform = []
+        self.set_of_reserve = []
+        for group, (set_of_inform_in_group, num_of_patch) in \
+                enumerate(list_of_group):
+            set_of_inform += set_of_inform_in_group[:num_of_patch]
+            self.group_of_inform += [group] * len(
+                set_of_inform_in_group[:num_of_patch])
+            self.set_of_reserve.append(
+                list(set_of_inform_in_group[num_of_patch:]))
+        return set_of_inform
+
+    def _get_inform_of_random_samples(self, mask, num_of_patch):
         patch_size = self.patch_size
 
         set_of_inform = []
-        number_of_region = int(np.sum(mask) / 255)
+        for x, y in self.get_pos_of_samples(mask, num_of_patch):
+            is_tumor = self.determine_tumor(
+                (x, y, patch_size[0], patch_size[1]))
+            set_of_inform.append(
+                [is_tumor, x, y, patch_size[0], patch_size[1]])
+
+        return set_of_inform
+
+    """
+    param : mask (COMPACT_MASK at self.level)
+            min_distance (level 0 pixels between the patch centres)
+
+    return : list of (x, y), level 0 top-left of the patches
+    """
+    def get_pos_of_samples(self, mask, num_of_patch,
+                           min_distance=hp.min_distance_of_patch):
+        downsamples = self.downsamples
+        patch_size = self.patch_size
+
+        number_of_region = mask.count_nonzero()
 
         if number_of_region < num_of_patch:
             raise RuntimeError(
                 'Random size is bigger than number of pixels in region')
 
-        mask = np.reshape(mask, -1)
-        mask_pos = np.argwhere(mask > 0).squeeze()
-        np.random.shuffle(mask_pos)
-        dataset_number = mask_pos[:num_of_patch]
+        # pixels of the mask, without the dense argwhere, at least
+        # min_distance apart
+        set_of_x, set_of_y = mask.sample_poisson_disk(
+            num_of_patch, min_distance / float(downsamples))
 
-        width, _ = slide.level_dimensions[level]
         goleft = int(patch_size[0] / (2 * downsamples))
         goup = int(patch_size[1] / (2 * downsamples))
 
-        for data in dataset_number:
-            x = (data % width - goleft) * downsamples
-            y = (data // width - goup) * downsamples
-
-            is_tumor = self.determine_tumor(
-                (x, y, patch_size[0], patch_size[1]))
-            set_of_inform.append(
-                [is_tumor, x, y, patch_size[0], patch_size[1]])
-
-        return set_of_inform
+        return [(int(col_of_pixel - goleft) * downsamples,
+                 int(row_of_pixel - goup) * downsamples)
+                for col_of_pixel, row_of_pixel in zip(set_of_x, set_of_y)]
 
 
     """
@@ -325,60 +413,96 @@ class CAMELYON_PREPRO():
     return :
     """
     def get_patch_data(self, save_image=False):
-        slide = self.slide
         num_of_patch = self.num_of_patch
         set_of_inform = self.set_of_inform
         set_of_patch = []
+        set_of_kept = []
+        set_of_group = []
+        self.count_of_filter = {'tissue': 0, 'std': 0, 'blur': 0,
+                                'replaced': 0, 'dropped': 0}
 
         i = 1
 
         if save_image:
             print("Save patch image")
-            for pos in set_of_inform:
-                is_tumor, x, y, w, h = pos
-                patch = slide.read_region((x, y), 0, (w, h)).convert("RGB")
-                set_of_patch.append(np.array(patch))
-
-                # for image save
-                patch_fn = str(x) + "_" + str(y) + "_" + str(is_tumor) + ".png"
-                target_image_path = os.path.join(self.patch_path,
-                                                 patch_fn)
-                patch.save(target_image_path)
-
-                print("\rPercentage : %d / %d" % (i, num_of_patch), end="")
-                i = i + 1
-
-            print("\n")
         else:
             print("Do not save patch image")
-            for pos in set_of_inform:
-                is_tumor, x, y, w, h = pos
-                patch = slide.read_region((x, y), 0, (w, h)).convert("RGB")
-                set_of_patch.append(np.array(patch))
-                print("\rPercentage : %d / %d" % (i, num_of_patch), end="")
-                i = i + 1
-            print("\n")
 
+        for index, inform in enumerate(set_of_inform):
+            patch = self.read_patch(inform)
+
+            # a rejected patch is replaced by a reserve of its group
+            while hp.use_patch_filter:
+                reason = get_reason_of_reject(get_quality_of_patch(patch))
+                if reason is None:
+                    break
+                self.count_of_filter[reason] += 1
+                reserve = []
+                if self.set_of_reserve is not None:
+                    reserve = self.set_of_reserve[self.group_of_inform[index]]
+                if not reserve:
+                    self.count_of_filter['dropped'] += 1
+                    patch = None
+                    break
+                self.count_of_filter['replaced'] += 1
+                inform = reserve.pop(0)
+                patch = self.read_patch(inform)
+
+            if patch is not None:
+                set_of_patch.append(np.array(patch))
+                set_of_kept.append(inform)
+                set_of_group.append(0 if self.group_of_inform is None
+                                    else self.group_of_inform[index])
+
+                if save_image:
+                    # for image save
+                    is_tumor, x, y, w, h = inform
+                    patch_fn = str(x) + "_" + str(y) + "_" + str(is_tumor) + ".png"
+                    target_image_path = os.path.join(self.patch_path,
+                                                     patch_fn)
+                    patch.save(target_image_path)
+
+            print("\rPercentage : %d / %d" % (i, num_of_patch), end="")
+            i = i + 1
+
+        print("\n")
+        if hp.use_patch_filter:
+            print(self.slide_filename, "patch filter", self.count_of_filter)
+
+        self.set_of_inform = np.array(set_of_kept).reshape(-1, 5)
+        self.group_of_patch = np.array(set_of_group, dtype=np.int64)
         return set_of_patch
 
+    """
+    param : inform ([is_tumor, x, y, w, h], level 0)
 
+    return : patch (PIL RGB)
     """
-    param :
+    def read_patch(self, inform):
+        is_tumor, x, y, w, h = inform
+        with profiler.timer('read_region'):
+            return self.slide.read_region((int(x), int(y)), 0,
+                                          (int(w), int(h))).convert("RGB")
+
+
+    """
+    param : usage ('train', 'val', 'test' or '*_incorrect')
+            slide_filename
+            dataset_filename (default is slide_filename)
 
     return :
     """
-    def create_dataset(self, usage, slide_filename):
+    def create_dataset(self, usage, slide_filename, dataset_filename=None):
         set_of_patch = self.set_of_patch
         set_of_inform = self.set_of_inform
 
         dataset = {}
 
-        dataset[cf.key_of_data] = np.array(set_of_patch)
         dataset[cf.key_of_informs] = np.array(set_of_inform)
 
-        if usage == 'train':
+        if usage == 'train' or usage == 'train_incorrect':
             fp = cf.path_of_train_dataset
-        elif usage == 'val':
+        elif usage == 'val' or usage == 'val_incorrect':
             fp = cf.path_of_val_dataset
         elif usage == 'test':
             fp = cf.path_of_test_dataset
@@ -387,11 +511,39 @@ class CAMELYON_PREPRO():
 
         self.check_path(fp)
 
-        fn = os.path.join(fp, slide_filename + ".pkl")
+        if dataset_filename is None:
+            dataset_filename = slide_filename
+
+        # the pixels are kept once, in the npy store when the patch index
+        # is on (the pickle has the path of the shard), else in the pickle
+        if cf.use_patch_index and usage != 'test':
+            with profiler.timer('patch_index'):
+                dataset[cf.key_of_store] = self.add_to_patch_index(
+                    usage, slide_filename, dataset_filename)
+        else:
+            dataset[cf.key_of_data] = np.array(set_of_patch)
+
+        fn = os.path.join(fp, dataset_filename + ".pkl")
         fo = open(fn, 'wb')
         pickle.dump(dataset, fo, pickle.HIGHEST_PROTOCOL)
         fo.close()
 
+    """
+    write the patches to the npy store and a row for each of them (label,
+    tumor rate, sampling source, ...) to the patch index
+
+    return : path of the npy shard
+    """
+    def add_to_patch_index(self, usage, slide_filename, dataset_filename):
+        set_of_inform = np.asarray(self.set_of_inform).reshape(-1, 5)
+        tumor_rate = self.labeller.get_tumor_rates(set_of_inform[:, 1:3],
+                                                   self.patch_size)
+        source = [self.list_of_source[group] for group in self.group_of_patch]
+        return PATCH_INDEX().add_shard(get_usage_of_folder(usage),
+                                       dataset_filename, slide_filename,
+                                       set_of_inform, tumor_rate, source,
+                                       self.set_of_patch)
+
 
     """
     param : slide file (openslide)
@@ -468,6 +620,68 @@ class CAMELYON_PREPRO():
         return thumbnail
 
 
+"""
+param : set_of_pos (N x 2, level 0 top-left)
+        threshold (float) a patch overlapping another by more than this
+            part of its area is a near duplicate
+        size_of_cell (int) resolution of the coverage, level 0 pixels
+
+return : dict, coverage is the area of the union of the patches / sum of
+         their areas (1 is no overlap)
+"""
+def get_overlap_of_patches(set_of_pos, patch_size=hp.patch_size,
+                           threshold=0.5, size_of_cell=16):
+    pos = np.asarray(set_of_pos, dtype=np.int64).reshape(-1, 2)
+    w, h = patch_size
+    if len(pos) < 2:
+        return {'patches': len(pos), 'coverage': 1., 'duplicate_rate': 0.,
+                'mean_overlap_of_nearest': 0.}
+
+    # nearest patch in the max norm is the one overlapping the most
+    distance, index = cKDTree(pos).query(pos, k=2, p=np.inf)
+    delta = np.abs(pos - pos[index[:, 1]])
+    overlap = (np.clip(w - delta[:, 0], 0, None) *
+               np.clip(h - delta[:, 1], 0, None)) / float(w * h)
+
+    # cells of the union, ids of (column, row) of every cell of every patch
+    cell = pos // size_of_cell
+    dx, dy = np.meshgrid(np.arange(-(-w // size_of_cell)),
+                         np.arange(-(-h // size_of_cell)))
+    cx = (cell[:, 0:1] + dx.reshape(1, -1)).reshape(-1)
+    cy = (cell[:, 1:2] + dy.reshape(1, -1)).reshape(-1)
+    number_of_cell = len(np.unique((cy - cy.min()) * (cx.max() - cx.min() + 1)
+                                   + (cx - cx.min())))
+
+    return {'patches': len(pos),
+            'coverage': number_of_cell / float(len(pos) * dx.size),
+            'duplicate_rate': float(np.mean(overlap > threshold)),
+            'mean_overlap_of_nearest': float(overlap.mean())}
+
+
+"""
+patches of the tissue of a slide with each min distance, same seed
+"""
+def compare_sampling(slide_filename, list_of_min_distance,
+                     num_of_patch=hp.number_of_patch_per_slide):
+    prepro = CAMELYON_PREPRO.__new__(CAMELYON_PREPRO)
+    prepro.load_slide(slide_filename)
+    tissue_mask = prepro.create_tissue_mask()
+
+    print("%-14s %8s %10s %16s %12s" % ('min distance', 'patches',
+                                        'coverage', 'duplicate rate',
+                                        'seconds'))
+    for min_distance in list_of_min_distance:
+        np.random.seed(0)
+        start = time.time()
+        set_of_pos = prepro.get_pos_of_samples(tissue_mask, num_of_patch,
+                                               min_distance)
+        seconds = time.time() - start
+        report = get_overlap_of_patches(set_of_pos)
+        print("%-14d %8d %10.3f %16.3f %12.2f"
+              % (min_distance, report['patches'], report['coverage'],
+                 report['duplicate_rate'], seconds))
+
+
 """
 """
 def prepro_use_multiprocess(usage, list_of_slide):
@@ -497,7 +711,7 @@ def create_val_dataset(list_of_slide_for_val):
                             list_of_slide_for_val)
 
 
-def create_incorrect_dataset(list_of_slide_for_incorrect):
+def create_incorrect_dataset(list_of_slide_for_train, list_of_slide_for_val):
     print("creat incorrect dataset")
     prepro_use_multiprocess("train_incorrect",
                             list_of_slide_for_train)
@@ -513,13 +727,49 @@ def create_test_dataset():
     CAMELYON_PREPRO("test", "test")
 
 
+"""
+merge the per-slide profile reports written by the pool workers
+"""
+def save_profile_of_dataset(list_of_usage):
+    list_of_report = []
+    for fn in sorted(os.listdir(cf.path_of_profile)):
+        usage = fn.split('_', 1)[0]
+        if usage in list_of_usage and not fn.endswith('.trace.json'):
+            list_of_report.append(os.path.join(cf.path_of_profile, fn))
+
+    report = merge_reports(list_of_report)
+    target_path = os.path.join(cf.path_of_profile, "create_dataset.json")
+    with open(target_path, 'w') as fo:
+        json.dump(report, fo, indent=2, sort_keys=True)
+    print("profile report is saved at", target_path)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Create train / val dataset')
+    parser.add_argument('--compare-sampling', nargs='+', metavar='SLIDE',
+                        help='only compare coverage and duplicate rate of '
+                             'uniform and min distance sampling')
+    parser.add_argument('--min-distance', type=int, nargs='+',
+                        default=[0, 152, 228])
+    return parser
+
+
 if __name__ == "__main__":
+    args = get_parser().parse_args()
+    if args.compare_sampling:
+        for slide_filename in args.compare_sampling:
+            compare_sampling(slide_filename, args.min_distance)
+        sys.exit(0)
+
+    enable_from_config()
     start_time = time.time()
 
     create_train_dataset(cf.list_of_slide_for_train)
     create_val_dataset(cf.list_of_slide_for_val)
-    create_incorrect_dataset(cf.list_of_slide_for_incorrect)
+    # hard examples are mined after training, see hard_example_mining.py
 
     end_time = time.time()
     print("Run time is :  ", end_time - start_time)
+    if profiler.enabled:
+        save_profile_of_dataset(["train", "val"])
     print("Done")
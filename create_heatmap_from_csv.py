@@ -5,13 +5,14 @@ from user_define import Hyperparams as hp
 import os
 
 import numpy as np
-import openslide
 import cv2
 
 # user define variable
 from user_define import Config as cf
 from user_define import Hyperparams as hp
 
+from slide_catalog import slide_catalog
+
 def create_heatmap(slide_fn):
     output_level = cf.level_for_preprocessing
 
@@ -21,21 +22,22 @@ def create_heatmap(slide_fn):
     f = open(csv_path,
              'r', encoding='utf-8')
 
-    target_path = os.path.join(cf.path_of_task_2, slide_fn + ".tif")
-    slide = openslide.OpenSlide(target_path)
+    # sizes from the catalog, the slide is not opened
+    record = slide_catalog.get(slide_fn)
+    downsamples = record['level_downsamples'][output_level]
 
     print("start")
 
-    output = np.zeros(shape=slide.level_dimensions[output_level][::-1])
+    output = np.zeros(shape=record['level_dimensions'][output_level][::-1])
 
     rdr = csv.reader(f)
     for line in rdr:
         if line[2] == '1.0':
             print(line[0], line[1])
             x_pos = line[0].strip()
-            x = round(int(x_pos)/slide.level_downsamples[output_level])
+            x = round(int(x_pos)/downsamples)
             y_pos = line[1].strip()
-            y = round(int(y_pos)/slide.level_downsamples[output_level])
+            y = round(int(y_pos)/downsamples)
             output[y:y+19, x:x+19] = 255
 
     target_path = os.path.join(cf.path_for_result, slide_fn, slide_fn + "_pred.png")
@@ -0,0 +1,176 @@
+""" Knowledge distillation from a teacher checkpoint (used by train.py)
+
+Set hp.use_distillation = True and put the teacher at
+cf.path_of_teacher_checkpoint, then run 'python train.py'. The student
+(hp.arch_of_student, ex) resnet18_narrow) is trained on
+    ratio * T^2 * BCE(sigmoid(student_logit / T), sigmoid(teacher_logit / T))
+    + (1 - ratio) * BCE(student_prob, label)
+and saved like any model of train.py, so eval.py, export.py and
+infer_cpu.py use it directly.
+
+The teacher runs once per patch of the train set (without augmentation,
+with the stain normalization of the student) and its logits are kept in a
+.npy memmap keyed by dataset index, so later epochs and later runs read
+them instead of running the teacher. The cache is rebuilt when the teacher
+or the patches of the dataset (get_fingerprint_of_dataset) change.
+"""
+from __future__ import print_function
+
+import os
+import json
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+# user define variable
+from user_define import Config as cf
+from user_define import Hyperparams as hp
+
+from export import load_checkpoint
+from load_dataset import get_fingerprint_of_dataset
+from stain_norm import get_normalizer
+
+
+"""
+param : prob (tensor of sigmoid outputs)
+
+return : logit, clamped so saturated outputs stay finite
+"""
+def get_logit(prob, eps=1e-6):
+    prob = prob.clamp(eps, 1 - eps)
+    return torch.log(prob) - torch.log1p(-prob)
+
+
+class TEACHER_LOGIT_CACHE(object):
+    """
+    Teacher logit of every patch of a dataset, on disk
+
+    Args:
+        cache_path (string) .npy, float32 of len(dataset), NaN if missing
+        teacher_path (string) checkpoint of the teacher, the cache is
+            rebuilt if it changes
+        num_of_data (int) len(dataset)
+        fingerprint (string) of the dataset, the cache is rebuilt if the
+            patches behind the indices change
+    """
+
+    def __init__(self, cache_path, teacher_path, num_of_data,
+                 fingerprint=None):
+        self.cache_path = cache_path
+        self.meta_path = cache_path + '.json'
+        meta = {'teacher': os.path.abspath(teacher_path),
+                'mtime_of_teacher': os.path.getmtime(teacher_path),
+                'num_of_data': num_of_data,
+                'fingerprint': fingerprint,
+                'stain': (hp.method_of_stain_normalization
+                          if hp.use_stain_normalization else None)}
+
+        if os.path.isfile(cache_path) and self._read_meta() == meta:
+            self.logits = np.load(cache_path, mmap_mode='r+')
+        else:
+            if not os.path.isdir(os.path.dirname(cache_path) or '.'):
+                os.makedirs(os.path.dirname(cache_path))
+            self.logits = np.lib.format.open_memmap(
+                cache_path, mode='w+', dtype=np.float32, shape=(num_of_data,))
+            self.logits[:] = np.nan
+            self.logits.flush()
+            with open(self.meta_path, 'w') as fo:
+                json.dump(meta, fo)
+
+    def _read_meta(self):
+        if not os.path.isfile(self.meta_path):
+            return None
+        with open(self.meta_path) as fo:
+            return json.load(fo)
+
+    def get_missing_index(self):
+        return np.flatnonzero(np.isnan(self.logits))
+
+    """
+    run the teacher over the patches not cached yet
+
+    param : teacher (nn.Module, sigmoid output)
+            dataset (CUSTOM_DATASET with return_index)
+    """
+    def fill(self, teacher, dataset, batch_size, use_cuda, num_workers=4):
+        missing = self.get_missing_index()
+        if len(missing) == 0:
+            print("teacher logits are cached at", self.cache_path)
+            return
+
+        print("teacher logits of %d patches" % len(missing))
+        start_time = time.time()
+        loader = torch.utils.data.DataLoader(
+            torch.utils.data.Subset(dataset, missing.tolist()),
+            batch_size, shuffle=False, num_workers=num_workers)
+
+        # the inputs of the student in train.py, None without normalization
+        stain = get_normalizer(dataset)
+
+        teacher.eval()
+        with torch.no_grad():
+            for inputs, _, index in loader:
+                if use_cuda:
+                    inputs = inputs.cuda()
+                if stain is not None:
+                    inputs = stain(inputs, index)
+                logit = get_logit(teacher(inputs).view(-1))
+                self.logits[index.numpy()] = logit.cpu().numpy()
+        self.logits.flush()
+        print("teacher is end, Running time is : %.2f"
+              % (time.time() - start_time))
+
+    def __getitem__(self, index):
+        if hasattr(index, 'numpy'):
+            index = index.numpy()
+        return torch.from_numpy(np.asarray(self.logits[index]))
+
+
+"""
+param : outputs (student prob, N)
+        targets (label, N)
+        teacher_logit (N)
+
+return : loss
+"""
+def distillation_loss(outputs, targets, teacher_logit,
+                      temperature=hp.temperature_of_distillation,
+                      ratio=hp.ratio_of_distillation_loss):
+    soft_target = torch.sigmoid(teacher_logit / temperature)
+    student_logit = get_logit(outputs)
+    soft_loss = F.binary_cross_entropy_with_logits(
+        student_logit / temperature, soft_target)
+    hard_loss = F.binary_cross_entropy(outputs, targets)
+    # T^2 keeps the gradient of the soft part in scale with the hard part
+    return ratio * temperature ** 2 * soft_loss + (1 - ratio) * hard_loss
+
+
+"""
+return : logit cache of the teacher, filled for every patch of trainset
+"""
+def prepare_teacher(trainset, transform, use_cuda,
+                    teacher_path=cf.path_of_teacher_checkpoint,
+                    cache_path=cf.path_of_teacher_logits):
+    cache = TEACHER_LOGIT_CACHE(cache_path, teacher_path, len(trainset),
+                                get_fingerprint_of_dataset(trainset))
+    if len(cache.get_missing_index()) == 0:
+        print("teacher logits are cached at", cache_path)
+        return cache
+
+    print('==> Loading teacher..', teacher_path)
+    teacher = load_checkpoint(teacher_path)['net']
+    if isinstance(teacher, torch.nn.DataParallel):
+        teacher = teacher.module
+    if use_cuda:
+        teacher.cuda()
+
+    # the teacher sees the patches without augmentation, once
+    transform_of_train = trainset.transform
+    trainset.transform = transform
+    try:
+        cache.fill(teacher, trainset, hp.batch_size_for_eval, use_cuda)
+    finally:
+        trainset.transform = transform_of_train
+    return cache
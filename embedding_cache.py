@@ -0,0 +1,303 @@
+""" Feature embedding cache, for retraining heads without the backbone
+
+usage :
+    python embedding_cache.py                          # ./checkpoint/ckpt.pth.tar
+    python embedding_cache.py --save ./checkpoint/ckpt_head.pth.tar
+    python embedding_cache.py --checkpoints a.pth.tar b.pth.tar   # probing
+
+The frozen backbone runs once over the train and val patch pickles and the
+input of 'fullyconnected' (the avgpool feature, 512-d for resnet18) is
+written to a float16 .npy memmap in cf.path_of_embedding, named after the
+absolute path of the checkpoint and rebuilt when the checkpoint (mtime) or
+the pickles (get_fingerprint_of_folder) change. The patches are read batch
+by batch from the npy store of the pickles, and stain normalized as in
+train.py when hp.use_stain_normalization is on. A logistic head (and the
+threshold of best F1) is then trained from the cache in seconds, so the
+fullyconnected layer can be retrained, re-calibrated or compared across
+checkpoints (linear probe) without running the backbone again.
+"""
+from __future__ import print_function
+
+import os
+import json
+import hashlib
+import time
+import argparse
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+# user define variable
+from user_define import Config as cf
+from user_define import Hyperparams as hp
+
+from export import load_net
+from froc import compute_auc
+from load_dataset import load_patches, get_fingerprint_of_folder
+from stain_norm import STAIN_NORMALIZER
+
+
+"""
+param : net (ResNet, DenseNet or Inception3 of models/)
+        inputs (float tensor, N x 3 x H x W)
+
+return : input of net.fullyconnected (N x D)
+"""
+def get_embedding(net, inputs):
+    embedding = []
+    hook = net.fullyconnected.register_forward_hook(
+        lambda module, x, output: embedding.append(x[0]))
+    try:
+        net(inputs)
+    finally:
+        hook.remove()
+    return embedding[0]
+
+
+class EMBEDDING_CACHE(object):
+    """
+    Embeddings of the patches of one usage, for one checkpoint
+
+    Args:
+        checkpoint_path (string)
+        usage (string) 'train' or 'val'
+        path_of_embedding (string) directory of the caches
+        fingerprint (string) of the patches, default the pickles of usage
+    """
+
+    def __init__(self, checkpoint_path, usage,
+                 path_of_embedding=cf.path_of_embedding, fingerprint=None):
+        name = os.path.splitext(os.path.basename(checkpoint_path))[0]
+        # every run of train.py saves ckpt.pth.tar, the hash of the path
+        # keeps the caches of run1/ckpt and run2/ckpt apart
+        name = "%s_%s" % (name.replace('.pth', ''), hashlib.sha1(
+            os.path.abspath(checkpoint_path).encode()).hexdigest()[:10])
+        self.embedding_path = os.path.join(path_of_embedding,
+                                           "%s_%s.npy" % (name, usage))
+        self.label_path = os.path.join(path_of_embedding,
+                                       "%s_%s_label.npy" % (name, usage))
+        self.meta_path = os.path.join(path_of_embedding,
+                                      "%s_%s.json" % (name, usage))
+        if fingerprint is None:
+            fingerprint = get_fingerprint_of_folder(get_path_of_dataset(usage))
+        self.meta = {'checkpoint': os.path.abspath(checkpoint_path),
+                     'mtime_of_checkpoint': os.path.getmtime(checkpoint_path),
+                     'usage': usage,
+                     'fingerprint': fingerprint,
+                     'stain': (hp.method_of_stain_normalization
+                               if hp.use_stain_normalization else None)}
+        self.checkpoint_path = checkpoint_path
+        self.usage = usage
+
+    def is_valid(self):
+        if not (os.path.isfile(self.embedding_path) and
+                os.path.isfile(self.meta_path)):
+            return False
+        with open(self.meta_path) as fo:
+            meta = json.load(fo)
+        return all(meta.get(k) == v for k, v in self.meta.items())
+
+    """
+    run the backbone over the patches and write the cache
+
+    param : stain (STAIN_NORMALIZER or None) applied per batch, with the
+            index of the patches
+    """
+    def build(self, net, data, labels, batch_size=hp.batch_size_for_eval,
+              use_cuda=False, stain=None):
+        start_time = time.time()
+        if not os.path.isdir(os.path.dirname(self.embedding_path)):
+            os.makedirs(os.path.dirname(self.embedding_path))
+
+        net.eval()
+        embedding = None
+        with torch.no_grad():
+            for i in range(0, len(data), batch_size):
+                # same as transforms.ToTensor()
+                inputs = torch.from_numpy(data[i:i + batch_size])
+                inputs = inputs.permute(0, 3, 1, 2).float().div(255.)
+                if use_cuda:
+                    inputs = inputs.cuda()
+                if stain is not None:
+                    inputs = stain(inputs, np.arange(i, i + len(inputs)))
+                feature = get_embedding(net, inputs).cpu().numpy()
+                if embedding is None:
+                    embedding = np.lib.format.open_memmap(
+                        self.embedding_path, mode='w+', dtype=np.float16,
+                        shape=(len(data), feature.shape[1]))
+                embedding[i:i + len(feature)] = feature
+        embedding.flush()
+        np.save(self.label_path, np.asarray(labels, dtype=np.float32))
+
+        meta = dict(self.meta, num_of_data=len(data),
+                    dim=int(embedding.shape[1]))
+        with open(self.meta_path, 'w') as fo:
+            json.dump(meta, fo)
+        print("%s %s : %d embeddings, Running time is : %.2f"
+              % (os.path.basename(self.checkpoint_path), self.usage,
+                 len(data), time.time() - start_time))
+
+    """
+    return : embedding (float16 memmap, N x D), labels (float32, N)
+    """
+    def load(self):
+        return (np.load(self.embedding_path, mmap_mode='r'),
+                np.load(self.label_path))
+
+
+def get_path_of_dataset(usage):
+    if usage == 'train':
+        return cf.path_of_train_dataset
+    return cf.path_of_val_dataset
+
+
+"""
+build (if needed) and load the caches of train and val for a checkpoint
+
+param : dataset (dict of usage -> (data, labels)) patches used instead of
+            the pickles of that usage, without stain normalization
+
+return : dict of usage -> (embedding, labels), and the net
+"""
+def get_caches(checkpoint_path, arch=None, list_of_usage=('train', 'val'),
+               use_cuda=False, dataset=None):
+    net = None
+    caches = {}
+    for usage in list_of_usage:
+        fingerprint = None
+        if dataset is not None and usage in dataset:
+            data, labels = dataset[usage]
+            fingerprint = hashlib.sha1(np.ascontiguousarray(labels).tobytes()
+                                       + np.ascontiguousarray(data).tobytes()
+                                       ).hexdigest()
+        cache = EMBEDDING_CACHE(checkpoint_path, usage,
+                                fingerprint=fingerprint)
+        if not cache.is_valid():
+            if net is None:
+                net = load_net(checkpoint_path, arch)
+                if use_cuda:
+                    net.cuda()
+            stain = None
+            if dataset is None or usage not in dataset:
+                data, labels, list_of_slide, slide_index = load_patches(
+                    get_path_of_dataset(usage), return_slide=True, lazy=True)
+                if hp.use_stain_normalization:
+                    stain = STAIN_NORMALIZER(list_of_slide, slide_index)
+            cache.build(net, data, labels, use_cuda=use_cuda, stain=stain)
+        caches[usage] = cache.load()
+    return caches
+
+
+"""
+logistic head on cached embeddings
+
+param : embedding (N x D), labels (N,)
+        fullyconnected (nn.Linear or None) start from its weights
+
+return : nn.Linear (D -> 1)
+"""
+def train_head(embedding, labels, fullyconnected=None, epochs=20,
+               learning_rate=1e-2, weight_decay=hp.weight_decay,
+               batch_size=4096, seed=0):
+    torch.manual_seed(seed)
+    x = torch.from_numpy(np.asarray(embedding, dtype=np.float32))
+    y = torch.from_numpy(np.asarray(labels, dtype=np.float32))
+
+    head = nn.Linear(x.size(1), 1)
+    if fullyconnected is not None:
+        head.load_state_dict(fullyconnected.state_dict())
+    optimizer = torch.optim.Adam(head.parameters(), lr=learning_rate,
+                                 weight_decay=weight_decay)
+
+    for _ in range(epochs):
+        for index in torch.randperm(len(x)).split(batch_size):
+            optimizer.zero_grad()
+            logit = head(x[index]).view(-1)
+            loss = F.binary_cross_entropy_with_logits(logit, y[index])
+            loss.backward()
+            optimizer.step()
+    return head
+
+
+def predict_head(head, embedding):
+    x = torch.from_numpy(np.asarray(embedding, dtype=np.float32))
+    with torch.no_grad():
+        return torch.sigmoid(head(x).view(-1)).numpy()
+
+
+"""
+return : threshold of the best F1 (like val() of train.py), F1
+"""
+def calibrate_threshold(prob, labels):
+    order = np.argsort(-prob, kind='stable')
+    prob = prob[order]
+    labels = np.asarray(labels)[order] > 0.5
+
+    true_positive = np.cumsum(labels)
+    predicted = np.arange(1, len(prob) + 1)
+    precision = true_positive / predicted
+    recall = true_positive / max(labels.sum(), 1)
+    f_score = 2 * precision * recall / (precision + recall + 1e-8)
+
+    # only where the next prob differs, the threshold cannot split ties
+    is_cut = np.append(prob[1:] != prob[:-1], True)
+    best = np.flatnonzero(is_cut)[np.argmax(f_score[is_cut])]
+    return float(prob[best]), float(f_score[best])
+
+
+"""
+train a head on train, report AUC and threshold on val
+
+return : head, dict
+"""
+def probe(caches, fullyconnected=None, epochs=20):
+    start_time = time.time()
+    train_embedding, train_labels = caches['train']
+    val_embedding, val_labels = caches['val']
+
+    head = train_head(train_embedding, train_labels, fullyconnected, epochs)
+    prob = predict_head(head, val_embedding)
+    threshold, f_score = calibrate_threshold(prob, val_labels)
+    return head, {'AUC': compute_auc(prob, val_labels > 0.5),
+                  'threshold': threshold,
+                  'F_score': f_score,
+                  'seconds': time.time() - start_time}
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Embedding cache')
+    parser.add_argument('--checkpoints', nargs='+',
+                        default=[cf.path_of_checkpoint])
+    parser.add_argument('--arch', default=None,
+                        help='needed for state_dict checkpoints')
+    parser.add_argument('--epochs', type=int, default=20)
+    parser.add_argument('--from-scratch', action='store_true',
+                        help='do not start from the fullyconnected weights')
+    parser.add_argument('--save', default=None,
+                        help='save the first checkpoint with the new head')
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+    use_cuda = torch.cuda.is_available()
+
+    print("%-40s %8s %10s %8s %8s" % ('checkpoint', 'AUC', 'threshold',
+                                      'F1', 'sec'))
+    for i, checkpoint_path in enumerate(args.checkpoints):
+        caches = get_caches(checkpoint_path, args.arch, use_cuda=use_cuda)
+        net = load_net(checkpoint_path, args.arch)
+        fullyconnected = None if args.from_scratch else net.fullyconnected
+
+        head, report = probe(caches, fullyconnected, args.epochs)
+        print("%-40s %8.4f %10.4f %8.4f %8.2f"
+              % (checkpoint_path, report['AUC'], report['threshold'],
+                 report['F_score'], report['seconds']))
+
+        if args.save is not None and i == 0:
+            net.fullyconnected.load_state_dict(head.state_dict())
+            torch.save({'net': net, 'AUC': report['AUC'], 'epoch': -1,
+                        'threshold': report['threshold']}, args.save)
+            print("checkpoint with the new head is saved at", args.save)
@@ -26,26 +26,48 @@ from load_dataset import *
 
 import pdb
 import csv
+import time
+
+from profiler import profiler, enable_from_config
+from stain_norm import get_normalizer
+from export import load_checkpoint
 
 # user define variable
 from user_define import Config as cf
 from user_define import Hyperparams as hp
 
 use_cuda = torch.cuda.is_available()
+enable_from_config(sync=torch.cuda.synchronize if use_cuda else None)
 
 print('==> Preparing data..')
 transform_test = transforms.Compose([
     transforms.ToTensor(),
 ])
-testset = get_test_dataset(transform_test)
+# one read_region per region of patches, items are already batches
+region_batched = hp.patches_per_side_of_region > 1
+testset = get_test_dataset(transform_test, region_batched)
+# None unless hp.use_stain_normalization
+stain = get_normalizer(testset)
 testloader = torch.utils.data.DataLoader(testset,
-                                         hp.batch_size_for_eval,
+                                         None if region_batched
+                                         else hp.batch_size_for_eval,
                                          shuffle=False,
-                                         num_workers=8)
+                                         num_workers=8,
+                                         collate_fn=None if region_batched
+                                         else profiled_collate,
+                                         worker_init_fn=profiler.worker_init_fn)
 
 print('==> Resuming from checkpoint..')
-checkpoint = torch.load('./checkpoint/ckpt.pth.tar')
-net = checkpoint['net']
+# pickled nn.Module, loaded on CPU (moved to the device below)
+net = load_checkpoint(cf.path_of_checkpoint)['net']
+if isinstance(net, torch.nn.DataParallel):
+    net = net.module
+# fold BatchNorm and padding, checked against the checkpoint
+net = optimize_for_inference(net)
+if hp.number_of_tta_view > 1:
+    # views are made from the batch on the device, the loader is unchanged
+    from tta import TTA_WRAPPER
+    net = TTA_WRAPPER(net, hp.number_of_tta_view)
 
 if use_cuda:
     net.cuda()
@@ -54,11 +76,11 @@ if use_cuda:
     cudnn.benchmark = True
 
 
-def makecsv(file_writer, output, label, size):
+def makecsv(file_writer, output, prob, label, size):
     for i in range(size):
         if output[i] == 1:
             print(label[i][0], label[i][1])
-        file_writer.writerow([label[i][0], label[i][1], output[i]])
+        file_writer.writerow([label[i][0], label[i][1], output[i], prob[i]])
 
 
 def eval_run(slide_fn):
@@ -70,19 +92,29 @@ def eval_run(slide_fn):
 
     for batch_idx, (inputs, label) in enumerate(testloader):
         if use_cuda:
-            inputs = inputs.type(torch.cuda.FloatTensor)
-            inputs = inputs.cuda()
+            with profiler.timer('h2d'):
+                inputs = inputs.type(torch.cuda.FloatTensor)
+                inputs = inputs.cuda()
+
+        if stain is not None:
+            with profiler.timer('stain_norm'):
+                inputs = stain(inputs)
 
         inputs = Variable(inputs, volatile=True)
 
-        outputs = net(inputs)
-        outputs = torch.squeeze(outputs)
-        thresholding = torch.ones(inputs.size(0)) * (1 - hp.threshold_for_eval)
-        outputs = outputs + Variable(thresholding.cuda())
-        outputs = torch.floor(outputs)
-        outputs_cpu = outputs.data.cpu()
+        with profiler.timer('forward'):
+            outputs = net(inputs)
+            outputs = torch.squeeze(outputs)
+            prob_cpu = outputs.data.cpu()
+            thresholding = torch.ones(inputs.size(0)) * (1 - hp.threshold_for_eval)
+            if use_cuda:
+                thresholding = thresholding.cuda()
+            outputs = outputs + Variable(thresholding)
+            outputs = torch.floor(outputs)
+            outputs_cpu = outputs.data.cpu()
 
-        makecsv(fw, outputs_cpu, label, inputs.size(0))
+        with profiler.timer('write_csv'):
+            makecsv(fw, outputs_cpu, prob_cpu, label, inputs.size(0))
 
         print("\r loop is %d" % batch_idx)
 
@@ -94,5 +126,7 @@ if __name__ == "__main__":
         eval_run(slide_fn)
     end_time = time.time()
     print("Program end, Running time is :  ", end_time - start_time)
+    profiler.print_summary()
+    profiler.dump('eval')
 
     print("end")
@@ -0,0 +1,190 @@
+""" Export a patch classifier to TorchScript and ONNX
+
+usage :
+    python export.py                          # ./checkpoint/ckpt.pth.tar
+    python export.py --arch densenet121 --checkpoint ckpt.pth.tar
+    python export.py --arch resnet18 --no-checkpoint   # untrained, for tests
+
+The exported graph takes a batch of RGB patches as read from the slide
+(uint8, N x H x W x 3), so ToTensor, the sigmoid of the model and
+the threshold of eval.py are all inside it and the runtime (infer_cpu.py)
+needs neither models/, the training code nor CUDA. It returns
+
+    prob (float32, N)       output of the model
+    predicted (float32, N)  1.0 if prob >= threshold else 0.0
+"""
+from __future__ import print_function
+
+import os
+import argparse
+
+import torch
+import torch.nn as nn
+
+# user define variable
+from user_define import Config as cf
+from user_define import Hyperparams as hp
+
+
+LIST_OF_ARCH = ('resnet18', 'densenet121', 'inception_v3',
+                'resnet10_narrow', 'resnet18_narrow')
+
+
+class PATCH_CLASSIFIER(nn.Module):
+    """
+    Model + preprocessing + threshold, for export
+
+    Args:
+        net (nn.Module) resnet18 / densenet121 / inception_v3 of models/
+        threshold (float) threshold of the prediction
+    """
+
+    def __init__(self, net, threshold=hp.threshold_for_eval):
+        super(PATCH_CLASSIFIER, self).__init__()
+        self.net = net
+        self.register_buffer('threshold',
+                             torch.tensor(float(threshold)))
+
+    def forward(self, patch):
+        # same as transforms.ToTensor()
+        x = patch.permute(0, 3, 1, 2).float().div(255.)
+        prob = self.net(x).view(-1)
+        predicted = (prob >= self.threshold).float()
+        return prob, predicted
+
+
+"""
+torch.load on CPU, also for the pickled modules of train.py
+"""
+def load_checkpoint(checkpoint_path):
+    try:
+        return torch.load(checkpoint_path, map_location='cpu',
+                          weights_only=False)
+    except TypeError:
+        # torch < 1.13 has no weights_only
+        return torch.load(checkpoint_path, map_location='cpu')
+
+
+"""
+param : checkpoint_path (string or None)
+        arch (string or None) needed if the checkpoint holds a state_dict
+            or to build an untrained model without checkpoint
+
+return : net (nn.Module, eval mode, on CPU)
+"""
+def load_net(checkpoint_path=cf.path_of_checkpoint, arch=None):
+    net = None
+    if checkpoint_path is not None:
+        net = load_checkpoint(checkpoint_path)['net']
+        if isinstance(net, nn.DataParallel):
+            net = net.module
+
+    if arch is not None:
+        import models
+        if arch not in LIST_OF_ARCH:
+            raise RuntimeError("invalid arch " + arch)
+        model = getattr(models, arch)(pretrained=False)
+        if net is not None:
+            state_dict = net if isinstance(net, dict) else net.state_dict()
+            model.load_state_dict(state_dict)
+        net = model
+    elif net is None or isinstance(net, dict):
+        raise RuntimeError("arch is needed to build the model")
+
+    net.cpu()
+    net.eval()
+    return net
+
+
+def get_example_input(batch_size=2):
+    w, h = hp.patch_size
+    return torch.randint(0, 256, (batch_size, h, w, 3), dtype=torch.uint8)
+
+
+def export_torchscript(wrapper, target_path):
+    with torch.no_grad():
+        traced = torch.jit.trace(wrapper, get_example_input())
+    traced = torch.jit.freeze(traced)
+    traced.save(target_path)
+    return traced
+
+
+def export_onnx(wrapper, target_path, opset_version=13):
+    kwargs = {}
+    if 'dynamo' in torch.onnx.export.__code__.co_varnames:
+        # the TorchScript based exporter, same graph as export_torchscript
+        kwargs['dynamo'] = False
+    with torch.no_grad():
+        torch.onnx.export(wrapper, (get_example_input(),), target_path,
+                          input_names=['patch'],
+                          output_names=['prob', 'predicted'],
+                          dynamic_axes={'patch': {0: 'batch'},
+                                        'prob': {0: 'batch'},
+                                        'predicted': {0: 'batch'}},
+                          opset_version=opset_version,
+                          **kwargs)
+
+
+"""
+max abs difference of prob between the eager wrapper and the exported one
+"""
+def check_exported(wrapper, traced, batch_size=4):
+    x = get_example_input(batch_size)
+    with torch.no_grad():
+        expected, _ = wrapper(x)
+        prob, _ = traced(x)
+    return float((expected - prob).abs().max())
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Export patch classifier')
+    parser.add_argument('--checkpoint', default=cf.path_of_checkpoint)
+    parser.add_argument('--no-checkpoint', action='store_true',
+                        help='export an untrained --arch')
+    parser.add_argument('--arch', choices=LIST_OF_ARCH, default=None,
+                        help='needed for state_dict checkpoints')
+    parser.add_argument('--threshold', type=float, default=hp.threshold_for_eval)
+    parser.add_argument('--output-dir', default=cf.path_of_export)
+    parser.add_argument('--name', default='patch_classifier')
+    parser.add_argument('--skip-onnx', action='store_true')
+    parser.add_argument('--no-optimize', action='store_true',
+                        help='keep BatchNorm and padding layers as trained')
+    parser.add_argument('--tta', type=int, choices=[1, 2, 4, 8], default=1,
+                        help='dihedral views averaged inside the graph')
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+
+    if hp.use_stain_normalization:
+        print("WARNING : the model is trained on stain normalized patches "
+              "and the graph does not normalize them. infer_cpu.py and "
+              "quantization.py do it before the graph, another runtime "
+              "must apply stain_norm.normalize_patches first")
+
+    checkpoint_path = None if args.no_checkpoint else args.checkpoint
+    net = load_net(checkpoint_path, args.arch)
+    if not args.no_optimize:
+        from models import optimize_for_inference
+        net = optimize_for_inference(net)
+    if args.tta > 1:
+        from tta import TTA_WRAPPER
+        net = TTA_WRAPPER(net, args.tta)
+    wrapper = PATCH_CLASSIFIER(net, args.threshold)
+    wrapper.eval()
+
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    target_path = os.path.join(args.output_dir, args.name + '.pt')
+    traced = export_torchscript(wrapper, target_path)
+    print("TorchScript is saved at", target_path,
+          "max diff : %.2e" % check_exported(wrapper, traced))
+
+    if not args.skip_onnx:
+        target_path = os.path.join(args.output_dir, args.name + '.onnx')
+        export_onnx(wrapper, target_path)
+        print("ONNX is saved at", target_path)
+
+    print("Done")
@@ -0,0 +1,304 @@
+""" Lesion-level FROC and slide-level AUC over slide probability maps
+
+usage :
+    python eval.py  # or hard_example_mining.py --predict, writes the csv
+    python froc.py --slides b_2 b_5 b_10
+
+The per-patch probabilities in cf.path_for_result/$SLIDE_NAME/
+$SLIDE_NAME_result.csv (x, y, predicted, prob) are put on a grid with one
+cell per stride_for_heatmap. Lesion candidates are the connected components
+(or the local maxima, with --nms) of the grid above a threshold, scored by
+their maximum probability. Ground truth is the tumor mask of
+CAMELYON_PREPRO, labelled into lesions like the CAMELYON16 evaluation
+(tumor dilated by 75um, isolated tumor cells shorter than 275um are
+neither a hit nor a false positive).
+
+Slides are processed in parallel, and FROC over every threshold is computed
+at once from sorted scores, so a full set finishes in seconds.
+"""
+from __future__ import print_function
+
+import os
+import json
+import time
+import argparse
+from multiprocessing import Pool
+
+import numpy as np
+from scipy import ndimage
+from scipy.stats import rankdata
+
+# user define variable
+from user_define import Config as cf
+from user_define import Hyperparams as hp
+
+from create_dataset import CAMELYON_PREPRO
+from slide_catalog import slide_catalog
+from hard_example_mining import get_path_of_prediction, read_predictions
+
+
+FP_RATES_OF_FROC = (0.25, 0.5, 1, 2, 4, 8)
+
+# CAMELYON16 evaluation
+DILATION_IN_UM = 75
+ITC_SIZE_IN_UM = 275
+DEFAULT_MPP = 0.243
+
+# 8-connectivity
+STRUCTURE = np.ones((3, 3), dtype=bool)
+
+
+class SLIDE_GROUND_TRUTH(CAMELYON_PREPRO):
+    """
+    Tumor mask of a slide, labelled into lesions
+
+    Args:
+        slide_filename (string) ex) 'b_2', slides without an annotation
+            xml are normal slides
+    """
+
+    def __init__(self, slide_filename):
+        self.load_slide(slide_filename)
+        self.tumor_mask = self.create_tumor_mask()
+
+        self.mpp = slide_catalog.get(slide_filename)['mpp_x'] or DEFAULT_MPP
+        self.label, self.is_itc = self.get_lesions()
+
+    def get_annotation_from_xml(self, target_xml_path, downsamples=None):
+        if not os.path.isfile(target_xml_path):
+            return []
+        return CAMELYON_PREPRO.get_annotation_from_xml(self, target_xml_path,
+                                                       downsamples)
+
+    """
+    return : label (int32, tumor mask size, 0 is not a lesion)
+             is_itc (bool, num_of_lesion + 1, index by label)
+    """
+    def get_lesions(self):
+        um_per_pixel = self.mpp * self.downsamples
+        is_tumor = self.tumor_mask.to_array() > 0
+        if not is_tumor.any():
+            return np.zeros(is_tumor.shape, np.int32), np.zeros(1, bool)
+
+        radius = DILATION_IN_UM / um_per_pixel
+        distance = ndimage.distance_transform_edt(~is_tumor)
+        label, num_of_lesion = ndimage.label(distance < radius, STRUCTURE)
+
+        is_itc = np.zeros(num_of_lesion + 1, dtype=bool)
+        for i, region in enumerate(ndimage.find_objects(label)):
+            # size of the lesion itself, without the dilation
+            ys, xs = np.nonzero(is_tumor[region] & (label[region] == i + 1))
+            if len(ys) == 0:
+                is_itc[i + 1] = True
+                continue
+            length = max(ys.max() - ys.min(), xs.max() - xs.min()) + 1
+            is_itc[i + 1] = length * um_per_pixel < ITC_SIZE_IN_UM
+        return label.astype(np.int32), is_itc
+
+
+"""
+param : predictions (N x 3 of x, y, prob, level 0)
+        shape (row, col of level 0)
+        stride (int, level 0)
+
+return : grid of probability (float32, 0 where nothing is predicted)
+"""
+def get_prob_grid(predictions, shape, stride=cf.stride_for_heatmap):
+    row = (shape[0] + stride - 1) // stride
+    col = (shape[1] + stride - 1) // stride
+    grid = np.zeros((row, col), dtype=np.float32)
+    if len(predictions) == 0:
+        return grid
+
+    gx = np.clip((predictions[:, 0] // stride).astype(np.int64), 0, col - 1)
+    gy = np.clip((predictions[:, 1] // stride).astype(np.int64), 0, row - 1)
+    # overlapping patches, keep the highest
+    np.maximum.at(grid, (gy, gx), predictions[:, 2])
+    return grid
+
+
+"""
+param : grid (probability grid)
+        threshold (float)
+        nms_size (int) 0 for one candidate per connected component,
+            else the size of the max filter window (in grid cells)
+
+return : candidates (N x 3 of gx, gy, score)
+"""
+def get_candidates(grid, threshold, nms_size=0):
+    is_over = grid >= threshold
+    if not is_over.any():
+        return np.zeros((0, 3), dtype=np.float64)
+
+    if nms_size > 0:
+        peak = ndimage.maximum_filter(grid, size=nms_size, mode='constant')
+        gy, gx = np.nonzero(is_over & (grid == peak))
+        return np.stack([gx, gy, grid[gy, gx]], axis=1).astype(np.float64)
+
+    label, num_of_component = ndimage.label(is_over, STRUCTURE)
+    index = np.arange(1, num_of_component + 1)
+    score = ndimage.maximum(grid, label, index)
+    pos = ndimage.maximum_position(grid, label, index)
+    pos = np.asarray(pos, dtype=np.float64).reshape(-1, 2)
+    return np.stack([pos[:, 1], pos[:, 0], score], axis=1)
+
+
+"""
+evaluate one slide
+
+return : dict of
+    score (float) slide score, max probability
+    is_tumor (bool)
+    candidate_score (float64, candidates)
+    candidate_lesion (int64, candidates) lesion hit, 0 for FP, -1 for ITC
+    num_of_lesion (int) lesions to detect (without ITC)
+"""
+def evaluate_slide(slide_filename, threshold, nms_size,
+                   stride=cf.stride_for_heatmap):
+    truth = SLIDE_GROUND_TRUTH(slide_filename)
+    shape = tuple(slide_catalog.get(slide_filename)['level_dimensions'][0][::-1])
+
+    predictions = read_predictions(get_path_of_prediction(slide_filename))
+    grid = get_prob_grid(predictions, shape, stride)
+    candidates = get_candidates(grid, threshold, nms_size)
+
+    # center of the candidate cell on the tumor mask
+    row, col = truth.label.shape
+    mx = ((candidates[:, 0] + 0.5) * stride / truth.downsamples).astype(np.int64)
+    my = ((candidates[:, 1] + 0.5) * stride / truth.downsamples).astype(np.int64)
+    lesion = truth.label[np.clip(my, 0, row - 1), np.clip(mx, 0, col - 1)]
+    lesion = lesion.astype(np.int64)
+    lesion[truth.is_itc[lesion] & (lesion > 0)] = -1
+
+    return {'slide': slide_filename,
+            'score': float(grid.max()) if grid.size else 0.,
+            'is_tumor': bool(truth.label.any()),
+            'candidate_score': candidates[:, 2],
+            'candidate_lesion': lesion,
+            'num_of_lesion': int(np.sum(~truth.is_itc[1:]))}
+
+
+"""
+param : score, is_positive (arrays of the same length)
+
+return : area under ROC (Mann-Whitney U with averaged ranks for ties)
+"""
+def compute_auc(score, is_positive):
+    score = np.asarray(score, dtype=np.float64)
+    is_positive = np.asarray(is_positive, dtype=bool)
+    num_of_pos = int(is_positive.sum())
+    num_of_neg = len(is_positive) - num_of_pos
+    if num_of_pos == 0 or num_of_neg == 0:
+        return float('nan')
+    rank = rankdata(score)
+    u = rank[is_positive].sum() - num_of_pos * (num_of_pos + 1) / 2.
+    return float(u / (num_of_pos * num_of_neg))
+
+
+"""
+param : list_of_result (of evaluate_slide)
+
+return : thresholds, avg FP per slide, sensitivity (for every threshold,
+         from the highest), FROC score (mean sensitivity at FP_RATES_OF_FROC)
+"""
+def compute_froc(list_of_result, fp_rates=FP_RATES_OF_FROC):
+    num_of_slide = len(list_of_result)
+    num_of_lesion = sum(r['num_of_lesion'] for r in list_of_result)
+
+    set_of_fp = []
+    set_of_hit = []
+    for r in list_of_result:
+        score = r['candidate_score']
+        lesion = r['candidate_lesion']
+        set_of_fp.append(score[lesion == 0])
+        is_hit = lesion > 0
+        if is_hit.any():
+            # a lesion is detected from the threshold of its best candidate
+            best = np.zeros(lesion.max() + 1)
+            np.maximum.at(best, lesion[is_hit], score[is_hit])
+            set_of_hit.append(best[best > 0])
+    fp_score = np.sort(np.concatenate(set_of_fp)) if set_of_fp else np.zeros(0)
+    hit_score = np.sort(np.concatenate(set_of_hit)) if set_of_hit else np.zeros(0)
+
+    thresholds = np.unique(np.concatenate([fp_score, hit_score]))[::-1]
+    # number of scores >= threshold
+    num_of_fp = len(fp_score) - np.searchsorted(fp_score, thresholds, 'left')
+    num_of_hit = len(hit_score) - np.searchsorted(hit_score, thresholds, 'left')
+
+    avg_fp = num_of_fp / float(max(num_of_slide, 1))
+    sensitivity = num_of_hit / float(max(num_of_lesion, 1))
+
+    # highest sensitivity while the avg FP stays under each rate, 0 when
+    # no slide has a candidate
+    index = np.searchsorted(avg_fp, fp_rates, 'right') - 1
+    sensitivity_at_rates = np.zeros(len(fp_rates))
+    if len(thresholds) > 0:
+        sensitivity_at_rates[index >= 0] = sensitivity[index[index >= 0]]
+    return (thresholds, avg_fp, sensitivity,
+            float(np.mean(sensitivity_at_rates)),
+            dict(zip(fp_rates, sensitivity_at_rates.tolist())))
+
+
+def _evaluate_slide(args):
+    return evaluate_slide(*args)
+
+
+def evaluate(list_of_slide, threshold=hp.threshold_for_eval, nms_size=0,
+             num_workers=4):
+    args = [(slide_fn, threshold, nms_size) for slide_fn in list_of_slide]
+    if num_workers > 1 and len(args) > 1:
+        pool = Pool(min(num_workers, len(args)))
+        list_of_result = pool.map(_evaluate_slide, args)
+        pool.close()
+        pool.join()
+    else:
+        list_of_result = [_evaluate_slide(a) for a in args]
+
+    _, _, _, froc, sensitivity_at_rates = compute_froc(list_of_result)
+    auc = compute_auc([r['score'] for r in list_of_result],
+                      [r['is_tumor'] for r in list_of_result])
+    return {'FROC': froc,
+            'sensitivity': {str(k): v for k, v in sensitivity_at_rates.items()},
+            'AUC': auc,
+            'slides': {r['slide']: {'score': r['score'],
+                                    'is_tumor': r['is_tumor'],
+                                    'lesions': r['num_of_lesion'],
+                                    'candidates': len(r['candidate_score']),
+                                    'hits': int(np.sum(r['candidate_lesion'] > 0))}
+                       for r in list_of_result}}
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='FROC and slide AUC')
+    parser.add_argument('--slides', nargs='+',
+                        default=cf.list_of_slide_for_val)
+    parser.add_argument('--threshold', type=float, default=hp.threshold_for_eval,
+                        help='lowest probability of a lesion candidate')
+    parser.add_argument('--nms', type=int, default=0,
+                        help='max filter size in grid cells, '
+                             '0 for one candidate per connected component')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--output', default=None,
+                        help='save the result as json')
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+    start_time = time.time()
+
+    result = evaluate(args.slides, args.threshold, args.nms, args.workers)
+
+    for slide_fn, r in sorted(result['slides'].items()):
+        print("%-8s score %.4f tumor %d lesions %3d candidates %4d hits %3d"
+              % (slide_fn, r['score'], r['is_tumor'], r['lesions'],
+                 r['candidates'], r['hits']))
+    for rate, sensitivity in result['sensitivity'].items():
+        print("FP/slide %5s : sensitivity %.4f" % (rate, sensitivity))
+    print("FROC : %.4f, slide AUC : %.4f" % (result['FROC'], result['AUC']))
+
+    if args.output is not None:
+        with open(args.output, 'w') as fo:
+            json.dump(result, fo, indent=2, sort_keys=True)
+
+    print("Run time is :  ", time.time() - start_time)
@@ -0,0 +1,300 @@
+""" Hard example mining from stored per-patch predictions
+
+usage :
+    python hard_example_mining.py --round 1 --predict
+    python train.py  # the new shards are picked up with the other pickles
+
+A previous eval/val pass writes 'x, y, predicted, prob' rows to
+cf.path_for_result/$SLIDE_NAME/$SLIDE_NAME_result.csv (eval.py does, and
+--predict runs the checkpoint over the tissue grid of each slide). For every
+slide the predicted patches are labelled against the tumor mask, ranked by
+their BCE loss, and only the top-k false positives and false negatives are
+read from the slide and saved as $SLIDE_NAME_hard_$ROUND.pkl next to the
+slide's training pickle, so a round costs time proportional to the errors.
+They are also in the patch index with source 'hard_fp' / 'hard_fn', ex)
+cf.query_of_train_patch = "source IN ('hard_fp', 'hard_fn')" trains on them.
+"""
+from __future__ import print_function
+
+import os
+import csv
+import time
+import pickle
+import argparse
+from multiprocessing import Pool
+
+import numpy as np
+
+# user define variable
+from user_define import Config as cf
+from user_define import Hyperparams as hp
+
+from create_dataset import CAMELYON_PREPRO
+from profiler import profiler
+from slide_catalog import slide_catalog
+from patch_index import PATCH_INDEX
+
+
+def get_path_of_prediction(slide_filename):
+    return os.path.join(cf.path_for_result,
+                        slide_filename,
+                        slide_filename + "_result.csv")
+
+
+"""
+param : csv_path (rows of x, y, predicted[, prob])
+
+return : predictions (numpy array, N x 3 of x, y, prob)
+"""
+def read_predictions(csv_path):
+    predictions = []
+    with open(csv_path, 'r', encoding='utf-8') as fo:
+        for line in csv.reader(fo):
+            if not line:
+                continue
+            # old csv files only have the thresholded output
+            prob = line[3] if len(line) > 3 else line[2]
+            predictions.append((float(line[0]), float(line[1]), float(prob)))
+    return np.array(predictions, dtype=np.float64).reshape(-1, 3)
+
+
+class HARD_EXAMPLE_MINER(CAMELYON_PREPRO):
+    """
+    Extract the top-k false positives and false negatives of a slide
+
+    Args:
+        usage (string) 'train' or 'val'
+        slide_filename (string) ex) 'b_1'
+        round_of_mining (int) the shard is saved as $SLIDE_hard_$ROUND.pkl
+        num_of_hard_example (int) k, for each of FP and FN
+    """
+
+    def __init__(self, usage, slide_filename, round_of_mining,
+                 num_of_hard_example=cf.number_of_hard_example_per_slide):
+        print("miner", slide_filename)
+        start_time = time.time()
+
+        self.load_slide(slide_filename)
+        self.labeller = self.create_labeller()
+
+        predictions = read_predictions(get_path_of_prediction(slide_filename))
+        predictions = self.remove_mined_pos(usage, slide_filename, predictions)
+
+        with profiler.timer('rank_errors'):
+            self.set_of_inform = self.get_inform_of_hard_examples(
+                predictions, num_of_hard_example)
+
+        self.number_of_fp = int(np.sum(self.set_of_inform[:, 0] == 0))
+        self.number_of_fn = int(np.sum(self.set_of_inform[:, 0] == 1))
+        # false positives first (get_inform_of_hard_examples)
+        self.list_of_source = ('hard_fp', 'hard_fn')
+        self.group_of_inform = list(self.set_of_inform[:, 0])
+        print("%s : %d predictions, %d FP, %d FN"
+              % (slide_filename, len(predictions),
+                 self.number_of_fp, self.number_of_fn))
+
+        if len(self.set_of_inform) == 0:
+            return
+
+        self.num_of_patch = len(self.set_of_inform)
+        self.set_of_patch = np.array(self.get_patch_data(cf.save_patch_images))
+        self.create_dataset(usage, slide_filename,
+                            "%s_hard_%d" % (slide_filename, round_of_mining))
+
+        print("%s : mining is end, Running time is : %.2f"
+              % (slide_filename, time.time() - start_time))
+
+    """
+    param : predictions (N x 3 of x, y, prob)
+
+    return : predictions not extracted in a previous round
+    """
+    def remove_mined_pos(self, usage, slide_filename, predictions):
+        if cf.use_patch_index:
+            # positions from the index, no pickle is loaded
+            rows = PATCH_INDEX().select(
+                "slide = ? AND source IN ('hard_fp', 'hard_fn')",
+                (slide_filename,), usage=usage)
+            set_of_mined = set(zip(rows['x'].tolist(), rows['y'].tolist()))
+            return self.remove_pos(predictions, set_of_mined)
+
+        if usage == 'train':
+            path_of_dataset = cf.path_of_train_dataset
+        else:
+            path_of_dataset = cf.path_of_val_dataset
+        if not os.path.isdir(path_of_dataset):
+            return predictions
+
+        prefix = slide_filename + "_hard_"
+        set_of_mined = set()
+        for fn in os.listdir(path_of_dataset):
+            if fn.startswith(prefix) and fn.endswith(".pkl"):
+                with open(os.path.join(path_of_dataset, fn), 'rb') as fo:
+                    informs = pickle.load(fo)[cf.key_of_informs]
+                set_of_mined.update((int(x), int(y)) for _, x, y, _, _ in informs)
+
+        return self.remove_pos(predictions, set_of_mined)
+
+    def remove_pos(self, predictions, set_of_mined):
+        if not set_of_mined:
+            return predictions
+        keep = [(int(x), int(y)) not in set_of_mined
+                for x, y, _ in predictions]
+        return predictions[np.array(keep, dtype=bool)]
+
+    """
+    param : set_of_pos (N x 2, level 0)
+
+    return : ratio of tumor pixels in each patch (N,)
+             (same window as determine_tumor)
+    """
+    def get_tumor_rate_of_patches(self, set_of_pos):
+        return self.labeller.get_tumor_rates(set_of_pos, self.patch_size)
+
+    """
+    param : predictions (N x 3 of x, y, prob)
+            num_of_hard_example (int)
+
+    return : set_of_inform (numpy array of [is_tumor, x, y, w, h])
+    """
+    def get_inform_of_hard_examples(self, predictions, num_of_hard_example):
+        if len(predictions) == 0:
+            return np.zeros((0, 5), dtype=np.int64)
+
+        set_of_pos = predictions[:, :2]
+        prob = np.clip(predictions[:, 2], 1e-7, 1 - 1e-7)
+
+        tumor_rate = self.get_tumor_rate_of_patches(set_of_pos)
+        is_tumor = (tumor_rate > self.threshold_of_tumor_rate).astype(np.int64)
+
+        loss = -(is_tumor * np.log(prob) + (1 - is_tumor) * np.log(1 - prob))
+        is_positive = prob >= hp.threshold_for_eval
+
+        set_of_index = []
+        for is_error in (is_positive & (is_tumor == 0),
+                         ~is_positive & (is_tumor == 1)):
+            index = np.flatnonzero(is_error)
+            index = index[np.argsort(-loss[index], kind='stable')]
+            set_of_index.append(index[:num_of_hard_example])
+        set_of_index = np.concatenate(set_of_index)
+
+        w, h = self.patch_size
+        set_of_inform = np.zeros((len(set_of_index), 5), dtype=np.int64)
+        set_of_inform[:, 0] = is_tumor[set_of_index]
+        set_of_inform[:, 1:3] = set_of_pos[set_of_index]
+        set_of_inform[:, 3] = w
+        set_of_inform[:, 4] = h
+        return set_of_inform
+
+
+"""
+run a checkpoint over the tissue grid of a slide and save the predictions
+in the same csv format as eval.py
+"""
+def predict_slide(net, slide_filename, use_cuda=False):
+    import torch
+    from load_dataset import REGION_BATCHED_DATASET
+    from prepro_for_test2 import get_pos_of_patch_of_slide
+    from stain_norm import get_normalizer
+
+    target_path = slide_catalog.get_path(slide_filename)
+    set_of_real_pos = get_pos_of_patch_of_slide(slide_filename)
+
+    dataset = REGION_BATCHED_DATASET(target_path, set_of_real_pos)
+    stain = get_normalizer(dataset)
+    loader = torch.utils.data.DataLoader(dataset,
+                                         batch_size=None,
+                                         shuffle=False,
+                                         num_workers=4)
+
+    csv_path = get_path_of_prediction(slide_filename)
+    if not os.path.isdir(os.path.dirname(csv_path)):
+        os.makedirs(os.path.dirname(csv_path))
+
+    net.eval()
+    with open(csv_path, 'w', encoding='utf-8', newline='') as fo:
+        fw = csv.writer(fo)
+        with torch.no_grad():
+            for inputs, label in loader:
+                if use_cuda:
+                    inputs = inputs.cuda()
+                if stain is not None:
+                    inputs = stain(inputs)
+                prob = net(inputs).view(-1).cpu().numpy()
+                predicted = (prob >= hp.threshold_for_eval).astype(np.float64)
+                for (x, y), output, p in zip(label.numpy(), predicted, prob):
+                    fw.writerow([x, y, output, p])
+    print("prediction is saved at", csv_path)
+
+
+def _mine_slide(usage, slide_fn, round_of_mining, num_of_hard_example):
+    miner = HARD_EXAMPLE_MINER(usage, slide_fn, round_of_mining,
+                               num_of_hard_example)
+    return slide_fn, miner.number_of_fp, miner.number_of_fn
+
+
+def mine_hard_examples(usage, list_of_slide, round_of_mining,
+                       num_of_hard_example):
+    pool = Pool(3)
+    args = [(usage, slide_fn, round_of_mining, num_of_hard_example)
+            for slide_fn in list_of_slide]
+    result = pool.starmap_async(_mine_slide, args)
+    result.wait()
+    pool.close()
+
+    for slide_fn, number_of_fp, number_of_fn in result.get():
+        print("%s round %d : %d FP, %d FN are added"
+              % (slide_fn, round_of_mining, number_of_fp, number_of_fn))
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Hard example mining')
+    parser.add_argument('--round', type=int, required=True,
+                        help='index of the mining round, names the shards')
+    parser.add_argument('--usage', choices=['train', 'val', 'both'],
+                        default='train')
+    parser.add_argument('--top-k', type=int,
+                        default=cf.number_of_hard_example_per_slide,
+                        help='false positives and false negatives per slide')
+    parser.add_argument('--predict', action='store_true',
+                        help='predict the slides with the checkpoint first')
+    parser.add_argument('--checkpoint', default='./checkpoint/ckpt.pth.tar')
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+    start_time = time.time()
+
+    list_of_job = []
+    if args.usage in ('train', 'both'):
+        list_of_job.append(('train', cf.list_of_slide_for_train))
+    if args.usage in ('val', 'both'):
+        list_of_job.append(('val', cf.list_of_slide_for_val))
+
+    if args.predict:
+        import torch
+        use_cuda = torch.cuda.is_available()
+        from export import load_checkpoint
+        from models import optimize_for_inference
+
+        # the same model as eval.py, so the errors are the ones it scores
+        net = load_checkpoint(args.checkpoint)['net']
+        if isinstance(net, torch.nn.DataParallel):
+            net = net.module
+        net = optimize_for_inference(net)
+        if hp.number_of_tta_view > 1:
+            from tta import TTA_WRAPPER
+            net = TTA_WRAPPER(net, hp.number_of_tta_view)
+        if use_cuda:
+            net.cuda()
+        for usage, list_of_slide in list_of_job:
+            for slide_fn in list_of_slide:
+                predict_slide(net, slide_fn, use_cuda)
+
+    for usage, list_of_slide in list_of_job:
+        mine_hard_examples(usage, list_of_slide, args.round, args.top_k)
+
+    end_time = time.time()
+    print("Run time is :  ", end_time - start_time)
+    print("Done")
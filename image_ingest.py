@@ -0,0 +1,129 @@
+""" Bulk decode of an image folder (task_1 patches) into one uint8 array
+
+usage :
+    set_of_patch, list_of_filename, report = ingest_folder(
+        cf.path_of_task_1, os.path.join(cf.path_of_test_dataset, 'test'))
+    set_of_patch, list_of_filename = load_ingested(
+        os.path.join(cf.path_of_test_dataset, 'test'))
+
+    python image_ingest.py --folder ./Data/task/task_1 --threads 1 4 8
+
+The files are decoded by a thread pool (cv2.imread and cvtColor release
+the GIL) straight into their row of a preallocated N x H x W x 3 array,
+an .npy memmap when a path is given, so there is no list of images, no
+np.array copy and no pickle. The file names, in row order, are saved
+next to it as json.
+"""
+from __future__ import print_function
+
+import os
+import json
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import cv2
+
+# user define variable
+from user_define import Config as cf
+
+
+LIST_OF_EXTENSION = ('.png', '.jpg', '.jpeg', '.tif', '.tiff', '.bmp')
+
+
+def get_list_of_image(path_of_folder):
+    return sorted(fn for fn in os.listdir(path_of_folder)
+                  if fn.lower().endswith(LIST_OF_EXTENSION))
+
+
+def _decode_into(path, out):
+    img = cv2.imread(path, cv2.IMREAD_COLOR)
+    if img is None:
+        raise RuntimeError("can not decode " + path)
+    if img.shape != out.shape:
+        raise RuntimeError("%s is %s, the others are %s"
+                           % (path, img.shape, out.shape))
+    cv2.cvtColor(img, cv2.COLOR_BGR2RGB, dst=out)
+
+
+"""
+param : path_of_folder (folder of images of the same size)
+        path_of_output (string) prefix of the .npy / .json, None keeps the
+            array in memory
+        num_of_thread (int)
+
+return : set_of_patch (uint8, N x H x W x 3), list_of_filename,
+         report (dict, images_per_sec)
+"""
+def ingest_folder(path_of_folder, path_of_output=None,
+                  num_of_thread=cf.number_of_ingest_thread):
+    start_time = time.time()
+    list_of_filename = get_list_of_image(path_of_folder)
+    list_of_path = [os.path.join(path_of_folder, fn)
+                    for fn in list_of_filename]
+    if not list_of_path:
+        raise RuntimeError("no image in " + path_of_folder)
+
+    first = cv2.imread(list_of_path[0], cv2.IMREAD_COLOR)
+    if first is None:
+        raise RuntimeError("can not decode " + list_of_path[0])
+    shape = (len(list_of_path),) + first.shape
+
+    if path_of_output is None:
+        set_of_patch = np.empty(shape, dtype=np.uint8)
+    else:
+        set_of_patch = np.lib.format.open_memmap(path_of_output + '.npy',
+                                                 mode='w+', dtype=np.uint8,
+                                                 shape=shape)
+
+    with ThreadPoolExecutor(max_workers=max(1, num_of_thread)) as executor:
+        # list() re-raises the error of a worker
+        list(executor.map(_decode_into, list_of_path, set_of_patch))
+
+    if path_of_output is not None:
+        set_of_patch.flush()
+        with open(path_of_output + '.json', 'w') as fo:
+            json.dump(list_of_filename, fo)
+
+    seconds = time.time() - start_time
+    report = {'images': len(list_of_path), 'seconds': seconds,
+              'images_per_sec': len(list_of_path) / max(seconds, 1e-9),
+              'threads': num_of_thread}
+    print("%d images of %s : %.1f images/sec (%d threads)"
+          % (len(list_of_path), path_of_folder, report['images_per_sec'],
+             num_of_thread))
+    return set_of_patch, list_of_filename, report
+
+
+"""
+return : set_of_patch (read-only memmap), list_of_filename
+"""
+def load_ingested(path_of_output):
+    set_of_patch = np.load(path_of_output + '.npy', mmap_mode='r')
+    with open(path_of_output + '.json') as fo:
+        list_of_filename = json.load(fo)
+    return set_of_patch, list_of_filename
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Image folder ingest')
+    parser.add_argument('--folder', default=cf.path_of_task_1)
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 4, 8])
+    args = parser.parse_args()
+
+    # the serial loop of the former 'test' branch of create_dataset.py
+    start_time = time.time()
+    set_of_patch = []
+    for fn in get_list_of_image(args.folder):
+        img = cv2.imread(os.path.join(args.folder, fn), cv2.IMREAD_COLOR)
+        set_of_patch.append(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
+    set_of_patch = np.array(set_of_patch)
+    seconds = time.time() - start_time
+    print("serial list + np.array : %.1f images/sec"
+          % (len(set_of_patch) / seconds))
+
+    for num_of_thread in args.threads:
+        ingested, _, _ = ingest_folder(args.folder, None, num_of_thread)
+        if not np.array_equal(ingested, set_of_patch):
+            raise RuntimeError("ingested images differ from the serial read")
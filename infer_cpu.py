@@ -0,0 +1,236 @@
+""" CPU inference with an exported patch classifier (see export.py)
+
+usage :
+    python infer_cpu.py --model ./checkpoint/export/patch_classifier.pt
+    python infer_cpu.py --model patch_classifier.onnx --threads 8 --slides t_1
+    python infer_cpu.py --model patch_classifier.pt --benchmark
+
+Patches are read region by region (region_reader.py) by a few reader
+threads (openslide releases the GIL) while the exported graph runs with its
+own intra-op threads, and the result is written in the same csv format as eval.py
+(cf.path_for_result/$SLIDE_NAME/$SLIDE_NAME_result.csv), so
+create_heatmap_from_csv.py and froc.py work on it unchanged.
+"""
+from __future__ import print_function
+
+import os
+import csv
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+import openslide
+
+# user define variable
+from user_define import Config as cf
+from user_define import Hyperparams as hp
+
+from region_reader import REGION_READER
+from slide_catalog import slide_catalog
+from stain_norm import STAIN_NORMALIZER, get_slide_name, normalize_patches
+from stain_norm import get_params_of_slide, get_path_of_params
+from tissue_grid import get_pos_of_patch_in_tissue, get_pos_of_patch_of_slide
+from tissue_grid import create_tissue_mask
+
+
+"""
+param : num_threads (int) intra-op threads, 0 to keep the default
+        num_interop_threads (int) only once, before any parallel work
+"""
+def configure_threads(num_threads, num_interop_threads=1):
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+    try:
+        torch.set_num_interop_threads(num_interop_threads)
+    except RuntimeError:
+        # already started
+        pass
+
+
+class RUNTIME(object):
+    """
+    Run an exported graph, TorchScript (.pt) or ONNX (.onnx, needs
+    onnxruntime)
+
+    Args:
+        model_path (string)
+        num_threads (int) intra-op threads, 0 for the default
+    """
+
+    def __init__(self, model_path, num_threads=0):
+        self.model_path = model_path
+        if model_path.endswith('.onnx'):
+            import onnxruntime
+            options = onnxruntime.SessionOptions()
+            if num_threads > 0:
+                options.intra_op_num_threads = num_threads
+            options.inter_op_num_threads = 1
+            self.session = onnxruntime.InferenceSession(
+                model_path, options, providers=['CPUExecutionProvider'])
+            self.module = None
+        else:
+            configure_threads(num_threads)
+            self.session = None
+            self.module = torch.jit.load(model_path, map_location='cpu')
+            self.module.eval()
+
+    """
+    param : patch (uint8 numpy array, N x H x W x 3)
+
+    return : prob, predicted (float32 numpy array, N)
+    """
+    def __call__(self, patch):
+        if self.session is not None:
+            prob, predicted = self.session.run(None, {'patch': patch})
+            return prob, predicted
+        with torch.no_grad():
+            prob, predicted = self.module(torch.from_numpy(patch))
+        return prob.numpy(), predicted.numpy()
+
+
+"""
+positions of the patches to predict, same grid as eval.py
+"""
+def get_pos_of_slide(slide):
+    return get_pos_of_patch_in_tissue(slide)
+
+
+"""
+the patches are stain normalized like eval.py when
+hp.use_stain_normalization is on (the params of the slide are estimated once
+if not cached), the exported graph takes them as read
+"""
+def predict_slide(runtime, slide_path, csv_path, set_of_pos=None,
+                  batch_size=hp.batch_size_for_eval, num_readers=2):
+    slide = openslide.OpenSlide(slide_path)
+    if set_of_pos is None:
+        set_of_pos = get_pos_of_slide(slide)
+
+    stain = None
+    if hp.use_stain_normalization:
+        slide_name = get_slide_name(slide_path)
+        if not os.path.isfile(get_path_of_params(slide_name)):
+            tissue_mask, img = create_tissue_mask(slide, return_image=True)
+            get_params_of_slide(slide_name, img, tissue_mask)
+        stain = STAIN_NORMALIZER([slide_name])
+
+    # one read_region per region of patches (see region_reader.py)
+    reader = REGION_READER(slide, set_of_pos)
+    set_of_batch = reader.split(batch_size)
+
+    if not os.path.isdir(os.path.dirname(csv_path)):
+        os.makedirs(os.path.dirname(csv_path))
+
+    start_time = time.time()
+    with open(csv_path, 'w', encoding='utf-8', newline='') as fo, \
+            ThreadPoolExecutor(num_readers) as executor:
+        fw = csv.writer(fo)
+        # map keeps the order and reads ahead while the graph runs
+        for patch, pos in executor.map(reader.read, set_of_batch):
+            if stain is not None:
+                patch = normalize_patches(stain, patch)
+            prob, predicted = runtime(patch)
+            for (x, y), output, p in zip(pos, predicted, prob):
+                fw.writerow([x, y, float(output), float(p)])
+
+    run_time = time.time() - start_time
+    print("%s : %d patches, %.1f patches/sec"
+          % (os.path.basename(slide_path), len(set_of_pos),
+             len(set_of_pos) / max(run_time, 1e-12)))
+
+
+def _get_patches_per_sec(run, patch, number_of_batch):
+    run(patch)  # warm up
+    start = time.perf_counter()
+    for _ in range(number_of_batch):
+        run(patch)
+    return len(patch) * number_of_batch / (time.perf_counter() - start)
+
+
+"""
+patches/sec of the eager path of eval.py (pickled module, ToTensor,
+threshold on the output) against the exported graph, for each thread count
+"""
+def benchmark(model_path, checkpoint_path, arch, batch_size, number_of_batch,
+              list_of_threads):
+    from export import load_net
+
+    w, h = hp.patch_size
+    rng = np.random.RandomState(0)
+    patch = rng.randint(0, 256, (batch_size, h, w, 3)).astype(np.uint8)
+
+    net = load_net(checkpoint_path, arch)
+
+    def eager(patch):
+        with torch.no_grad():
+            inputs = torch.from_numpy(patch).permute(0, 3, 1, 2).float() / 255.
+            outputs = torch.squeeze(net(inputs), 1)
+            predicted = torch.floor(outputs + (1 - hp.threshold_for_eval))
+        return outputs.numpy(), predicted.numpy()
+
+    print("%8s %14s %14s %8s" % ('threads', 'eager (p/s)', 'exported (p/s)',
+                                 'speedup'))
+    result = []
+    for num_threads in list_of_threads:
+        torch.set_num_threads(num_threads)
+        runtime = RUNTIME(model_path, num_threads)
+        eager_rate = _get_patches_per_sec(eager, patch, number_of_batch)
+        exported_rate = _get_patches_per_sec(runtime, patch, number_of_batch)
+        print("%8d %14.1f %14.1f %8.2f" % (num_threads, eager_rate,
+                                           exported_rate,
+                                           exported_rate / eager_rate))
+        result.append((num_threads, eager_rate, exported_rate))
+
+    diff = np.abs(eager(patch)[0] - runtime(patch)[0]).max()
+    print("max diff of prob : %.2e" % diff)
+    return result
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='CPU inference')
+    parser.add_argument('--model', default=os.path.join(cf.path_of_export,
+                                                        'patch_classifier.pt'),
+                        help='.pt (TorchScript) or .onnx of export.py')
+    parser.add_argument('--slides', nargs='+',
+                        default=cf.list_of_slide_for_task2)
+    parser.add_argument('--threads', type=int, default=0,
+                        help='intra-op threads, 0 for all cores')
+    parser.add_argument('--readers', type=int, default=2,
+                        help='threads reading patches from the slide')
+    parser.add_argument('--batch-size', type=int, default=hp.batch_size_for_eval)
+    parser.add_argument('--benchmark', action='store_true',
+                        help='compare patches/sec with the eager path')
+    parser.add_argument('--checkpoint', default=cf.path_of_checkpoint,
+                        help='eager model for --benchmark')
+    parser.add_argument('--arch', default=None,
+                        help='for --benchmark without a pickled module')
+    parser.add_argument('--batches', type=int, default=5)
+    parser.add_argument('--bench-threads', type=int, nargs='+',
+                        default=[1, 2, 4, torch.get_num_threads()])
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+    start_time = time.time()
+
+    if args.benchmark:
+        checkpoint_path = args.checkpoint
+        if args.arch is not None and not os.path.isfile(checkpoint_path):
+            checkpoint_path = None
+        benchmark(args.model, checkpoint_path, args.arch, args.batch_size,
+                  args.batches, sorted(set(args.bench_threads)))
+    else:
+        runtime = RUNTIME(args.model, args.threads)
+        for slide_fn in args.slides:
+            slide_path = slide_catalog.get_path(slide_fn)
+            csv_path = os.path.join(cf.path_for_result, slide_fn,
+                                    slide_fn + "_result.csv")
+            predict_slide(runtime, slide_path, csv_path,
+                          get_pos_of_patch_of_slide(slide_fn),
+                          batch_size=args.batch_size,
+                          num_readers=args.readers)
+
+    print("Run time is :  ", time.time() - start_time)
@@ -5,27 +5,41 @@ import os.path
 import errno
 import numpy as np
 import sys
-import pickle
+import time
+import hashlib
 import openslide
 
+import torch
 import torch.utils.data as data
+from torch.utils.data.dataloader import default_collate
 
 # user define variable
 from user_define import Config as cf
 from user_define import Hyperparams as hp
 
-from remove_background import *
+from prepro_for_test2 import get_pos_of_patch_of_slide
+
+from profiler import profiler
+from stain_norm import get_slide_name
+from slide_catalog import slide_catalog
+from patch_index import PATCH_INDEX, load_dataset_pickle
+from region_reader import REGION_READER
 
 
 class CUSTOM_DATASET(data.Dataset):
 
-    def __init__(self, usage, slide_fn, pos, transform=None):
+    def __init__(self, usage, slide_fn, pos, transform=None,
+                 return_index=False, query=None):
 
         #self.img = patch
         self.usage = usage
-        self.slide = openslide.OpenSlide(slide_fn)
+        # only the test patches are read from the slide
+        self.slide = openslide.OpenSlide(slide_fn) if usage == 'test' else None
         self.pos = pos
         self.transform = transform
+        # (img, target, index), so per-sample losses can be fed back
+        # to LOSS_WEIGHTED_SAMPLER
+        self.return_index = return_index
 
         if usage == 'train':
             self.path_of_dataset = cf.path_of_train_dataset
@@ -41,28 +55,45 @@ class CUSTOM_DATASET(data.Dataset):
         self.data = []
         self.labels = []
 
-        if usage is 'train' or usage is 'val':
+        # slide of every sample, for the per-slide stain params
+        self.list_of_slide = [get_slide_name(slide_fn)] if slide_fn else []
+        self.slide_index = np.zeros(len(pos) if pos is not None else 0,
+                                    dtype=np.int64)
+
+        if (usage == 'train' or usage == 'val') and query is not None:
+            self._load_from_patch_index(query)
+
+        elif usage is 'train' or usage is 'val':
             print("train and val")
+            self.list_of_slide = []
+            slide_index = []
             for filename in self.dataset_list:
                 fliepath = os.path.join(self.path_of_dataset, filename)
-                fo = open(fliepath, 'rb')
-                dataset = pickle.load(fo)
+                dataset = load_dataset_pickle(fliepath)
 
                 self.data.append(dataset[cf.key_of_data])
                 self.labels.append(dataset[cf.key_of_informs])
 
-                fo.close()
+                slide_name = get_slide_name(filename)
+                if slide_name not in self.list_of_slide:
+                    self.list_of_slide.append(slide_name)
+                slide_index.append(
+                    np.full(len(self.data[-1]),
+                            self.list_of_slide.index(slide_name),
+                            dtype=np.int64))
 
             self.data = np.concatenate(self.data)
             print("data shape is ", self.data.shape)
             self.labels = np.concatenate(self.labels)
             print("label shape is ", self.labels.shape)
+            self.slide_index = np.concatenate(slide_index)
 
 
     def __getitem__(self, index):
         if self.usage is "test":
             target = self.pos[index]
-            img = self.slide.read_region(target, 0, hp.patch_size).convert('RGB')
+            with profiler.timer('read_region'):
+                img = self.slide.read_region(target, 0, hp.patch_size).convert('RGB')
 
         elif self.usage is "train" or self.usage is "val" :
             img, target = self.data[index], self.labels[index][0]
@@ -70,8 +101,11 @@ class CUSTOM_DATASET(data.Dataset):
         img = Image.fromarray(np.array(img))
 
         if self.transform is not None:
-            img = self.transform(img)
+            with profiler.timer('transform'):
+                img = self.transform(img)
 
+        if self.return_index:
+            return img, target, index
         return img, target
 
     def __len__(self):
@@ -85,57 +119,299 @@ class CUSTOM_DATASET(data.Dataset):
         file_list.sort()
         return file_list
 
+    """
+    param : query (SQL condition on the patch index, see patch_index.py)
+
+    only the rows of the selected patches are read from the npy shards
+    """
+    def _load_from_patch_index(self, query):
+        index = PATCH_INDEX()
+        rows = index.select(query, usage=self.usage)
+        self.data = index.read_patches(rows)
+        self.labels = index.get_inform(rows)
+        print("%s query %r : %d patches" % (self.usage, query, len(self.data)))
+
+        self.list_of_slide = sorted(set(rows['slide'].tolist()))
+        self.slide_index = np.array([self.list_of_slide.index(slide)
+                                     for slide in rows['slide']],
+                                    dtype=np.int64)
+
+
+class REGION_BATCHED_DATASET(data.Dataset):
+    """
+    Test patches of a slide, one item is a whole batch read region by
+    region (see region_reader.py), for DataLoader(batch_size=None)
+
+    Args:
+        slide_fn (string) path of the slide
+        pos (N x 2, level 0)
+        batch_size (int) max patches of an item
+        patches_per_side (int) patches per side of a region
+
+    return of __getitem__ : inputs (float, n x 3 x H x W, same as
+        transforms.ToTensor()), pos (n x 2)
+    """
+
+    def __init__(self, slide_fn, pos, batch_size=hp.batch_size_for_eval,
+                 patches_per_side=hp.patches_per_side_of_region):
+        self.reader = REGION_READER(slide_fn, pos,
+                                    patches_per_side=patches_per_side)
+        self.set_of_batch = self.reader.split(batch_size)
+
+        # one slide, for the stain params (see CUSTOM_DATASET)
+        self.list_of_slide = [get_slide_name(slide_fn)]
+        self.slide_index = None
 
-def make_patch_imform():
-    slide_fn = 't_4'
-    target_path = os.path.join(cf.path_of_task_2, slide_fn + ".tif")
-    slide = openslide.OpenSlide(target_path)
-
-    level = cf.level_for_preprocessing
-    downsamples = int(slide.level_downsamples[level])
-
-    tissue_mask = create_tissue_mask(slide)
-    x_min, y_min, x_max, y_max = get_interest_region(tissue_mask)
-
-    stride = cf.stride_for_heatmap
-    stride_rescale = int(stride / downsamples)
+    def __getitem__(self, index):
+        with profiler.timer('read_region'):
+            patches, pos = self.reader.read(self.set_of_batch[index])
+        with profiler.timer('transform'):
+            # NCHW before the float copy, like ToTensor
+            inputs = torch.from_numpy(patches).permute(0, 3, 1, 2)
+            inputs = inputs.contiguous().float().div_(255.)
+        return inputs, torch.from_numpy(pos)
 
-    set_of_pos = [(x, y) for x in range(x_min, x_max, stride_rescale)
-                  for y in range(y_min, y_max, stride_rescale)]
-    set_of_real_pos = get_pos_of_patch_for_eval(
-        target_path, tissue_mask, set_of_pos)
+    def __len__(self):
+        return len(self.set_of_batch)
+
+
+class LOSS_WEIGHTED_SAMPLER(data.Sampler):
+    """
+    Draw each epoch from the dataset in proportion to the running loss
+    of every sample, so easy background patches are visited less often
+    than hard ones (tumor boundary etc.)
+
+    Args:
+        data_source (Dataset) dataset to sample from
+        ratio_of_sample (float) samples drawn per epoch / len(data_source),
+            without replacement under 1, with replacement from 1 (a draw
+            of N of N without replacement would not depend on the loss)
+        floor (float) part of the probability spread uniformly, so every
+            sample keeps at least floor / N and is revisited
+        momentum (float) weight of the old loss in the running average
+        initial_loss (float) loss of samples not seen yet (ln 2 is the BCE
+            of an uninformed output, so new samples are drawn early)
+
+    usage :
+        sampler = LOSS_WEIGHTED_SAMPLER(trainset)
+        loader = DataLoader(trainset, batch_size, sampler=sampler)
+        for inputs, targets, index in loader:
+            ...
+            sampler.update(index, loss_of_each_sample)
+    """
+
+    def __init__(self, data_source, ratio_of_sample=hp.ratio_of_sampled_patch,
+                 floor=hp.floor_of_sampling_prob,
+                 momentum=hp.momentum_of_sample_loss,
+                 initial_loss=np.log(2)):
+        self.num_of_data = len(data_source)
+        self.num_samples = max(1, int(round(self.num_of_data * ratio_of_sample)))
+        self.floor = floor
+        self.momentum = momentum
+
+        self.loss = np.full(self.num_of_data, initial_loss, dtype=np.float64)
+        self.is_seen = np.zeros(self.num_of_data, dtype=bool)
+        self.num_of_epoch = 0
+        self.num_of_drawn = 0
+
+    """
+    return : probability of each sample (float64, sums to 1)
+    """
+    def get_prob(self):
+        loss = np.maximum(self.loss, 0)
+        total = loss.sum()
+        if total <= 0:
+            return np.full(self.num_of_data, 1. / self.num_of_data)
+        return ((1 - self.floor) * loss / total +
+                self.floor / self.num_of_data)
+
+    def __iter__(self):
+        prob = self.get_prob()
+        if self.num_samples < self.num_of_data:
+            # weighted sampling without replacement in O(N)
+            # (Efraimidis & Spirakis : keep the k largest u ** (1 / p))
+            key = np.log(np.random.uniform(size=self.num_of_data)) / prob
+            index = np.argpartition(-key, self.num_samples - 1)
+            index = index[:self.num_samples]
+            np.random.shuffle(index)
+        else:
+            index = np.random.choice(self.num_of_data, self.num_samples,
+                                     p=prob)
 
-    set_of_real_pos = np.array(set_of_real_pos)
+        self.num_of_epoch += 1
+        self.num_of_drawn += len(index)
+        return iter(index.tolist())
 
-    return set_of_real_pos
+    def __len__(self):
+        return self.num_samples
+
+    """
+    param : index (tensor or array of dataset indices)
+            loss (tensor or array of per-sample loss, same order)
+    """
+    def update(self, index, loss):
+        if hasattr(index, 'cpu'):
+            index = index.cpu().numpy()
+        if hasattr(loss, 'cpu'):
+            loss = loss.cpu().numpy()
+        index = np.asarray(index, dtype=np.int64).reshape(-1)
+        loss = np.asarray(loss, dtype=np.float64).reshape(-1)
+
+        old = np.where(self.is_seen[index], self.loss[index], loss)
+        self.loss[index] = self.momentum * old + (1 - self.momentum) * loss
+        self.is_seen[index] = True
+
+    """
+    return : dict, effective_epoch is samples drawn / N, so
+             epochs_saved = epochs run - effective_epoch
+    """
+    def get_report(self):
+        effective_epoch = self.num_of_drawn / float(self.num_of_data)
+        return {'epochs': self.num_of_epoch,
+                'effective_epochs': effective_epoch,
+                'epochs_saved': self.num_of_epoch - effective_epoch,
+                'coverage': float(self.is_seen.mean()),
+                'mean_loss': float(self.loss.mean())}
+
+
+class CONCAT_PATCHES(object):
+    """
+    Patches of the pickles of a dataset folder as one N x H x W x 3 array,
+    the rows of a slice or an index array are read on access, from the
+    memmap of the npy store of each pickle
+
+    Args:
+        set_of_data (list of uint8 arrays or memmaps, n_i x H x W x 3)
+    """
+
+    def __init__(self, set_of_data):
+        self.set_of_data = set_of_data
+        self.bounds = np.cumsum([0] + [len(d) for d in set_of_data])
+        self.shape = (int(self.bounds[-1]),) + tuple(set_of_data[0].shape[1:])
+        self.dtype = np.dtype(np.uint8)
 
+    def __len__(self):
+        return self.shape[0]
 
-def get_test_dataset(transform=None):
+    def __getitem__(self, index):
+        index = np.arange(len(self))[index].reshape(-1)
+        output = np.empty((len(index),) + self.shape[1:], dtype=self.dtype)
+        which = np.searchsorted(self.bounds, index, side='right') - 1
+        for i in np.unique(which):
+            is_in = which == i
+            output[is_in] = self.set_of_data[i][index[is_in] - self.bounds[i]]
+        return output
+
+
+"""
+param : path_of_dataset (directory of the pickles of create_dataset.py)
+        return_slide (bool) also return list_of_slide and slide_index, as
+            CUSTOM_DATASET (for the stain normalizer)
+        lazy (bool) data is a CONCAT_PATCHES, so only the rows used are read
+            instead of the whole dataset
+
+return : data (uint8, N x H x W x 3), labels (N,), same order as
+         CUSTOM_DATASET
+"""
+def load_patches(path_of_dataset, return_slide=False, lazy=False):
+    set_of_data = []
+    set_of_label = []
+    list_of_slide = []
+    slide_index = []
+    for filename in sorted(os.listdir(path_of_dataset)):
+        dataset = load_dataset_pickle(os.path.join(path_of_dataset, filename))
+        patches = dataset[cf.key_of_data]
+        if not (lazy and isinstance(patches, np.ndarray)):
+            patches = np.asarray(patches, dtype=np.uint8)
+        set_of_data.append(patches)
+        set_of_label.append(np.asarray(dataset[cf.key_of_informs])[:, 0])
+
+        slide_name = get_slide_name(filename)
+        if slide_name not in list_of_slide:
+            list_of_slide.append(slide_name)
+        slide_index.append(np.full(len(set_of_data[-1]),
+                                   list_of_slide.index(slide_name),
+                                   dtype=np.int64))
+    data = CONCAT_PATCHES(set_of_data) if lazy else np.concatenate(set_of_data)
+    if return_slide:
+        return (data, np.concatenate(set_of_label),
+                list_of_slide, np.concatenate(slide_index))
+    return data, np.concatenate(set_of_label)
+
+
+"""
+return : hash of the file names, sizes and mtimes of a dataset folder, it
+         changes when create_dataset.py writes the pickles again
+"""
+def get_fingerprint_of_folder(path_of_dataset):
+    hash_of_folder = hashlib.sha1()
+    for filename in sorted(os.listdir(path_of_dataset)):
+        stat = os.stat(os.path.join(path_of_dataset, filename))
+        hash_of_folder.update(("%s %d %r\n" % (filename, stat.st_size,
+                                                stat.st_mtime)).encode())
+    return hash_of_folder.hexdigest()
+
+
+"""
+return : hash of the patches of a CUSTOM_DATASET (slide, label and level 0
+         position of every index), for caches keyed by dataset index
+"""
+def get_fingerprint_of_dataset(dataset):
+    hash_of_dataset = hashlib.sha1()
+    hash_of_dataset.update(" ".join(dataset.list_of_slide).encode())
+    hash_of_dataset.update(np.ascontiguousarray(
+        dataset.slide_index, dtype=np.int64).tobytes())
+    hash_of_dataset.update(np.ascontiguousarray(
+        dataset.labels, dtype=np.int64).tobytes())
+    return hash_of_dataset.hexdigest()
+
+
+def profiled_collate(batch):
+    with profiler.timer('collate'):
+        return default_collate(batch)
+
+
+def make_patch_imform(slide_fn='t_4'):
+    return get_pos_of_patch_of_slide(slide_fn)
+
+
+"""
+region_batched : REGION_BATCHED_DATASET (items are batches, transform is
+                 ToTensor) instead of CUSTOM_DATASET
+"""
+def get_test_dataset(transform=None, region_batched=False):
     start_time = time.time()
-    set_of_real_pos = make_patch_imform()
     slide_fn = 't_4'
-    target_path = os.path.join(cf.path_of_task_2, slide_fn + ".tif")
-    test_dataset = CUSTOM_DATASET("test", target_path, set_of_real_pos, transform)
+    set_of_real_pos = make_patch_imform(slide_fn)
+    target_path = slide_catalog.get_path(slide_fn)
+    if region_batched:
+        test_dataset = REGION_BATCHED_DATASET(target_path, set_of_real_pos)
+    else:
+        test_dataset = CUSTOM_DATASET("test", target_path, set_of_real_pos,
+                                      transform)
     end_time = time.time()
     print("creating dataset is end, Running time is :  ", end_time - start_time)
     return test_dataset
 
-def get_train_dataset(transform=None):
+"""
+query : SQL condition on the patch index choosing the patches, None loads
+        every pickle of the usage
+"""
+def get_train_dataset(transform=None, return_index=False,
+                      query=cf.query_of_train_patch):
     start_time = time.time()
-    set_of_real_pos = make_patch_imform()
-    slide_fn = 't_4'
-    target_path = os.path.join(cf.path_of_task_2, slide_fn + ".tif")
-    train_dataset = CUSTOM_DATASET("train",target_path, set_of_real_pos, transform)
+    # the patches are in the pickles, no slide and no grid
+    train_dataset = CUSTOM_DATASET("train", None, None, transform,
+                                   return_index, query)
     end_time = time.time()
     print("creating train dataset is end, Running time is :  ", end_time - start_time)
     return train_dataset
 
-def get_val_dataset(transform=None):
+def get_val_dataset(transform=None, return_index=False,
+                    query=cf.query_of_val_patch):
     start_time = time.time()
-    set_of_real_pos = make_patch_imform()
-    slide_fn = 't_4'
-    target_path = os.path.join(cf.path_of_task_2, slide_fn + ".tif")
-    val_dataset = CUSTOM_DATASET("val", target_path, set_of_real_pos, transform)
+    val_dataset = CUSTOM_DATASET("val", None, None, transform,
+                                 return_index, query)
     end_time = time.time()
     print("creating val dataset is end, Running time is :  ", end_time - start_time)
     return val_dataset
@@ -1,73 +1,266 @@
 # Code referenced from https://gist.github.com/gyglim/1f8dfb1b5c82627ae3efcfbbadb9f514
-import tensorflow as tf
+# Event files are written with a minimal record writer, so TensorFlow is not
+# needed. Summaries are serialized and flushed by a background thread.
+import os
+import io
+import time
+import queue
+import atexit
+import socket
+import struct
+import threading
+
 import numpy as np
-import scipy.misc
+from PIL import Image
+
 try:
-    from StringIO import StringIO  # Python 2.7
+    from crc32c import crc32c as _crc32c_native
 except ImportError:
-    from io import BytesIO         # Python 3.x
+    _crc32c_native = None
+
+
+"""
+crc32c (Castagnoli) used by the TFRecord framing
+"""
+def _make_crc32c_table():
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            if crc & 1:
+                crc = (crc >> 1) ^ 0x82F63B78
+            else:
+                crc >>= 1
+        table.append(crc)
+    return table
+
+
+_CRC32C_TABLE = _make_crc32c_table()
+
+
+def _crc32c(data):
+    if _crc32c_native is not None:
+        return _crc32c_native(data)
+    crc = 0xFFFFFFFF
+    table = _CRC32C_TABLE
+    for b in data:
+        crc = table[(crc ^ b) & 0xFF] ^ (crc >> 8)
+    return crc ^ 0xFFFFFFFF
+
+
+def _masked_crc32c(data):
+    crc = _crc32c(data)
+    return (((crc >> 15) | (crc << 17)) + 0xA282EAD8) & 0xFFFFFFFF
+
+
+"""
+minimal protobuf encoding for Event / Summary messages
+"""
+def _varint(value):
+    out = bytearray()
+    value &= 0xFFFFFFFFFFFFFFFF
+    while True:
+        bits = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(bits | 0x80)
+        else:
+            out.append(bits)
+            return bytes(out)
+
+
+def _key(field, wire_type):
+    return _varint((field << 3) | wire_type)
+
+
+def _field_varint(field, value):
+    return _key(field, 0) + _varint(int(value))
+
+
+def _field_double(field, value):
+    return _key(field, 1) + struct.pack('<d', float(value))
+
+
+def _field_float(field, value):
+    return _key(field, 5) + struct.pack('<f', float(value))
+
+
+def _field_bytes(field, value):
+    if isinstance(value, str):
+        value = value.encode('utf-8')
+    return _key(field, 2) + _varint(len(value)) + value
+
+
+def _field_packed_double(field, values):
+    values = np.asarray(values, dtype='<f8')
+    return _field_bytes(field, values.tobytes())
+
+
+def _encode_event(step, summary_values=None, file_version=None):
+    event = _field_double(1, time.time()) + _field_varint(2, step)
+    if file_version is not None:
+        event += _field_bytes(3, file_version)
+    if summary_values is not None:
+        summary = b''.join(_field_bytes(1, v) for v in summary_values)
+        event += _field_bytes(5, summary)
+    return event
+
+
+def _encode_scalar(tag, value):
+    return _field_bytes(1, tag) + _field_float(2, value)
+
+
+def _encode_image(tag, img):
+    s = io.BytesIO()
+    img = np.asarray(img)
+    if img.dtype != np.uint8:
+        low, high = float(img.min()), float(img.max())
+        img = (img - low) / (high - low + 1e-12) * 255.
+        img = img.astype(np.uint8)
+    Image.fromarray(img).save(s, format="png")
+
+    colorspace = 1 if img.ndim == 2 else img.shape[2]
+    image = (_field_varint(1, img.shape[0]) +
+             _field_varint(2, img.shape[1]) +
+             _field_varint(3, colorspace) +
+             _field_bytes(4, s.getvalue()))
+    return _field_bytes(1, tag) + _field_bytes(4, image)
+
+
+def _encode_histogram(tag, values, bins):
+    values = np.asarray(values, dtype=np.float64).reshape(-1)
+    counts, bin_edges = np.histogram(values, bins=bins)
+
+    histo = (_field_double(1, values.min()) +
+             _field_double(2, values.max()) +
+             _field_double(3, values.size) +
+             _field_double(4, values.sum()) +
+             _field_double(5, np.dot(values, values)) +
+             # Drop the start of the first bin
+             _field_packed_double(6, bin_edges[1:]) +
+             _field_packed_double(7, counts))
+    return _field_bytes(1, tag) + _field_bytes(5, histo)
+
+
+class _EventFileWriter(threading.Thread):
+    """
+    Drains the summary queue on a daemon thread, serializes each summary
+    and appends it to the event file in batches.
+    """
+
+    def __init__(self, log_dir, max_queue, flush_secs):
+        super(_EventFileWriter, self).__init__()
+        self.daemon = True
+
+        if not os.path.isdir(log_dir):
+            os.makedirs(log_dir)
+        filename = "events.out.tfevents.%d.%s" % (time.time(),
+                                                  socket.gethostname())
+        self.path = os.path.join(log_dir, filename)
+        self.fo = open(self.path, 'wb')
+
+        self.queue = queue.Queue()
+        self.max_queue = max_queue
+        self.flush_secs = flush_secs
+        self.pending = []
+        self.last_flush = time.time()
+
+        self._write_record(_encode_event(0, file_version="brain.Event:2"))
+        self.fo.flush()
+
+    def _write_record(self, data):
+        header = struct.pack('<Q', len(data))
+        self.fo.write(header)
+        self.fo.write(struct.pack('<I', _masked_crc32c(header)))
+        self.fo.write(data)
+        self.fo.write(struct.pack('<I', _masked_crc32c(data)))
+
+    def _flush_pending(self):
+        for data in self.pending:
+            self._write_record(data)
+        self.pending = []
+        self.fo.flush()
+        self.last_flush = time.time()
+
+    def run(self):
+        while True:
+            timeout = max(self.flush_secs - (time.time() - self.last_flush), 0)
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = 'flush'
+
+            if item is None:
+                self._flush_pending()
+                self.fo.close()
+                return
+
+            if item == 'flush':
+                self._flush_pending()
+            else:
+                kind, tag, value, step, extra = item
+                if kind == 'scalar':
+                    summary = _encode_scalar(tag, value)
+                elif kind == 'image':
+                    summary = _encode_image(tag, value)
+                else:
+                    summary = _encode_histogram(tag, value, extra)
+                self.pending.append(_encode_event(step, [summary]))
+
+                if len(self.pending) >= self.max_queue:
+                    self._flush_pending()
 
 
 class Logger(object):
 
-    def __init__(self, log_dir):
-        """Create a summary writer logging to log_dir."""
-        self.writer = tf.summary.FileWriter(log_dir)
+    def __init__(self, log_dir, histogram_frequency=1, bins=100,
+                 max_queue=64, flush_secs=10):
+        """Create a summary writer logging to log_dir.
+
+        Args:
+            histogram_frequency (int): log histograms every N steps only
+            bins (int): number of bins for histogram summaries
+            max_queue (int): number of summaries buffered before a write
+            flush_secs (float): longest time a summary waits before a write
+        """
+        self.histogram_frequency = max(int(histogram_frequency), 1)
+        self.bins = bins
+
+        self.writer = _EventFileWriter(log_dir, max_queue, flush_secs)
+        self.writer.start()
+        atexit.register(self.close)
 
     def scalar_summary(self, tag, value, step):
         """Log a scalar variable."""
-        summary = tf.Summary(
-            value=[tf.Summary.Value(tag=tag, simple_value=value)])
-        self.writer.add_summary(summary, step)
+        self.writer.queue.put(('scalar', tag, float(value), step, None))
 
     def image_summary(self, tag, images, step):
         """Log a list of images."""
-
-        img_summaries = []
         for i, img in enumerate(images):
-            # Write the image to a string
-            try:
-                s = StringIO()
-            except:
-                s = BytesIO()
-            scipy.misc.toimage(img).save(s, format="png")
-
-            # Create an Image object
-            img_sum = tf.Summary.Image(encoded_image_string=s.getvalue(),
-                                       height=img.shape[0],
-                                       width=img.shape[1])
-            # Create a Summary value
-            img_summaries.append(tf.Summary.Value(
-                tag='%s/%d' % (tag, i), image=img_sum))
-
-        # Create and write Summary
-        summary = tf.Summary(value=img_summaries)
-        self.writer.add_summary(summary, step)
-
-    def histo_summary(self, tag, values, step, bins=1000):
-        """Log a histogram of the tensor of values."""
-
-        # Create a histogram using numpy
-        counts, bin_edges = np.histogram(values, bins=bins)
-
-        # Fill the fields of the histogram proto
-        hist = tf.HistogramProto()
-        hist.min = float(np.min(values))
-        hist.max = float(np.max(values))
-        hist.num = int(np.prod(values.shape))
-        hist.sum = float(np.sum(values))
-        hist.sum_squares = float(np.sum(values**2))
-
-        # Drop the start of the first bin
-        bin_edges = bin_edges[1:]
-
-        # Add bin edges and counts
-        for edge in bin_edges:
-            hist.bucket_limit.append(edge)
-        for c in counts:
-            hist.bucket.append(c)
-
-        # Create and write Summary
-        summary = tf.Summary(value=[tf.Summary.Value(tag=tag, histo=hist)])
-        self.writer.add_summary(summary, step)
-        self.writer.flush()
+            self.writer.queue.put(
+                ('image', '%s/%d' % (tag, i), np.array(img), step, None))
+
+    def should_log_histogram(self, step):
+        return step % self.histogram_frequency == 0
+
+    def histo_summary(self, tag, values, step, bins=None):
+        """Log a histogram of the tensor of values.
+
+        Skipped unless step is a multiple of histogram_frequency. The
+        histogram itself is computed on the writer thread.
+        """
+        if values is None or not self.should_log_histogram(step):
+            return
+        if bins is None:
+            bins = self.bins
+        self.writer.queue.put(('histo', tag, np.array(values), step, bins))
+
+    def flush(self):
+        """Ask the writer thread to write everything queued so far."""
+        self.writer.queue.put('flush')
+
+    def close(self):
+        """Write pending summaries and stop the writer thread."""
+        if self.writer.is_alive():
+            self.writer.queue.put(None)
+            self.writer.join()
@@ -0,0 +1,409 @@
+""" Compact binary masks (tumor / tissue) for the sampling and labelling
+
+usage :
+    mask = COMPACT_MASK.from_contours((row, col), annotation, 'bitpacked')
+    mask.window_sum(x, y, w, h)        # pixels set in a window
+    xs, ys = mask.sample(100)          # uniform, without replacement
+    mask.dilate(19).difference(other)
+
+    python mask.py --size 50000 40000  # memory and time of each backing
+
+A mask is 0 / 1 and is stored row by row in one of three backings
+    uint8     : 1 byte per pixel (what cv2 works on)
+    bitpacked : 1 bit per pixel (np.packbits of every row)
+    rle       : runs [start, end) of every row, for large sparse masks
+Rasterization and morphology run on horizontal strips of strip_height
+rows (plus the rows of context they need), so no dense mask of the whole
+level is ever allocated; that makes labelling at level 2 or finer fit in
+memory. The result is the same as cv2 on the dense mask.
+"""
+from __future__ import print_function
+
+import time
+import argparse
+
+import numpy as np
+import cv2
+
+# user define variable
+from user_define import Config as cf
+
+
+LIST_OF_BACKING = ('uint8', 'bitpacked', 'rle')
+
+# pixels set in each byte value
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.int64)
+
+
+class COMPACT_MASK(object):
+    """
+    Binary mask of shape (row, col)
+
+    Args:
+        shape (tuple) (row, col)
+        backing (string) 'uint8', 'bitpacked' or 'rle'
+        strip_height (int) rows per strip of the dense operations
+    """
+
+    def __init__(self, shape, backing=cf.backing_of_mask,
+                 strip_height=1024):
+        if backing not in LIST_OF_BACKING:
+            raise RuntimeError("invalid backing of mask : " + backing)
+        self.shape = (int(shape[0]), int(shape[1]))
+        self.backing = backing
+        self.strip_height = strip_height
+
+        row, col = self.shape
+        if backing == 'uint8':
+            self.data = np.zeros((row, col), dtype=np.uint8)
+        elif backing == 'bitpacked':
+            self.data = np.zeros((row, (col + 7) // 8), dtype=np.uint8)
+        else:
+            # runs of row r are run_start / run_end[row_ptr[r]:row_ptr[r + 1]]
+            self.row_ptr = np.zeros(row + 1, dtype=np.int64)
+            self.run_start = np.zeros(0, dtype=np.int32)
+            self.run_end = np.zeros(0, dtype=np.int32)
+
+    """
+    param : shape (row, col)
+            set_of_strip (iterable of (first row, dense strip), in row order,
+                rows not given are empty)
+    """
+    @classmethod
+    def from_strips(cls, shape, set_of_strip, backing=cf.backing_of_mask,
+                    strip_height=1024):
+        mask = cls(shape, backing, strip_height)
+        if backing != 'rle':
+            for r0, strip in set_of_strip:
+                mask._set_rows(r0, strip)
+            return mask
+
+        row_ptr = np.zeros(mask.shape[0] + 1, dtype=np.int64)
+        set_of_start, set_of_end = [], []
+        for r0, strip in set_of_strip:
+            rows, start, end = _encode_runs(strip)
+            np.add.at(row_ptr, r0 + rows + 1, 1)
+            set_of_start.append(start)
+            set_of_end.append(end)
+        mask.row_ptr = np.cumsum(row_ptr)
+        if set_of_start:
+            mask.run_start = np.concatenate(set_of_start).astype(np.int32)
+            mask.run_end = np.concatenate(set_of_end).astype(np.int32)
+        return mask
+
+    @classmethod
+    def from_array(cls, array, backing=cf.backing_of_mask, strip_height=1024):
+        array = np.asarray(array)
+        return cls.from_strips(
+            array.shape,
+            ((r0, array[r0:r0 + strip_height] > 0)
+             for r0 in range(0, array.shape[0], strip_height)),
+            backing, strip_height)
+
+    """
+    filled polygons, like cv2.drawContours(mask, contours, -1, 255, -1)
+
+    param : shape (row, col)
+            contours (list of N x 2 (x, y) in pixels of the mask)
+    """
+    @classmethod
+    def from_contours(cls, shape, contours, backing=cf.backing_of_mask,
+                      strip_height=1024):
+        contours = [np.asarray(c, dtype=np.int32).reshape(-1, 1, 2)
+                    for c in contours if len(c) > 0]
+        row, col = int(shape[0]), int(shape[1])
+
+        def iter_strips():
+            if not contours:
+                return
+            y_min = max(0, min(int(c[:, 0, 1].min()) for c in contours))
+            y_max = min(row, max(int(c[:, 0, 1].max()) for c in contours) + 1)
+            # cv2 also draws the outline, and a line clipped at the strip
+            # edge is not the same line, so every segment crossing a strip
+            # is drawn whole in a margin around it
+            margin = 1 + max(int(np.abs(np.diff(c[:, 0, 1], append=c[:1, 0, 1]))
+                                 .max()) for c in contours)
+            for r0 in range(y_min, y_max, strip_height):
+                height = min(strip_height, y_max - r0)
+                top = max(0, r0 - margin)
+                bottom = min(row, r0 + height + margin)
+                strip = np.zeros((bottom - top, col), dtype=np.uint8)
+                cv2.drawContours(strip, contours, -1, 1, -1, offset=(0, -top))
+                yield r0, strip[r0 - top:r0 - top + height]
+
+        return cls.from_strips(shape, iter_strips(), backing, strip_height)
+
+    def _set_rows(self, r0, strip):
+        strip = np.asarray(strip) > 0
+        if self.backing == 'uint8':
+            self.data[r0:r0 + len(strip)] = strip
+        elif self.backing == 'bitpacked':
+            self.data[r0:r0 + len(strip)] = np.packbits(strip, axis=1)
+        else:
+            raise RuntimeError("rle masks are built with from_strips")
+
+    """
+    return : dense uint8 (0 / 1) of rows [r0, r1) and columns [c0, c1)
+    """
+    def get_window(self, r0, r1, c0=0, c1=None):
+        row, col = self.shape
+        c1 = col if c1 is None else c1
+        r0, r1 = max(0, r0), min(row, r1)
+        c0, c1 = max(0, c0), min(col, c1)
+        if r1 <= r0 or c1 <= c0:
+            return np.zeros((max(0, r1 - r0), max(0, c1 - c0)), np.uint8)
+
+        if self.backing == 'uint8':
+            return self.data[r0:r1, c0:c1]
+        if self.backing == 'bitpacked':
+            # unpack only the bytes of the window
+            b0 = c0 // 8
+            bits = np.unpackbits(self.data[r0:r1, b0:(c1 + 7) // 8], axis=1)
+            return bits[:, c0 - b0 * 8:c1 - b0 * 8]
+
+        # +1 at the start and -1 at the end of every run, then cumsum
+        p0, p1 = self.row_ptr[r0], self.row_ptr[r1]
+        rows = np.repeat(np.arange(r1 - r0),
+                         np.diff(self.row_ptr[r0:r1 + 1]))
+        start = np.clip(self.run_start[p0:p1], c0, c1) - c0
+        end = np.clip(self.run_end[p0:p1], c0, c1) - c0
+        edge = np.zeros((r1 - r0, c1 - c0 + 1), dtype=np.int32)
+        np.add.at(edge, (rows, start), 1)
+        np.add.at(edge, (rows, end), -1)
+        return (np.cumsum(edge[:, :-1], axis=1) > 0).astype(np.uint8)
+
+    def iter_strips(self, halo=0):
+        row = self.shape[0]
+        for r0 in range(0, row, self.strip_height):
+            r1 = min(row, r0 + self.strip_height)
+            yield r0, r1, self.get_window(r0 - halo, r1 + halo)
+
+    """
+    param : x, y (top-left), w, h of the window, in pixels of the mask
+
+    return : number of pixels set (the part outside the mask counts 0)
+    """
+    def window_sum(self, x, y, w, h):
+        x, y = int(x), int(y)
+        if self.backing == 'rle':
+            row, col = self.shape
+            total = 0
+            for r in range(max(0, y), min(row, y + h)):
+                p0, p1 = self.row_ptr[r], self.row_ptr[r + 1]
+                if p0 == p1:
+                    continue
+                start = np.clip(self.run_start[p0:p1], x, x + w)
+                end = np.clip(self.run_end[p0:p1], x, x + w)
+                total += int((end - start).sum())
+            return total
+        return int(self.get_window(y, y + h, x, x + w).sum())
+
+    def window_sums(self, set_of_x, set_of_y, w, h):
+        return np.array([self.window_sum(x, y, w, h)
+                         for x, y in zip(set_of_x, set_of_y)], dtype=np.int64)
+
+    def row_counts(self):
+        if self.backing == 'uint8':
+            return self.data.sum(axis=1, dtype=np.int64)
+        if self.backing == 'bitpacked':
+            # padding bits of the last byte are never set
+            return POPCOUNT[self.data].sum(axis=1)
+        length = (self.run_end - self.run_start).astype(np.int64)
+        csum = np.concatenate([[0], np.cumsum(length)])
+        return csum[self.row_ptr[1:]] - csum[self.row_ptr[:-1]]
+
+    def count_nonzero(self):
+        if self.backing == 'rle':
+            return int((self.run_end - self.run_start).astype(np.int64).sum())
+        return int(self.row_counts().sum())
+
+    """
+    param : num (int) pixels to draw, uniform, without replacement
+            random_state (np.random or RandomState)
+
+    return : xs, ys (int64, num), in random order
+    """
+    def sample(self, num, random_state=np.random):
+        counts = self.row_counts()
+        total = int(counts.sum())
+        if total < num:
+            raise RuntimeError(
+                'Random size is bigger than number of pixels in region')
+        rank = _choice_without_replacement(total, num, random_state)
+
+        # rank -> row, then the column of the k-th set pixel of that row
+        cumulative = np.cumsum(counts)
+        rows = np.searchsorted(cumulative, rank, side='right')
+        rank_in_row = rank - (cumulative[rows] - counts[rows])
+        xs = np.empty(num, dtype=np.int64)
+        order = np.argsort(rows, kind='stable')
+        boundary = np.flatnonzero(np.diff(rows[order])) + 1
+        for index in np.split(order, boundary):
+            if len(index) == 0:
+                continue
+            r = int(rows[index[0]])
+            columns = np.flatnonzero(self.get_window(r, r + 1)[0])
+            xs[index] = columns[rank_in_row[index]]
+        return xs, rows.astype(np.int64)
+
+    """
+    Poisson-disk sampling : uniform candidates (sample) are accepted when
+    no accepted pixel is closer than min_distance, checked in a grid of
+    buckets of side min_distance / sqrt(2) (one pixel per bucket at most)
+
+    param : num (int) pixels to draw
+            min_distance (float) in pixels of the mask, 0 is sample
+            max_attempts (int) candidates drawn per pixel asked
+
+    return : xs, ys (int64, num or fewer when the mask is full)
+    """
+    def sample_poisson_disk(self, num, min_distance, random_state=np.random,
+                            max_attempts=30):
+        if min_distance <= 0:
+            return self.sample(num, random_state)
+
+        total = self.count_nonzero()
+        candidate_x, candidate_y = self.sample(min(total, num * max_attempts),
+                                               random_state)
+        size = min_distance / np.sqrt(2)
+        square = min_distance * min_distance
+        buckets = {}
+        set_of_x, set_of_y = [], []
+        for x, y in zip(candidate_x.tolist(), candidate_y.tolist()):
+            bx, by = int(x // size), int(y // size)
+            is_far = True
+            for key in ((bx + i, by + j) for i in range(-2, 3)
+                        for j in range(-2, 3)):
+                other = buckets.get(key)
+                if other is not None and \
+                        (other[0] - x) ** 2 + (other[1] - y) ** 2 < square:
+                    is_far = False
+                    break
+            if not is_far:
+                continue
+            buckets[(bx, by)] = (x, y)
+            set_of_x.append(x)
+            set_of_y.append(y)
+            if len(set_of_x) == num:
+                break
+
+        if len(set_of_x) < num:
+            print("min distance %.1f : %d of %d pixels sampled"
+                  % (min_distance, len(set_of_x), num))
+        return (np.array(set_of_x, dtype=np.int64),
+                np.array(set_of_y, dtype=np.int64))
+
+    """
+    param : fn (dense strip with halo -> dense strip with halo)
+            halo (int) rows of context fn needs on each side
+    """
+    def map_strips(self, fn, halo=0, backing=None):
+        row = self.shape[0]
+
+        def iter_result():
+            for r0, r1, strip in self.iter_strips(halo):
+                top = r0 - max(0, r0 - halo)
+                yield r0, fn(strip)[top:top + r1 - r0]
+
+        return COMPACT_MASK.from_strips(self.shape, iter_result(),
+                                        backing or self.backing,
+                                        self.strip_height)
+
+    def dilate(self, size):
+        kernel = np.ones((size, size), np.uint8)
+        return self.map_strips(
+            lambda strip: cv2.dilate(np.ascontiguousarray(strip), kernel),
+            halo=size // 2)
+
+    def erode(self, size):
+        kernel = np.ones((size, size), np.uint8)
+        # the halo rows make each strip erode as the whole mask does, and
+        # at the real top / bottom cv2 uses the same border as before
+        return self.map_strips(
+            lambda strip: cv2.erode(np.ascontiguousarray(strip), kernel),
+            halo=size // 2)
+
+    """
+    return : self and not other (same shape)
+    """
+    def difference(self, other):
+        if other.shape != self.shape:
+            raise RuntimeError("masks of different shape")
+
+        def iter_result():
+            for r0, r1, strip in self.iter_strips():
+                yield r0, (strip > 0) & ~(other.get_window(r0, r1) > 0)
+
+        return COMPACT_MASK.from_strips(self.shape, iter_result(),
+                                        self.backing, self.strip_height)
+
+    def to_array(self):
+        return np.array(self.get_window(0, self.shape[0]), dtype=np.uint8)
+
+    """
+    return : uint8 0 / 255, for cv2.imwrite
+    """
+    def to_image(self):
+        return self.to_array() * 255
+
+    @property
+    def nbytes(self):
+        if self.backing == 'rle':
+            return (self.row_ptr.nbytes + self.run_start.nbytes +
+                    self.run_end.nbytes)
+        return self.data.nbytes
+
+
+def _encode_runs(strip):
+    strip = np.asarray(strip) > 0
+    padded = np.zeros((strip.shape[0], strip.shape[1] + 2), dtype=np.int8)
+    padded[:, 1:-1] = strip
+    rows, start = np.nonzero(np.diff(padded, axis=1) == 1)
+    _, end = np.nonzero(np.diff(padded, axis=1) == -1)
+    return rows, start, end
+
+
+def _choice_without_replacement(total, num, random_state):
+    if num * 4 > total:
+        return random_state.permutation(total)[:num]
+    # few draws of many : redraw the duplicates
+    rank = np.unique(random_state.randint(0, total, size=num))
+    while len(rank) < num:
+        more = random_state.randint(0, total, size=num - len(rank))
+        rank = np.unique(np.concatenate([rank, more]))
+    random_state.shuffle(rank)
+    return rank
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='COMPACT_MASK backings')
+    parser.add_argument('--size', type=int, nargs=2, default=[25000, 20000],
+                        help='col row, ex) level 2 of a CAMELYON slide')
+    parser.add_argument('--polygons', type=int, default=20)
+    args = parser.parse_args()
+
+    col, row = args.size
+    rng = np.random.RandomState(0)
+    contours = []
+    for _ in range(args.polygons):
+        center = rng.uniform([0, 0], [col, row])
+        radius = rng.uniform(50, min(col, row) / 20.)
+        angle = np.linspace(0, 2 * np.pi, 48, endpoint=False)
+        contours.append(np.stack([center[0] + radius * np.cos(angle),
+                                  center[1] + radius * np.sin(angle)], 1))
+
+    print("%-10s %12s %10s %10s %10s" % ('backing', 'MB', 'draw (s)',
+                                         'count (s)', 'sample (s)'))
+    print("%-10s %12.1f" % ('float64', row * col * 8 / 1e6))
+    for backing in LIST_OF_BACKING:
+        start = time.perf_counter()
+        mask = COMPACT_MASK.from_contours((row, col), contours, backing)
+        draw = time.perf_counter() - start
+        start = time.perf_counter()
+        number = mask.count_nonzero()
+        count = time.perf_counter() - start
+        start = time.perf_counter()
+        mask.sample(min(1000, number))
+        sample = time.perf_counter() - start
+        print("%-10s %12.1f %10.3f %10.3f %10.3f"
+              % (backing, mask.nbytes / 1e6, draw, count, sample))
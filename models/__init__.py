@@ -1,3 +1,4 @@
 from .resnet import *
 from .densenet import *
 from .inception import *
+from .optimize import *
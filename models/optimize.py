@@ -0,0 +1,251 @@
+""" Inference graph optimization for the models of this package
+
+usage :
+    from models import resnet18, optimize_for_inference
+    net = optimize_for_inference(net)
+
+    python -m models.optimize --arch resnet18     # check and throughput
+
+In eval mode BatchNorm is an affine map per channel, so it is folded into
+the weights and bias of the conv in front of it. Explicit padding modules
+are merged into the padding of the conv that consumes them where that is
+equivalent (ResNet padding1 / padding2, DenseNet _SizeHandle), and layers
+left as no-ops are removed from their Sequential.
+"""
+import copy
+import time
+import argparse
+
+import torch
+import torch.nn as nn
+
+from .resnet import ResNet, Bottleneck
+from .densenet import DenseNet, _DenseLayer, _SizeHandle, _Transition
+from .inception import Inception3, BasicConv2d
+
+
+__all__ = ['optimize_for_inference', 'fold_bn', 'check_equivalence']
+
+
+"""
+param : conv (nn.Conv2d), bn (nn.BatchNorm2d) directly after conv
+
+return : conv with bn folded into its weight and bias (new module)
+"""
+def fold_bn(conv, bn):
+    std = torch.sqrt(bn.running_var + bn.eps)
+    gamma = bn.weight if bn.affine else torch.ones_like(std)
+    beta = bn.bias if bn.affine else torch.zeros_like(std)
+    scale = (gamma / std).detach()
+
+    fused = copy.deepcopy(conv)
+    fused.weight = nn.Parameter(
+        conv.weight.detach() * scale.view(-1, 1, 1, 1))
+    bias = conv.bias.detach() if conv.bias is not None \
+        else torch.zeros_like(bn.running_mean)
+    fused.bias = nn.Parameter(
+        (bias - bn.running_mean) * scale + beta.detach())
+    return fused
+
+
+def _fold(module, conv_name, bn_name):
+    module._modules[conv_name] = fold_bn(module._modules[conv_name],
+                                         module._modules[bn_name])
+    module._modules[bn_name] = nn.Identity()
+
+
+def _merge_zero_pad(conv, pad):
+    conv.padding = (conv.padding[0] + pad, conv.padding[1] + pad)
+
+
+def _get_pad(module):
+    # ZeroPad2d of an int is (left, right, top, bottom), all the same
+    padding = module.padding
+    if len(set(padding)) != 1:
+        raise RuntimeError("only symmetric padding can be merged")
+    return padding[0]
+
+
+def _optimize_resnet(net):
+    _fold(net, 'conv1', 'bn1')
+    for layer in (net.layer1, net.layer2, net.layer3, net.layer4):
+        for block in layer:
+            _fold(block, 'conv1', 'bn1')
+            _fold(block, 'conv2', 'bn2')
+            if isinstance(block, Bottleneck):
+                _fold(block, 'conv3', 'bn3')
+            if block.downsample is not None:
+                _fold(block.downsample, '0', '1')
+
+    # zero padding of the input == more zero padding of the conv
+    if isinstance(net.padding1, nn.ZeroPad2d):
+        _merge_zero_pad(net.conv1, _get_pad(net.padding1))
+        net.padding1 = nn.Identity()
+
+    # padding2 feeds both paths of layer3[0], pad its conv1 and downsample
+    block = net.layer3[0]
+    # (the border then sees conv(0) = folded bias, as before the folding)
+    if isinstance(net.padding2, nn.ZeroPad2d) and block.downsample is not None:
+        pad = _get_pad(net.padding2)
+        _merge_zero_pad(block.conv1, pad)
+        _merge_zero_pad(block.downsample[0], pad)
+        net.padding2 = nn.Identity()
+
+
+def _optimize_densenet(net):
+    _fold(net.features, 'conv0', 'norm0')
+    for module in net.modules():
+        if isinstance(module, _DenseLayer):
+            # pre-activation, only conv.1 is directly followed by bn
+            _fold(module, 'conv.1', 'norm.2')
+
+    # replication pad commutes with norm and relu (per pixel), so it is
+    # the same as replicate padding of the 1x1 conv of the next transition
+    list_of_name = list(net.features._modules)
+    for i, name in enumerate(list_of_name):
+        module = net.features._modules[name]
+        if not isinstance(module, _SizeHandle):
+            continue
+        transition = net.features._modules[list_of_name[i + 1]]
+        pad = list(module._modules.values())[0]
+        if not isinstance(transition, _Transition) or \
+                not isinstance(pad, nn.ReplicationPad2d):
+            continue
+        conv = transition.conv
+        if conv.kernel_size != (1, 1) or conv.padding != (0, 0):
+            continue
+        padded = nn.Conv2d(conv.in_channels, conv.out_channels,
+                           kernel_size=1, stride=conv.stride,
+                           padding=_get_pad(pad), bias=conv.bias is not None,
+                           padding_mode='replicate')
+        padded.load_state_dict(conv.state_dict())
+        transition.conv = padded
+        net.features._modules[name] = nn.Identity()
+
+
+def _optimize_inception(net):
+    for module in net.modules():
+        if isinstance(module, BasicConv2d):
+            _fold(module, 'conv', 'bn')
+
+
+def _remove_identity(module):
+    for child in module.children():
+        _remove_identity(child)
+    # Sequential (and _DenseLayer, _Transition ...) just chain their children
+    if isinstance(module, nn.Sequential):
+        for name, child in list(module._modules.items()):
+            if isinstance(child, nn.Identity):
+                del module._modules[name]
+
+
+"""
+param : model (ResNet, DenseNet or Inception3, may be in DataParallel)
+        inplace (bool) modify model instead of a copy
+        check (bool) compare the outputs with the original model
+        tolerance (float) max difference of the logits allowed
+
+return : optimized model in eval mode
+"""
+def optimize_for_inference(model, inplace=False, check=True, tolerance=1e-4,
+                           input_size=(2, 3, 304, 304)):
+    if isinstance(model, nn.DataParallel):
+        model = model.module
+    model.eval()
+    net = model if inplace else copy.deepcopy(model)
+    if check and inplace:
+        model = copy.deepcopy(model)
+
+    with torch.no_grad():
+        if isinstance(net, ResNet):
+            _optimize_resnet(net)
+        elif isinstance(net, DenseNet):
+            _optimize_densenet(net)
+        elif isinstance(net, Inception3):
+            _optimize_inception(net)
+        else:
+            raise RuntimeError("can not optimize " + type(net).__name__)
+    _remove_identity(net)
+
+    if check:
+        check_equivalence(model, net, input_size, tolerance)
+    return net
+
+
+def _get_logit(model, x):
+    # compare before the sigmoid, which saturates and hides differences
+    logit = []
+    hook = model.fullyconnected.register_forward_hook(
+        lambda module, inputs, output: logit.append(output))
+    try:
+        model(x)
+    finally:
+        hook.remove()
+    return logit[0]
+
+
+"""
+raise RuntimeError if the logits differ more than tolerance (relative to
+the largest logit when it is above 1, float32 rounding grows with it)
+
+return : max difference
+"""
+def check_equivalence(model, optimized, input_size=(2, 3, 304, 304),
+                      tolerance=1e-4):
+    device = next(model.parameters()).device
+    x = torch.rand(*input_size, device=device)
+    with torch.no_grad():
+        expected = _get_logit(model, x)
+        output = _get_logit(optimized, x)
+    scale = max(1., float(expected.abs().max()))
+    diff = float((expected - output).abs().max()) / scale
+    if diff > tolerance:
+        raise RuntimeError("optimized model differs by %.3e (> %.1e)"
+                           % (diff, tolerance))
+    return diff
+
+
+def get_patches_per_sec(model, batch_size=16, number_of_batch=5,
+                        input_size=(3, 304, 304)):
+    device = next(model.parameters()).device
+    x = torch.rand(batch_size, *input_size, device=device)
+    with torch.no_grad():
+        model(x)  # warm up
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(number_of_batch):
+            model(x)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+    return batch_size * number_of_batch / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    import models
+
+    parser = argparse.ArgumentParser(description='optimize_for_inference')
+    parser.add_argument('--arch', default='resnet18',
+                        choices=['resnet18', 'resnet50', 'densenet121',
+                                 'inception_v3'])
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--batches', type=int, default=5)
+    parser.add_argument('--tolerance', type=float, default=1e-4)
+    args = parser.parse_args()
+
+    net = getattr(models, args.arch)(pretrained=False).eval()
+    # non trivial statistics, so folding is actually checked
+    for m in net.modules():
+        if isinstance(m, nn.BatchNorm2d):
+            m.running_mean.uniform_(-0.1, 0.1)
+            m.running_var.uniform_(0.5, 2.)
+            m.weight.data.uniform_(0.5, 1.5)
+            m.bias.data.uniform_(-0.1, 0.1)
+
+    optimized = optimize_for_inference(net, tolerance=args.tolerance)
+    print("max diff : %.3e" % check_equivalence(net, optimized,
+                                                tolerance=args.tolerance))
+    before = get_patches_per_sec(net, args.batch_size, args.batches)
+    after = get_patches_per_sec(optimized, args.batch_size, args.batches)
+    print("%s : %.1f -> %.1f patches/sec (x%.2f)"
+          % (args.arch, before, after, after / before))
@@ -4,7 +4,7 @@ import torch.utils.model_zoo as model_zoo
 
 
 __all__ = ['ResNet', 'resnet18', 'resnet34', 'resnet50', 'resnet101',
-           'resnet152']
+           'resnet152', 'resnet10_narrow', 'resnet18_narrow']
 
 
 model_urls = {
@@ -95,22 +95,27 @@ class Bottleneck(nn.Module):
 
 class ResNet(nn.Module):
 
-    def __init__(self, block, layers, num_classes=1):
-        self.inplanes = 64
+    def __init__(self, block, layers, num_classes=1, base_width=64):
+        # base_width < 64 makes every layer narrower (small students)
+        self.inplanes = base_width
         super(ResNet, self).__init__()
         self.padding1 = nn.ZeroPad2d(3)
-        self.conv1 = nn.Conv2d(3, 64, kernel_size=7, stride=2, padding=0,
-                               bias=False)
-        self.bn1 = nn.BatchNorm2d(64)
+        self.conv1 = nn.Conv2d(3, base_width, kernel_size=7, stride=2,
+                               padding=0, bias=False)
+        self.bn1 = nn.BatchNorm2d(base_width)
         self.relu = nn.ReLU(inplace=True)
         self.maxpool = nn.MaxPool2d(kernel_size=3, stride=2, padding=1)
-        self.layer1 = self._make_layer(block, 64, layers[0])
-        self.layer2 = self._make_layer(block, 128, layers[1], stride=2)
+        self.layer1 = self._make_layer(block, base_width, layers[0])
+        self.layer2 = self._make_layer(block, base_width * 2, layers[1],
+                                       stride=2)
         self.padding2 = nn.ZeroPad2d(1)
-        self.layer3 = self._make_layer(block, 256, layers[2], stride=2)
-        self.layer4 = self._make_layer(block, 512, layers[3], stride=2)
+        self.layer3 = self._make_layer(block, base_width * 4, layers[2],
+                                       stride=2)
+        self.layer4 = self._make_layer(block, base_width * 8, layers[3],
+                                       stride=2)
         self.avgpool = nn.AvgPool2d(10, stride=1)
-        self.fullyconnected = nn.Linear(512 * block.expansion, num_classes)
+        self.fullyconnected = nn.Linear(base_width * 8 * block.expansion,
+                                        num_classes)
         self.sigmoid = nn.Sigmoid()
 
         for m in self.modules():
@@ -217,3 +222,25 @@ def resnet152(pretrained=True, **kwargs):
     if pretrained:
         model.load_state_dict(model_zoo.load_url(model_urls['resnet152']), False)
     return model
+
+
+def resnet10_narrow(pretrained=False, **kwargs):
+    """Constructs a ResNet-10 with half width, a student for distillation.
+
+    Args:
+        pretrained (bool): no weights are available, must be False
+    """
+    if pretrained:
+        raise RuntimeError("no pretrained weights for resnet10_narrow")
+    return ResNet(BasicBlock, [1, 1, 1, 1], base_width=32, **kwargs)
+
+
+def resnet18_narrow(pretrained=False, **kwargs):
+    """Constructs a ResNet-18 with half width, a student for distillation.
+
+    Args:
+        pretrained (bool): no weights are available, must be False
+    """
+    if pretrained:
+        raise RuntimeError("no pretrained weights for resnet18_narrow")
+    return ResNet(BasicBlock, [2, 2, 2, 2], base_width=32, **kwargs)
@@ -0,0 +1,89 @@
+""" Quality filter of the patches read by create_dataset.py
+
+usage :
+    quality = get_quality_of_patch(patch)     # RGB uint8, H x W x 3
+    reason = get_reason_of_reject(quality)   # None is a good patch
+
+    python patch_filter.py --slide b_1       # stats of sampled patches
+
+The level 4 tissue mask keeps patches that are mostly white (edge of the
+tissue, holes) or blurred at level 0. Three statistics, on every other
+pixel of the decoded patch
+    tissue : part of the pixels with HSV saturation over
+             hp.threshold_of_saturation (stained)
+    std    : std of the gray image (flat background, pen)
+    blur   : variance of the Laplacian of the gray image (out of focus)
+"""
+from __future__ import print_function
+
+import argparse
+
+import numpy as np
+import cv2
+
+# user define variable
+from user_define import Hyperparams as hp
+
+
+LIST_OF_REASON = ('tissue', 'std', 'blur')
+
+
+"""
+param : patch (RGB uint8, H x W x 3)
+        step (int) pixel step of the statistics
+
+return : dict of tissue, std and blur
+"""
+def get_quality_of_patch(patch, step=2):
+    patch = np.ascontiguousarray(np.asarray(patch)[::step, ::step, :3])
+    saturation = cv2.cvtColor(patch, cv2.COLOR_RGB2HSV)[:, :, 1]
+    gray = cv2.cvtColor(patch, cv2.COLOR_RGB2GRAY)
+    return {'tissue': float(np.mean(saturation > hp.threshold_of_saturation)),
+            'std': float(gray.std()),
+            'blur': float(cv2.Laplacian(gray, cv2.CV_32F).var())}
+
+
+"""
+return : None for a good patch, else the first failed statistic
+"""
+def get_reason_of_reject(quality, min_tissue=hp.min_tissue_of_patch,
+                         min_std=hp.min_std_of_patch,
+                         min_blur=hp.min_blur_of_patch):
+    if quality['tissue'] < min_tissue:
+        return 'tissue'
+    if quality['std'] < min_std:
+        return 'std'
+    if quality['blur'] < min_blur:
+        return 'blur'
+    return None
+
+
+if __name__ == "__main__":
+    from create_dataset import CAMELYON_PREPRO
+
+    parser = argparse.ArgumentParser(description='Patch quality statistics')
+    parser.add_argument('--slide', default='b_1')
+    parser.add_argument('--patches', type=int, default=500)
+    args = parser.parse_args()
+
+    prepro = CAMELYON_PREPRO.__new__(CAMELYON_PREPRO)
+    prepro.load_slide(args.slide)
+    tissue_mask = prepro.create_tissue_mask()
+    np.random.seed(0)
+    set_of_pos = prepro.get_pos_of_samples(tissue_mask, args.patches, 0)
+
+    set_of_quality = []
+    for x, y in set_of_pos:
+        patch = prepro.slide.read_region((x, y), 0, hp.patch_size)
+        set_of_quality.append(get_quality_of_patch(
+            np.array(patch.convert('RGB'))))
+
+    for key in LIST_OF_REASON:
+        value = np.array([q[key] for q in set_of_quality])
+        print("%-8s " % key + " ".join(
+            "p%d %.3f" % (p, np.percentile(value, p))
+            for p in (1, 5, 25, 50, 75)))
+    set_of_reason = [get_reason_of_reject(q) for q in set_of_quality]
+    for reason in LIST_OF_REASON:
+        print("rejected by %-8s %d / %d"
+              % (reason, set_of_reason.count(reason), len(set_of_reason)))
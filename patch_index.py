@@ -0,0 +1,267 @@
+""" Index of the extracted patches (SQLite) and their pixel store (npy shards)
+
+usage :
+    from patch_index import PATCH_INDEX
+    index = PATCH_INDEX()
+    rows = index.select("slide = ? AND label = 1 AND tumor_rate < 1",
+                        ('b_3',), usage='train')   # boundary tumor patches
+    set_of_patch = index.read_patches(rows)        # only those rows
+
+    python patch_index.py --usage train --where "source = 'hard_fp'"
+
+create_dataset.py (and the hard example miner) write the patches of a
+shard, ex) 'b_1' or 'b_1_hard_2', to
+    cf.path_of_patch_store/$USAGE/$SHARD.npy   (uint8, N x H x W x 3)
+and one row per patch to the 'patch' table of cf.path_of_patch_index
+    usage, shard, offset (row in the npy), slide, x, y, w, h (level 0),
+    label, tumor_rate, source ('tumor', 'tissue', 'false_positive',
+    'hard_fp', 'hard_fn')
+so a subset is chosen by a query on the table, and only its rows are read
+from the memmap of each shard. The npy is the only copy of the pixels, the
+pickle of the shard keeps the informations and the path of the npy
+(cf.key_of_store), load_dataset_pickle reads both.
+"""
+from __future__ import print_function
+
+import os
+import time
+import pickle
+import sqlite3
+import argparse
+
+import numpy as np
+
+# user define variable
+from user_define import Config as cf
+from user_define import Hyperparams as hp
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS patch (
+    usage TEXT NOT NULL,
+    shard TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    slide TEXT NOT NULL,
+    x INTEGER NOT NULL,
+    y INTEGER NOT NULL,
+    w INTEGER NOT NULL,
+    h INTEGER NOT NULL,
+    label INTEGER NOT NULL,
+    tumor_rate REAL NOT NULL,
+    source TEXT NOT NULL,
+    PRIMARY KEY (usage, shard, offset)
+);
+CREATE INDEX IF NOT EXISTS patch_of_slide ON patch (usage, slide, label);
+"""
+
+LIST_OF_COLUMN = ('usage', 'shard', 'offset', 'slide', 'x', 'y', 'w', 'h',
+                  'label', 'tumor_rate', 'source')
+
+
+"""
+return : 'train' or 'val', the folder of a create_dataset usage
+"""
+def get_usage_of_folder(usage):
+    if usage in ('train', 'train_incorrect'):
+        return 'train'
+    if usage in ('val', 'val_incorrect'):
+        return 'val'
+    raise RuntimeError("usage is invalid value")
+
+
+"""
+param : path_of_pickle (string) dataset pickle of create_dataset.py
+
+return : dict of the pickle, cf.key_of_data is a read-only memmap of the
+         npy store for a pickle without the pixels
+"""
+def load_dataset_pickle(path_of_pickle):
+    with open(path_of_pickle, 'rb') as fo:
+        dataset = pickle.load(fo)
+    if cf.key_of_data not in dataset:
+        if cf.key_of_store not in dataset:
+            raise RuntimeError("no patch in " + path_of_pickle)
+        dataset[cf.key_of_data] = np.load(dataset[cf.key_of_store],
+                                          mmap_mode='r')
+    return dataset
+
+
+class PATCH_INDEX(object):
+    """
+    Patch table and npy shards of the extracted datasets
+
+    Args:
+        path_of_index (string) default cf.path_of_patch_index
+        path_of_store (string) default cf.path_of_patch_store
+    """
+
+    def __init__(self, path_of_index=None, path_of_store=None):
+        self.path_of_index = path_of_index or cf.path_of_patch_index
+        self.path_of_store = path_of_store or cf.path_of_patch_store
+
+    """
+    return : connection, the table is created on the first use (the pool
+             workers of create_dataset.py wait for each other's writes)
+    """
+    def connect(self):
+        folder = os.path.dirname(self.path_of_index)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        connection = sqlite3.connect(self.path_of_index, timeout=600)
+        connection.executescript(SCHEMA)
+        return connection
+
+    def get_path_of_shard(self, usage, shard):
+        return os.path.join(self.path_of_store, usage, shard + '.npy')
+
+    """
+    save the patches of a shard and replace its rows
+
+    param : usage ('train' or 'val')
+            shard (string) ex) 'b_1', 'b_1_hard_2'
+            slide (string) ex) 'b_1'
+            set_of_inform (N x 5 of [label, x, y, w, h], level 0)
+            tumor_rate (N,)
+            source (N,) sampling source of every patch
+            set_of_patch (uint8, N x H x W x 3)
+
+    return : path of the npy shard
+    """
+    def add_shard(self, usage, shard, slide, set_of_inform, tumor_rate,
+                  source, set_of_patch):
+        set_of_inform = np.asarray(set_of_inform).reshape(-1, 5)
+        set_of_patch = np.asarray(set_of_patch, dtype=np.uint8)
+        if len(set_of_patch) != len(set_of_inform):
+            raise RuntimeError("%d patches for %d rows of %s"
+                               % (len(set_of_patch), len(set_of_inform),
+                                  shard))
+
+        path_of_shard = self.get_path_of_shard(usage, shard)
+        if not os.path.isdir(os.path.dirname(path_of_shard)):
+            os.makedirs(os.path.dirname(path_of_shard))
+        # np.save adds .npy to a name without it
+        path_of_tmp = "%s.%d.tmp.npy" % (path_of_shard[:-4], os.getpid())
+        np.save(path_of_tmp, set_of_patch)
+        os.replace(path_of_tmp, path_of_shard)
+
+        rows = [(usage, shard, offset, slide, int(x), int(y), int(w), int(h),
+                 int(label), float(rate), str(src))
+                for offset, ((label, x, y, w, h), rate, src) in
+                enumerate(zip(set_of_inform, tumor_rate, source))]
+        connection = self.connect()
+        with connection:
+            connection.execute("DELETE FROM patch WHERE usage = ? AND "
+                               "shard = ?", (usage, shard))
+            connection.executemany(
+                "INSERT INTO patch VALUES (%s)"
+                % ", ".join("?" * len(LIST_OF_COLUMN)), rows)
+        connection.close()
+        return path_of_shard
+
+    """
+    param : where (string) SQL condition on the columns, with ? for params
+            params (tuple)
+            usage ('train', 'val' or None for both)
+
+    return : rows (dict of column -> numpy array), in shard / offset order
+    """
+    def select(self, where='1', params=(), usage=None):
+        if usage is not None:
+            where = "usage = ? AND (%s)" % where
+            params = (usage,) + tuple(params)
+        connection = self.connect()
+        result = connection.execute(
+            "SELECT %s FROM patch WHERE %s ORDER BY usage, shard, offset"
+            % (", ".join(LIST_OF_COLUMN), where), tuple(params)).fetchall()
+        connection.close()
+
+        rows = {}
+        for i, column in enumerate(LIST_OF_COLUMN):
+            rows[column] = np.array([r[i] for r in result])
+        # typed when nothing matched
+        for column in ('offset', 'x', 'y', 'w', 'h', 'label'):
+            rows[column] = rows[column].astype(np.int64)
+        rows['tumor_rate'] = rows['tumor_rate'].astype(np.float64)
+        return rows
+
+    """
+    return : set_of_inform (N x 5 of [label, x, y, w, h]) of the rows, as
+             the informations of a dataset pickle
+    """
+    def get_inform(self, rows):
+        return np.stack([rows[c] for c in ('label', 'x', 'y', 'w', 'h')],
+                        axis=1).reshape(-1, 5)
+
+    """
+    param : rows (from select)
+
+    return : set_of_patch (uint8, N x H x W x 3) of the rows, in their
+             order, read from the memmap of each shard
+    """
+    def read_patches(self, rows):
+        set_of_patch = None
+        keys = np.array(["%s/%s" % key
+                         for key in zip(rows['usage'], rows['shard'])])
+        # rows grouped by shard in one pass
+        list_of_key, inverse = np.unique(keys, return_inverse=True)
+        order = np.argsort(inverse, kind='stable')
+        bounds = np.searchsorted(inverse[order],
+                                 np.arange(len(list_of_key) + 1))
+        for i, key in enumerate(list_of_key):
+            usage, shard = key.split('/', 1)
+            index = order[bounds[i]:bounds[i + 1]]
+            store = np.load(self.get_path_of_shard(usage, shard),
+                            mmap_mode='r')
+            if set_of_patch is None:
+                set_of_patch = np.empty((len(keys),) + store.shape[1:],
+                                        dtype=np.uint8)
+            set_of_patch[index] = store[rows['offset'][index]]
+        if set_of_patch is None:
+            return np.zeros((0, hp.patch_size[1], hp.patch_size[0], 3),
+                            dtype=np.uint8)
+        return set_of_patch
+
+    """
+    return : number of patches by usage, slide, source and label
+    """
+    def get_summary(self, where='1', params=()):
+        connection = self.connect()
+        result = connection.execute(
+            "SELECT usage, slide, source, label, COUNT(*) FROM patch "
+            "WHERE %s GROUP BY usage, slide, source, label" % where,
+            tuple(params)).fetchall()
+        connection.close()
+        return result
+
+
+if __name__ == "__main__":
+    from load_dataset import load_patches
+
+    parser = argparse.ArgumentParser(description='Patch index query')
+    parser.add_argument('--usage', choices=['train', 'val'], default='train')
+    parser.add_argument('--where', default='1',
+                        help="SQL condition, ex) \"slide = 'b_3' AND "
+                             "label = 1 AND tumor_rate < 1\"")
+    args = parser.parse_args()
+
+    index = PATCH_INDEX()
+    for usage, slide, source, label, count in index.get_summary(
+            "usage = ?", (args.usage,)):
+        print("%-6s %-8s %-15s label %d : %d"
+              % (usage, slide, source, label, count))
+
+    start = time.perf_counter()
+    rows = index.select(args.where, usage=args.usage)
+    set_of_patch = index.read_patches(rows)
+    time_of_index = time.perf_counter() - start
+    print("query : %d patches, %.1f MB read, %.3f s"
+          % (len(set_of_patch), set_of_patch.nbytes / 1e6, time_of_index))
+
+    # the same subset from the pickles, all the pixels are loaded
+    path_of_dataset = (cf.path_of_train_dataset if args.usage == 'train'
+                       else cf.path_of_val_dataset)
+    start = time.perf_counter()
+    set_of_data, _ = load_patches(path_of_dataset)
+    time_of_pickle = time.perf_counter() - start
+    print("pickles : %d patches, %.1f MB loaded, %.3f s"
+          % (len(set_of_data), set_of_data.nbytes / 1e6, time_of_pickle))
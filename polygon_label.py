@@ -0,0 +1,185 @@
+""" Patch labels from the level 0 annotation polygons
+
+usage :
+    labeller = POLYGON_LABELLER(annotation_of_level0)
+    labeller.get_tumor_rate(x, y, w, h)       # one patch, level 0
+    labeller.get_tumor_rates(set_of_pos)      # N x 2 top-left, level 0
+
+    python polygon_label.py --slide b_1       # labels / sec and agreement
+                                              # with the level 4 raster
+
+The polygons stay in level 0 coordinates. Their bounding boxes are kept in
+a grid of buckets, so a patch away from every annotation is rejected with
+a dict lookup, and only a patch whose window meets a bounding box is
+rasterized, in a buffer of the patch size at the resolution of
+downsamples (1 is exact). Memory does not depend on the size of the slide.
+"""
+from __future__ import print_function
+
+import time
+import argparse
+
+import numpy as np
+import cv2
+
+# user define variable
+from user_define import Config as cf
+from user_define import Hyperparams as hp
+
+# fractional bits of the vertices given to cv2.fillPoly
+SHIFT = 4
+
+
+class POLYGON_LABELLER(object):
+    """
+    Tumor rate of patches from annotation polygons
+
+    Args:
+        annotation (list of N x 2 (x, y), level 0)
+        downsamples (float) pixel size of the window raster in level 0
+            pixels, 1 for exact labels
+        size_of_bucket (int) side of a bucket of the index, level 0
+    """
+
+    def __init__(self, annotation, downsamples=1, size_of_bucket=4096):
+        self.polygons = [np.asarray(p, dtype=np.float64).reshape(-1, 2)
+                         for p in annotation if len(p) > 0]
+        self.downsamples = float(downsamples)
+        self.size_of_bucket = size_of_bucket
+
+        # x_min, y_min, x_max, y_max of every polygon
+        self.boxes = np.array([[p[:, 0].min(), p[:, 1].min(),
+                                p[:, 0].max(), p[:, 1].max()]
+                               for p in self.polygons]).reshape(-1, 4)
+
+        self.buckets = {}
+        for i, (x0, y0, x1, y1) in enumerate(self.boxes):
+            for by in range(int(y0 // size_of_bucket),
+                            int(y1 // size_of_bucket) + 1):
+                for bx in range(int(x0 // size_of_bucket),
+                                int(x1 // size_of_bucket) + 1):
+                    self.buckets.setdefault((bx, by), []).append(i)
+
+        # longest x or y extent of a polygon edge, level 0
+        self.length_of_edge = max([np.abs(np.diff(p, axis=0, append=p[:1]))
+                                   .max() for p in self.polygons] + [0])
+
+        self.number_of_rejected = 0
+        self.number_of_rasterized = 0
+
+    """
+    return : indices of the polygons whose bounding box meets the window
+    """
+    def get_candidates(self, x, y, w, h):
+        size = self.size_of_bucket
+        candidates = set()
+        for by in range(int(y // size), int((y + h - 1) // size) + 1):
+            for bx in range(int(x // size), int((x + w - 1) // size) + 1):
+                candidates.update(self.buckets.get((bx, by), ()))
+        return [i for i in sorted(candidates)
+                if self.boxes[i, 0] < x + w and self.boxes[i, 2] >= x and
+                self.boxes[i, 1] < y + h and self.boxes[i, 3] >= y]
+
+    """
+    param : x, y (top-left), w, h of the patch, level 0
+
+    return : ratio of the patch inside the annotation (0 to 1)
+    """
+    def get_tumor_rate(self, x, y, w, h):
+        candidates = self.get_candidates(x, y, w, h)
+        if not candidates:
+            self.number_of_rejected += 1
+            return 0.
+        self.number_of_rasterized += 1
+
+        downsamples = self.downsamples
+        width = max(1, int(round(w / downsamples)))
+        height = max(1, int(round(h / downsamples)))
+        # cv2 also draws the outline and a clipped edge is drawn differently,
+        # so the edges crossing the patch are drawn whole in a margin
+        # (up to the patch size, past that it is a boundary pixel or two)
+        margin = min(int(np.ceil(self.length_of_edge / downsamples)) + 1,
+                     max(width, height))
+        window = np.zeros((height + 2 * margin, width + 2 * margin),
+                          dtype=np.uint8)
+        # all polygons in one call, same fill rule as cv2.drawContours
+        # of the whole annotation
+        origin = (x - margin * downsamples, y - margin * downsamples)
+        list_of_pts = [np.round((self.polygons[i] - origin) / downsamples
+                                * (1 << SHIFT)).astype(np.int32)
+                       for i in candidates]
+        cv2.fillPoly(window, list_of_pts, 1, 8, SHIFT)
+        window = window[margin:margin + height, margin:margin + width]
+        return window.sum() / float(width * height)
+
+    """
+    param : set_of_pos (N x 2 top-left, level 0)
+
+    return : tumor rate of each patch (N,)
+    """
+    def get_tumor_rates(self, set_of_pos, patch_size=hp.patch_size):
+        w, h = patch_size
+        return np.array([self.get_tumor_rate(x, y, w, h)
+                         for x, y in np.asarray(set_of_pos).reshape(-1, 2)],
+                        dtype=np.float64)
+
+    def get_report(self):
+        total = max(1, self.number_of_rejected + self.number_of_rasterized)
+        return {'rejected': self.number_of_rejected,
+                'rasterized': self.number_of_rasterized,
+                'ratio_of_rejected': self.number_of_rejected / float(total)}
+
+
+if __name__ == "__main__":
+    from create_dataset import CAMELYON_PREPRO
+
+    parser = argparse.ArgumentParser(description='Polygon labeller benchmark')
+    parser.add_argument('--slide', default='b_1')
+    parser.add_argument('--patches', type=int, default=20000,
+                        help='random positions, half of them in the tumor')
+    args = parser.parse_args()
+
+    prepro = CAMELYON_PREPRO.__new__(CAMELYON_PREPRO)
+    prepro.load_slide(args.slide)
+    w, h = hp.patch_size
+    col, row = prepro.slide.level_dimensions[0]
+
+    start = time.perf_counter()
+    tumor_mask = prepro.create_tumor_mask()
+    time_of_raster = time.perf_counter() - start
+
+    # half near the annotation, half anywhere on the slide
+    rng = np.random.RandomState(0)
+    xs, ys = tumor_mask.sample(min(args.patches // 2,
+                                   tumor_mask.count_nonzero()), rng)
+    near = np.stack([xs, ys], 1) * prepro.downsamples - (w // 2, h // 2)
+    anywhere = rng.randint(0, [col - w, row - h], (args.patches - len(near), 2))
+    set_of_pos = np.concatenate([near, anywhere])
+
+    start = time.perf_counter()
+    downsamples = prepro.downsamples
+    min_x = np.maximum(0, (set_of_pos[:, 0] / downsamples).astype(np.int64))
+    min_y = np.maximum(0, (set_of_pos[:, 1] / downsamples).astype(np.int64))
+    rate_of_raster = tumor_mask.window_sums(
+        min_x, min_y, int(w / downsamples), int(h / downsamples)) / \
+        float(int(w / downsamples) * int(h / downsamples))
+    time_of_raster += time.perf_counter() - start
+
+    start = time.perf_counter()
+    labeller = POLYGON_LABELLER(
+        prepro.get_annotation_from_xml(prepro.xml_path, 1))
+    rate_of_polygon = labeller.get_tumor_rates(set_of_pos)
+    time_of_polygon = time.perf_counter() - start
+
+    threshold = hp.threshold_of_tumor_rate
+    agree = np.mean((rate_of_raster > threshold) ==
+                    (rate_of_polygon > threshold))
+    print("%-22s %10s %14s" % ('labeller', 'seconds', 'patches/sec'))
+    print("%-22s %10.3f %14.1f" % ('level %d raster' % prepro.level,
+                                   time_of_raster,
+                                   len(set_of_pos) / time_of_raster))
+    print("%-22s %10.3f %14.1f" % ('level 0 polygon', time_of_polygon,
+                                   len(set_of_pos) / time_of_polygon))
+    print("label agreement : %.4f, mean |rate diff| : %.4f"
+          % (agree, np.abs(rate_of_raster - rate_of_polygon).mean()))
+    print(labeller.get_report())
@@ -25,9 +25,6 @@ import matplotlib
 import matplotlib.pyplot as plt
 import pylab
 
-from load_dataset import *
-
-
 import csv
 from user_define import Config as cf
 from user_define import Hyperparams as hp
@@ -43,98 +40,27 @@ from operator import methodcaller
 
 import cv2
 
-def get_interest_region(tissue_mask, o_knl=5, c_knl=9):
-    open_knl = np.ones((o_knl, o_knl), dtype=np.uint8)
-    close_knl = np.ones((c_knl, c_knl), dtype=np.uint8)
-
-    tissue_mask = cv2.morphologyEx(tissue_mask, cv2.MORPH_OPEN, open_knl)
-    tissue_mask = cv2.morphologyEx(tissue_mask, cv2.MORPH_CLOSE, close_knl)
-
-    _, contours, hierarchy = cv2.findContours(tissue_mask,
-                                              cv2.RETR_EXTERNAL,
-                                              cv2.CHAIN_APPROX_SIMPLE)
-
-    cv2.imwrite("tissue_mask.jpg", tissue_mask)
-
-    xmax = 0
-    ymax = 0
-    xmin = sys.maxsize
-    ymin = sys.maxsize
-
-    #print("in makeRECT")
-    for i in contours:
-        x, y, w, h = cv2.boundingRect(i)
-        if(x > xmax):
-            xmax = x
-        elif(x < xmin):
-            xmin = x
-
-        if(y > ymax):
-            ymax = y
-        elif(y < ymin):
-            ymin = y
-
-    return xmin, ymin, xmax, ymax
-
-
-def create_tissue_mask(slide):
-    level = cf.level_for_preprocessing
-
-    col, row = slide.level_dimensions[level]
-
-    img = np.array(slide.read_region((0, 0), level, (col, row)))
-    img = cv2.cvtColor(img, cv2.COLOR_RGBA2RGB)
-    img = cv2.cvtColor(img, cv2.COLOR_RGB2HSV)
-    img = img[:, :, 1]
+from slide_catalog import slide_catalog
+# the test grid, importable without models/ (see tissue_grid.py)
+from tissue_grid import clean_tissue_mask, get_regions_of_interest
+from tissue_grid import get_grid_in_regions, get_pos_of_patch_in_tissue
+from tissue_grid import get_params_of_grid, get_pos_of_patch_of_slide
+from tissue_grid import create_tissue_mask, get_pos_of_patch_for_eval
+from tissue_grid import determine_is_background
 
-    _, tissue_mask = cv2.threshold(img,
-                                   0,
-                                   255,
-                                   cv2.THRESH_BINARY + cv2.THRESH_OTSU)
 
+def get_interest_region(tissue_mask, o_knl=5, c_knl=9):
+    cv2.imwrite("tissue_mask.jpg", clean_tissue_mask(tissue_mask, o_knl, c_knl))
 
-    return tissue_mask
-
-
-def get_pos_of_patch_for_eval(slide, mask, set_of_pos):
-    level = cf.level_for_preprocessing
-    downsamples = 2 ** level
-    gap = int(304 / downsamples)
-
-    # print(mask.shape)
-    length = len(set_of_pos)
-
-    set_of_real_pos = []
-    set_of_patch = []
-
-    j = 0
-
-    for i in range(length):
-        x, y = set_of_pos[i]
-        x_, y_ = (x + gap), (y + gap)
-        patch = mask[y:y_, x:x_]
-        if determine_is_background(patch):
-            continue
-        else:
-            xreal, yreal = x * downsamples, y * downsamples
-            set_of_real_pos.append((xreal, yreal))
-            j = j + 1
-        print("\r %d/%d correct : %d" % (i, length, j), end="")
-
-    print("\n")
-    return set_of_real_pos
-
-
-def determine_is_background(patch):
-    area = patch.size
-    _sum = np.sum(patch)
-
-    ratio = _sum / area
+    set_of_region = get_regions_of_interest(tissue_mask, o_knl, c_knl)
+    if len(set_of_region) == 0:
+        return sys.maxsize, sys.maxsize, 0, 0
 
-    if ratio > cf.ratio_of_tissue_area:
-        return False  # is not background
-    else:
-        return True
+    # one box around every component
+    set_of_region = np.array(set_of_region)
+    xmin, ymin = set_of_region[:, :2].min(axis=0)
+    xmax, ymax = set_of_region[:, 2:].max(axis=0)
+    return int(xmin), int(ymin), int(xmax), int(ymax)
 
 
 def draw_patch_pos_on_thumbnail(set_of_real_pos, thumbnail, downsamples, slide_fn):
@@ -157,8 +83,7 @@ def draw_patch_pos_on_thumbnail(set_of_real_pos, thumbnail, downsamples, slide_f
 
 if __name__ == "__main__":
     for slide_fn in cf.list_of_slide_for_task2:
-        target_path = os.path.join(cf.path_of_task_2, slide_fn + ".tif")
-        slide = openslide.OpenSlide(target_path)
+        slide = openslide.OpenSlide(slide_catalog.get_path(slide_fn))
         level = cf.level_for_preprocessing
         downsamples = int(slide.level_downsamples[level])
 
@@ -168,17 +93,7 @@ if __name__ == "__main__":
 
         print(x_min, y_min, x_max, y_max)
 
-        stride = cf.stride_for_heatmap
-        stride_rescale = int(stride / downsamples)
-
-        set_of_pos = [(x, y) for x in range(x_min, x_max, stride_rescale)
-                      for y in range(y_min, y_max, stride_rescale)]
-
-        set_of_real_pos = get_pos_of_patch_for_eval(slide,
-                                                    tissue_mask,
-                                                    set_of_pos)
-
-        set_of_real_pos = np.array(set_of_real_pos)
+        set_of_real_pos = get_pos_of_patch_in_tissue(slide, tissue_mask)
 
         print(set_of_real_pos.shape)
 
@@ -0,0 +1,250 @@
+""" Named timers and counters for the hot paths of the pipeline.
+
+usage :
+    from profiler import profiler
+
+    with profiler.timer('read_region'):
+        patch = slide.read_region(...)
+    profiler.count('patch_rejected')
+
+    profiler.dump('b_1')  # ./logs/profile/b_1.json (+ b_1.trace.json)
+
+Timers are no-ops until profiler.enable() is called (or cf.enable_profiling
+/ the CAMELYON_PROFILE environment variable is set to a value other than
+'0', 'false', 'no', 'off' or '' and enable_from_config() is called), so they
+can stay in the code.
+"""
+import os
+import json
+import math
+import time
+import threading
+import multiprocessing.util
+
+from user_define import Config as cf
+
+
+# durations are bucketed by powers of two from 1 us up to ~1.2 hours
+MIN_OF_BUCKET = 1e-6
+NUMBER_OF_BUCKET = 32
+MAX_TRACE_EVENTS = 1000000
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer(object):
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        if self.profiler.sync is not None:
+            self.profiler.sync()
+        self.profiler.record(self.name, self.start,
+                             time.perf_counter() - self.start)
+        return False
+
+
+class _Stage(object):
+    """count / total / min / max and a log2 histogram of durations"""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.
+        self.min = float('inf')
+        self.max = 0.
+        self.buckets = [0] * NUMBER_OF_BUCKET
+
+    def add(self, duration):
+        self.count += 1
+        self.total += duration
+        self.min = min(self.min, duration)
+        self.max = max(self.max, duration)
+        index = 0
+        if duration > MIN_OF_BUCKET:
+            index = int(math.log2(duration / MIN_OF_BUCKET))
+        self.buckets[min(index, NUMBER_OF_BUCKET - 1)] += 1
+
+    def merge(self, other):
+        self.count += other['count']
+        self.total += other['total_sec']
+        self.min = min(self.min, other['min_sec'])
+        self.max = max(self.max, other['max_sec'])
+        self.buckets = [a + b for a, b in zip(self.buckets, other['histogram'])]
+
+    def percentile(self, q):
+        """upper edge of the bucket that holds the q-th percentile"""
+        target = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= target and n:
+                return min(MIN_OF_BUCKET * 2 ** (i + 1), self.max)
+        return self.max
+
+    def to_dict(self):
+        return {'count': self.count,
+                'total_sec': self.total,
+                'mean_sec': self.total / self.count if self.count else 0.,
+                'min_sec': self.min if self.count else 0.,
+                'max_sec': self.max,
+                'p50_sec': self.percentile(0.5),
+                'p90_sec': self.percentile(0.9),
+                'p99_sec': self.percentile(0.99),
+                'histogram': self.buckets}
+
+
+class Profiler(object):
+
+    def __init__(self):
+        self.enabled = False
+        self.trace = False
+        self.sync = None
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.stages = {}
+        self.counters = {}
+        self.events = []
+        self.origin = time.perf_counter()
+
+    def enable(self, trace=False, sync=None):
+        """
+        param : trace (keep every span for a Chrome trace)
+                sync (called before a timer stops, ex) torch.cuda.synchronize)
+        """
+        self.enabled = True
+        self.trace = trace
+        self.sync = sync
+
+    def disable(self):
+        self.enabled = False
+
+    def timer(self, name):
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name)
+
+    def record(self, name, start, duration):
+        with self.lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = _Stage()
+            stage.add(duration)
+            if self.trace and len(self.events) < MAX_TRACE_EVENTS:
+                self.events.append({'name': name,
+                                    'ph': 'X',
+                                    'ts': (start - self.origin) * 1e6,
+                                    'dur': duration * 1e6,
+                                    'pid': os.getpid(),
+                                    'tid': threading.get_ident()})
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def get_report(self):
+        return {'pid': os.getpid(),
+                'stages': dict((name, stage.to_dict())
+                               for name, stage in self.stages.items()),
+                'counters': dict(self.counters)}
+
+    def dump(self, name, path=None):
+        """
+        write name.json (and name.trace.json when tracing) under path
+
+        return : path of the json report (None when disabled)
+        """
+        if not self.enabled:
+            return None
+        if path is None:
+            path = cf.path_of_profile
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        report_path = os.path.join(path, name + '.json')
+        with open(report_path, 'w') as fo:
+            json.dump(self.get_report(), fo, indent=2, sort_keys=True)
+
+        if self.trace:
+            trace_path = os.path.join(path, name + '.trace.json')
+            with open(trace_path, 'w') as fo:
+                json.dump({'traceEvents': self.events}, fo)
+
+        return report_path
+
+    def print_summary(self):
+        if not self.enabled:
+            return
+        print('%-24s %8s %10s %10s %10s' % ('stage', 'count', 'total(s)',
+                                            'mean(ms)', 'p90(ms)'))
+        for name, stage in sorted(self.stages.items(),
+                                  key=lambda item: -item[1].total):
+            d = stage.to_dict()
+            print('%-24s %8d %10.3f %10.3f %10.3f'
+                  % (name, d['count'], d['total_sec'],
+                     d['mean_sec'] * 1e3, d['p90_sec'] * 1e3))
+        for name, value in sorted(self.counters.items()):
+            print('%-24s %8d' % (name, value))
+
+    def worker_init_fn(self, worker_id):
+        """
+        DataLoader worker_init_fn: dump the worker's timers when it exits
+        """
+        if not self.enabled:
+            return
+        self.reset()
+        multiprocessing.util.Finalize(
+            self, self.dump,
+            args=('worker_%d_%d' % (worker_id, os.getpid()),),
+            exitpriority=10)
+
+
+def merge_reports(list_of_report_path):
+    """
+    param : list of json reports written by Profiler.dump
+
+    return : report (dict) with stages and counters summed over the inputs
+    """
+    stages = {}
+    counters = {}
+    for report_path in list_of_report_path:
+        with open(report_path) as fo:
+            report = json.load(fo)
+        for name, d in report['stages'].items():
+            stages.setdefault(name, _Stage()).merge(d)
+        for name, value in report['counters'].items():
+            counters[name] = counters.get(name, 0) + value
+    return {'stages': dict((name, stage.to_dict())
+                           for name, stage in stages.items()),
+            'counters': counters}
+
+
+profiler = Profiler()
+
+
+def is_enabled_by_env(name='CAMELYON_PROFILE'):
+    value = os.environ.get(name, '').strip().lower()
+    return value not in ('', '0', 'false', 'no', 'off')
+
+
+def enable_from_config(sync=None):
+    if cf.enable_profiling or is_enabled_by_env():
+        profiler.enable(trace=cf.save_chrome_trace, sync=sync)
+    return profiler.enabled
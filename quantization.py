@@ -0,0 +1,367 @@
+""" Post-training static int8 quantization for CPU slide inference
+
+usage :
+    python quantization.py                      # ./checkpoint/ckpt.pth.tar
+    python quantization.py --calibration 1024 --evaluation 4000
+    python infer_cpu.py --model ./checkpoint/export/patch_classifier_int8.pt
+
+ResNet (BasicBlock / Bottleneck) and DenseNet of models/ are supported.
+conv+bn(+relu) are fused, observers are calibrated on a random sample of the
+val patches, and the model is converted to int8 (fbgemm on x86, qnnpack on
+arm). The quantized model is wrapped in export.PATCH_CLASSIFIER and saved as
+TorchScript, so infer_cpu.py runs it like any exported model.
+
+Speedup (patches/sec) and the AUC delta against fp32 on val are reported.
+"""
+from __future__ import print_function
+
+import os
+import copy
+import time
+import argparse
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+try:
+    import torch.ao.quantization as quantization
+    from torch.ao.quantization.fuse_modules import fuse_known_modules
+except ImportError:
+    # torch < 1.10
+    import torch.quantization as quantization
+    from torch.quantization.fuse_modules import fuse_known_modules
+
+# user define variable
+from user_define import Config as cf
+from user_define import Hyperparams as hp
+
+from models.resnet import ResNet, BasicBlock, Bottleneck
+from models.densenet import DenseNet, _DenseLayer, _SizeHandle
+from export import PATCH_CLASSIFIER, load_net, export_torchscript
+from froc import compute_auc
+from load_dataset import load_patches
+from stain_norm import STAIN_NORMALIZER, normalize_patches
+
+
+class QUANTIZABLE_BASIC_BLOCK(nn.Module):
+    """BasicBlock with the residual add as FloatFunctional"""
+
+    def __init__(self, block):
+        super(QUANTIZABLE_BASIC_BLOCK, self).__init__()
+        self.conv1 = block.conv1
+        self.bn1 = block.bn1
+        self.relu = block.relu
+        self.conv2 = block.conv2
+        self.bn2 = block.bn2
+        self.downsample = block.downsample
+        self.stride = block.stride
+        self.skip_add = nn.quantized.FloatFunctional()
+
+    def forward(self, x):
+        residual = x
+
+        out = self.relu(self.bn1(self.conv1(x)))
+        out = self.bn2(self.conv2(out))
+
+        if self.downsample is not None:
+            residual = self.downsample(x)
+
+        return self.skip_add.add_relu(out, residual)
+
+    def fuse(self):
+        fuse(self, ['conv1', 'bn1', 'relu'])
+        fuse(self, ['conv2', 'bn2'])
+        if self.downsample is not None:
+            fuse(self.downsample, ['0', '1'])
+
+
+class QUANTIZABLE_BOTTLENECK(nn.Module):
+    """Bottleneck with its own ReLUs and the residual add as FloatFunctional"""
+
+    def __init__(self, block):
+        super(QUANTIZABLE_BOTTLENECK, self).__init__()
+        self.conv1 = block.conv1
+        self.bn1 = block.bn1
+        self.relu1 = nn.ReLU()
+        self.conv2 = block.conv2
+        self.bn2 = block.bn2
+        self.relu2 = nn.ReLU()
+        self.conv3 = block.conv3
+        self.bn3 = block.bn3
+        self.downsample = block.downsample
+        self.stride = block.stride
+        self.skip_add = nn.quantized.FloatFunctional()
+
+    def forward(self, x):
+        residual = x
+
+        out = self.relu1(self.bn1(self.conv1(x)))
+        out = self.relu2(self.bn2(self.conv2(out)))
+        out = self.bn3(self.conv3(out))
+
+        if self.downsample is not None:
+            residual = self.downsample(x)
+
+        return self.skip_add.add_relu(out, residual)
+
+    def fuse(self):
+        fuse(self, ['conv1', 'bn1', 'relu1'])
+        fuse(self, ['conv2', 'bn2', 'relu2'])
+        fuse(self, ['conv3', 'bn3'])
+        if self.downsample is not None:
+            fuse(self.downsample, ['0', '1'])
+
+
+class QUANTIZABLE_DENSE_LAYER(nn.Module):
+    """_DenseLayer with the concatenation as FloatFunctional"""
+
+    def __init__(self, layer):
+        super(QUANTIZABLE_DENSE_LAYER, self).__init__()
+        # names of _DenseLayer contain '.', which torch.jit.trace can not
+        # resolve, so its layers are kept as '0', '1', ... in order
+        list_of_name = list(layer._modules)
+        self.layers = nn.Sequential(*[layer._modules[name]
+                                      for name in list_of_name])
+        self.index_of_name = {name: str(i)
+                              for i, name in enumerate(list_of_name)}
+        self.drop_rate = layer.drop_rate
+        self.cat = nn.quantized.FloatFunctional()
+
+    def forward(self, x):
+        new_features = self.layers(x)
+        if self.drop_rate > 0:
+            new_features = F.dropout(new_features, p=self.drop_rate,
+                                     training=self.training)
+        return self.cat.cat([x, new_features], 1)
+
+    def fuse(self):
+        # pre-activation: only conv.1 is followed by bn and relu
+        fuse(self.layers, [self.index_of_name[name]
+                           for name in ('conv.1', 'norm.2', 'relu.2')])
+
+
+class QUANTIZED_WRAPPER(nn.Module):
+    """quantize the input, the model dequantizes before its sigmoid"""
+
+    def __init__(self, net):
+        super(QUANTIZED_WRAPPER, self).__init__()
+        self.quant = quantization.QuantStub()
+        self.net = net
+        self.net.sigmoid = nn.Sequential(quantization.DeQuantStub(),
+                                         net.sigmoid)
+
+    def forward(self, x):
+        return self.net(self.quant(x))
+
+
+"""
+fuse the children of module named in list_of_name, in place (the names can
+contain '.', unlike torch.quantization.fuse_modules)
+"""
+def fuse(module, list_of_name):
+    list_of_module = [module._modules[name] for name in list_of_name]
+    try:
+        fused = fuse_known_modules(list_of_module, is_qat=False)
+    except TypeError:
+        # torch < 1.11
+        fused = fuse_known_modules(list_of_module)
+    for name, new_module in zip(list_of_name, fused):
+        module._modules[name] = new_module
+
+
+def _replace_children(module, replace):
+    for name, child in list(module._modules.items()):
+        new_child = replace(child)
+        if new_child is not None:
+            module._modules[name] = new_child
+        else:
+            _replace_children(child, replace)
+
+
+def _to_quantizable(module):
+    if type(module) is BasicBlock:
+        return QUANTIZABLE_BASIC_BLOCK(module)
+    if type(module) is Bottleneck:
+        return QUANTIZABLE_BOTTLENECK(module)
+    if type(module) is _DenseLayer:
+        return QUANTIZABLE_DENSE_LAYER(module)
+    if type(module) is _SizeHandle:
+        # replication pad has no int8 kernel, run it in float
+        return nn.Sequential(quantization.DeQuantStub(), module,
+                             quantization.QuantStub())
+    return None
+
+
+"""
+param : net (fp32 ResNet or DenseNet, not modified)
+
+return : fused copy, in eval mode, ready for prepare()
+"""
+def make_quantizable(net):
+    if not isinstance(net, (ResNet, DenseNet)):
+        raise RuntimeError("quantization supports ResNet and DenseNet, not "
+                           + type(net).__name__)
+    net = copy.deepcopy(net).cpu()
+    _replace_children(net, _to_quantizable)
+    # the ReLUs added by the quantizable blocks start in train mode
+    net.eval()
+
+    if isinstance(net, ResNet):
+        fuse(net, ['conv1', 'bn1', 'relu'])
+    else:
+        fuse(net.features, ['conv0', 'norm0', 'relu0'])
+    for module in net.modules():
+        if isinstance(module, (QUANTIZABLE_BASIC_BLOCK, QUANTIZABLE_BOTTLENECK,
+                               QUANTIZABLE_DENSE_LAYER)):
+            module.fuse()
+
+    return QUANTIZED_WRAPPER(net)
+
+
+def get_backend():
+    supported = torch.backends.quantized.supported_engines
+    for engine in ('x86', 'fbgemm', 'qnnpack'):
+        if engine in supported:
+            return engine
+    raise RuntimeError("no quantized engine is available")
+
+
+"""
+param : net (fp32)
+        calibration_patches (uint8, N x H x W x 3)
+
+return : int8 model (input float NCHW in [0, 1], output prob)
+"""
+def quantize(net, calibration_patches, batch_size=hp.batch_size_for_eval,
+             backend=None):
+    backend = backend or get_backend()
+    torch.backends.quantized.engine = backend
+
+    model = make_quantizable(net)
+    model.qconfig = quantization.get_default_qconfig(backend)
+    quantization.prepare(model, inplace=True)
+
+    with torch.no_grad():
+        for i in range(0, len(calibration_patches), batch_size):
+            patch = torch.from_numpy(calibration_patches[i:i + batch_size])
+            model(patch.permute(0, 3, 1, 2).float().div(255.))
+
+    quantization.convert(model, inplace=True)
+    return model
+
+
+"""
+param : number_of_patch (int) sampled without replacement, all if larger
+
+return : patches (uint8, stain normalized with hp.use_stain_normalization,
+         as infer_cpu.py feeds them), labels, only the sampled rows are read
+"""
+def load_val_patches(number_of_patch, seed=0):
+    data, labels, list_of_slide, slide_index = load_patches(
+        cf.path_of_val_dataset, return_slide=True, lazy=True)
+
+    rng = np.random.RandomState(seed)
+    index = rng.permutation(len(data))[:number_of_patch]
+    patches = data[index]
+    if hp.use_stain_normalization:
+        stain = STAIN_NORMALIZER(list_of_slide, slide_index)
+        patches = normalize_patches(stain, patches, index)
+    return patches, labels[index]
+
+
+def predict(wrapper, patches, batch_size=hp.batch_size_for_eval):
+    set_of_prob = []
+    with torch.no_grad():
+        for i in range(0, len(patches), batch_size):
+            prob, _ = wrapper(torch.from_numpy(patches[i:i + batch_size]))
+            set_of_prob.append(prob.numpy())
+    return np.concatenate(set_of_prob)
+
+
+def get_patches_per_sec(wrapper, patch, number_of_batch):
+    x = torch.from_numpy(patch)
+    with torch.no_grad():
+        wrapper(x)  # warm up
+        start = time.perf_counter()
+        for _ in range(number_of_batch):
+            wrapper(x)
+    return len(patch) * number_of_batch / (time.perf_counter() - start)
+
+
+"""
+return : dict of patches/sec, speedup, AUC of fp32 and int8 and their delta
+"""
+def get_report(fp32, int8, patches, labels, batch_size, number_of_batch):
+    bench_patch = patches[:batch_size]
+    fp32_rate = get_patches_per_sec(fp32, bench_patch, number_of_batch)
+    int8_rate = get_patches_per_sec(int8, bench_patch, number_of_batch)
+
+    fp32_prob = predict(fp32, patches, batch_size)
+    int8_prob = predict(int8, patches, batch_size)
+    fp32_auc = compute_auc(fp32_prob, labels)
+    int8_auc = compute_auc(int8_prob, labels)
+
+    return {'fp32_patches_per_sec': fp32_rate,
+            'int8_patches_per_sec': int8_rate,
+            'speedup': int8_rate / fp32_rate,
+            'fp32_auc': fp32_auc,
+            'int8_auc': int8_auc,
+            'auc_delta': int8_auc - fp32_auc,
+            'max_prob_diff': float(np.abs(fp32_prob - int8_prob).max())}
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='int8 quantization')
+    parser.add_argument('--checkpoint', default=cf.path_of_checkpoint)
+    parser.add_argument('--arch', default=None,
+                        help='needed for state_dict checkpoints')
+    parser.add_argument('--calibration', type=int,
+                        default=cf.number_of_patch_for_calibration,
+                        help='val patches used to calibrate the observers')
+    parser.add_argument('--evaluation', type=int, default=2000,
+                        help='val patches used for the AUC delta')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--batches', type=int, default=5,
+                        help='batches timed for patches/sec')
+    parser.add_argument('--threads', type=int, default=0)
+    parser.add_argument('--backend', default=None,
+                        help='fbgemm / x86 / qnnpack, default by platform')
+    parser.add_argument('--output', default=os.path.join(
+        cf.path_of_export, 'patch_classifier_int8.pt'))
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    net = load_net(args.checkpoint, args.arch)
+
+    patches, labels = load_val_patches(args.calibration + args.evaluation)
+    calibration_patches = patches[:args.calibration]
+    patches, labels = patches[args.calibration:], labels[args.calibration:]
+
+    start_time = time.time()
+    model = quantize(net, calibration_patches, args.batch_size, args.backend)
+    print("quantization is end, Running time is : %.2f"
+          % (time.time() - start_time))
+
+    fp32 = PATCH_CLASSIFIER(net).eval()
+    int8 = PATCH_CLASSIFIER(model).eval()
+
+    if not os.path.isdir(os.path.dirname(args.output)):
+        os.makedirs(os.path.dirname(args.output))
+    export_torchscript(int8, args.output)
+    print("int8 TorchScript is saved at", args.output)
+
+    report = get_report(fp32, int8, patches, labels, args.batch_size,
+                        args.batches)
+    print("fp32 %.1f patches/sec, int8 %.1f patches/sec, speedup %.2f"
+          % (report['fp32_patches_per_sec'], report['int8_patches_per_sec'],
+             report['speedup']))
+    print("AUC fp32 %.4f, int8 %.4f, delta %+.4f (max prob diff %.4f)"
+          % (report['fp32_auc'], report['int8_auc'], report['auc_delta'],
+             report['max_prob_diff']))
@@ -0,0 +1,208 @@
+""" Region-batched patch reads for slide inference
+
+usage :
+    reader = REGION_READER(slide, set_of_pos)
+    for list_of_region in reader.split(batch_size):
+        patches, pos = reader.read(list_of_region)    # N x H x W x 3, N x 2
+
+    python region_reader.py --slide ./Data/task/task_2/t_1.tif   # benchmark
+
+The grid positions of a slide are grouped into aligned regions of up to
+patches_per_side x patches_per_side patches. Each region is read with one
+read_region call (the tiles under it are decoded once, also where patches
+overlap) and converted to RGB once, and the patches are NumPy views into
+that buffer, so the only copy is into the batch array. Regions mostly made
+of background are split (min_fill), reading them would cost more pixels
+than it saves calls.
+"""
+from __future__ import print_function
+
+import time
+import argparse
+
+import numpy as np
+import openslide
+
+# user define variable
+from user_define import Config as cf
+from user_define import Hyperparams as hp
+
+
+def _group_by_cell(pos, index, span):
+    cell = (pos[index] - pos.min(axis=0)) // span
+    key = cell[:, 1] * (cell[:, 0].max() + 1) + cell[:, 0]
+    order = np.argsort(key, kind='stable')
+    boundary = np.flatnonzero(np.diff(key[order])) + 1
+    return np.split(index[order], boundary)
+
+
+"""
+param : set_of_pos (N x 2, level 0 top-left of the patches)
+        span (int) side of a region in level 0 pixels
+        patch_size (tuple) (w, h)
+        min_fill (float) a region whose patches cover less of its bounding
+            box (sparse tissue, background left out of the grid) is split
+            in four, down to single patches, so pixels are not read for
+            nothing
+
+return : list of index arrays, one per region, regions in row-major order
+"""
+def group_by_region(set_of_pos, span, patch_size=hp.patch_size, min_fill=0.9):
+    pos = np.asarray(set_of_pos, dtype=np.int64).reshape(-1, 2)
+    if len(pos) == 0:
+        return []
+    w, h = patch_size
+
+    regions = []
+    stack = [(index, span) for index in
+             reversed(_group_by_cell(pos, np.arange(len(pos)), span))]
+    while stack:
+        index, span_of_region = stack.pop()
+        x, y = pos[index, 0], pos[index, 1]
+        area = (x.max() - x.min() + w) * (y.max() - y.min() + h)
+        if len(index) > 1 and len(index) * w * h < min_fill * area:
+            sub_span = max(1, span_of_region // 2)
+            stack.extend((sub_index, sub_span) for sub_index in
+                         reversed(_group_by_cell(pos, index, sub_span)))
+        else:
+            regions.append(index)
+    return regions
+
+
+class REGION_READER(object):
+    """
+    Read the patches of a slide region by region
+
+    Args:
+        slide (OpenSlide or path)
+        set_of_pos (N x 2, level 0)
+        patch_size (tuple) (w, h)
+        patches_per_side (int) patches per side of a region
+        stride (int) distance of the grid positions in level 0
+    """
+
+    def __init__(self, slide, set_of_pos, patch_size=hp.patch_size,
+                 patches_per_side=hp.patches_per_side_of_region,
+                 stride=cf.stride_for_heatmap):
+        if not isinstance(slide, openslide.OpenSlide):
+            slide = openslide.OpenSlide(slide)
+        self.slide = slide
+        self.pos = np.asarray(set_of_pos, dtype=np.int64).reshape(-1, 2)
+        self.patch_size = patch_size
+        self.regions = group_by_region(self.pos,
+                                       stride * max(1, patches_per_side),
+                                       patch_size)
+
+        w, h = patch_size
+        # bounding box of the patches of each region, x, y, w, h
+        self.boxes = np.array(
+            [[self.pos[i, 0].min(), self.pos[i, 1].min(),
+              self.pos[i, 0].max() + w - self.pos[i, 0].min(),
+              self.pos[i, 1].max() + h - self.pos[i, 1].min()]
+             for i in self.regions], dtype=np.int64).reshape(-1, 4)
+
+    def __len__(self):
+        return len(self.regions)
+
+    """
+    param : i (index of the region)
+
+    return : RGB of the region (uint8, H x W x 3)
+    """
+    def read_region(self, i):
+        x, y, w, h = self.boxes[i]
+        region = self.slide.read_region((int(x), int(y)), 0, (int(w), int(h)))
+        # one conversion per region, the patches are contiguous rows of it
+        return np.asarray(region.convert('RGB'))
+
+    """
+    yield (pos, patch) of a region, patch is a view into the region
+    """
+    def iter_patches(self, i):
+        rgb = self.read_region(i)
+        x, y = self.boxes[i, :2]
+        w, h = self.patch_size
+        for px, py in self.pos[self.regions[i]]:
+            yield (px, py), rgb[py - y:py - y + h, px - x:px - x + w]
+
+    """
+    param : list_of_region (indices of regions)
+
+    return : patches (uint8, N x H x W x 3), pos (N x 2), in region order
+    """
+    def read(self, list_of_region):
+        w, h = self.patch_size
+        num_of_patch = sum(len(self.regions[i]) for i in list_of_region)
+        patches = np.empty((num_of_patch, h, w, 3), dtype=np.uint8)
+        set_of_pos = np.empty((num_of_patch, 2), dtype=np.int64)
+        n = 0
+        for i in list_of_region:
+            for pos, patch in self.iter_patches(i):
+                patches[n] = patch
+                set_of_pos[n] = pos
+                n += 1
+        return patches, set_of_pos
+
+    """
+    return : list of lists of regions, each at most batch_size patches
+             (a region bigger than batch_size is a batch alone)
+    """
+    def split(self, batch_size=hp.batch_size_for_eval):
+        set_of_batch = []
+        batch, size = [], 0
+        for i, index in enumerate(self.regions):
+            if batch and size + len(index) > batch_size:
+                set_of_batch.append(batch)
+                batch, size = [], 0
+            batch.append(i)
+            size += len(index)
+        if batch:
+            set_of_batch.append(batch)
+        return set_of_batch
+
+
+"""
+seconds to read every patch one by one (as CUSTOM_DATASET 'test') and
+region by region
+"""
+def benchmark(slide_path, set_of_pos, list_of_patches_per_side=(1, 4, 8)):
+    slide = openslide.OpenSlide(slide_path)
+
+    start = time.perf_counter()
+    for x, y in set_of_pos:
+        np.array(slide.read_region((int(x), int(y)), 0,
+                                   hp.patch_size).convert('RGB'))
+    per_patch = time.perf_counter() - start
+    print("%-12s %10s %14s" % ('reader', 'seconds', 'patches/sec'))
+    print("%-12s %10.3f %14.1f" % ('per patch', per_patch,
+                                   len(set_of_pos) / per_patch))
+
+    result = {'per_patch': per_patch}
+    for patches_per_side in list_of_patches_per_side:
+        start = time.perf_counter()
+        reader = REGION_READER(slide, set_of_pos,
+                               patches_per_side=patches_per_side)
+        for list_of_region in reader.split():
+            reader.read(list_of_region)
+        seconds = time.perf_counter() - start
+        print("%-12s %10.3f %14.1f" % ('region %dx%d' % (patches_per_side,
+                                                          patches_per_side),
+                                       seconds, len(set_of_pos) / seconds))
+        result[patches_per_side] = seconds
+    return result
+
+
+if __name__ == "__main__":
+    from infer_cpu import get_pos_of_slide
+
+    parser = argparse.ArgumentParser(description='Region reader benchmark')
+    parser.add_argument('--slide', required=True)
+    parser.add_argument('--patches', type=int, default=0,
+                        help='first n grid positions, 0 for all')
+    parser.add_argument('--sides', type=int, nargs='+', default=[1, 4, 8])
+    args = parser.parse_args()
+
+    set_of_pos = get_pos_of_slide(openslide.OpenSlide(args.slide))
+    if args.patches > 0:
+        set_of_pos = set_of_pos[:args.patches]
+    benchmark(args.slide, set_of_pos, args.sides)
@@ -0,0 +1,251 @@
+""" Catalog of the slides and of their metadata, kept in one json
+
+usage :
+    from slide_catalog import slide_catalog
+    slide_catalog.get_path('b_1')             # './Data/slide/b_1.tif'
+    record = slide_catalog.get('t_4')         # level_dimensions, mpp, ...
+    slide_catalog.add_artifact('t_4', 'test_grid', path)
+
+    python slide_catalog.py                   # scan the slide folders
+    python slide_catalog.py --slides b_1 t_4  # show records
+
+A slide is opened once, the first time it is asked for; its record (path,
+bytes, mtime, levels, downsamples, MPP, vendor, annotation xml) is added
+to cf.path_of_slide_catalog. Later calls, from any script, read the record
+without opening the slide, and it is rebuilt when the file changes (size
+or mtime), which also drops the artifacts (cached results of the slide,
+name -> path) registered by add_artifact. Every change is a read-merge-write
+of the json under an flock of $CATALOG.lock, so the pool workers of
+create_dataset.py do not lose each other's records.
+"""
+from __future__ import print_function
+
+import os
+import json
+import fcntl
+import argparse
+from contextlib import contextmanager
+
+import openslide
+
+# user define variable
+from user_define import Config as cf
+
+
+EXTENSION_OF_SLIDE = '.tif'
+
+
+"""
+return : list of folders searched for a slide name, in order
+"""
+def get_folders_of_slide():
+    return [cf.path_of_slide, cf.path_of_task_2]
+
+
+"""
+param : name (string) ex) 'b_1'
+        path (string) of the slide file
+
+return : record (dict), from the slide file
+"""
+def create_record(name, path):
+    slide = openslide.OpenSlide(path)
+    stat = os.stat(path)
+    properties = slide.properties
+
+    def get_float(key):
+        value = properties.get(key)
+        return float(value) if value else None
+
+    path_of_annotation = os.path.join(cf.path_of_annotation, name + '.xml')
+    return {'name': name,
+            'path': path,
+            'bytes': stat.st_size,
+            'mtime': stat.st_mtime,
+            'level_count': slide.level_count,
+            'level_dimensions': [list(d) for d in slide.level_dimensions],
+            'level_downsamples': list(slide.level_downsamples),
+            'mpp_x': get_float(openslide.PROPERTY_NAME_MPP_X),
+            'mpp_y': get_float(openslide.PROPERTY_NAME_MPP_Y),
+            'vendor': properties.get(openslide.PROPERTY_NAME_VENDOR),
+            'annotation': (path_of_annotation
+                           if os.path.isfile(path_of_annotation) else None),
+            'artifacts': {}}
+
+
+"""
+return : True if the record is of the file as it is now
+"""
+def is_fresh(record, path, stat):
+    return (record is not None and record['path'] == path and
+            record['bytes'] == stat.st_size and
+            record['mtime'] == stat.st_mtime)
+
+
+@contextmanager
+def lock_of_file(path):
+    with open(path + '.lock', 'a') as fo:
+        fcntl.flock(fo, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fo, fcntl.LOCK_UN)
+
+
+class SLIDE_CATALOG(object):
+    """
+    Slide name -> record, loaded from and saved to a json file
+
+    Args:
+        path_of_catalog (string) default cf.path_of_slide_catalog, read when
+            the catalog is first used (so a script can change cf before)
+    """
+
+    def __init__(self, path_of_catalog=None):
+        self.path_of_catalog = path_of_catalog
+        self.path_of_loaded = None
+        self.records = None
+
+    def get_path_of_catalog(self):
+        return self.path_of_catalog or cf.path_of_slide_catalog
+
+    def load(self):
+        path = self.get_path_of_catalog()
+        if self.records is None or self.path_of_loaded != path:
+            self.records = {}
+            if os.path.isfile(path):
+                with open(path) as fo:
+                    self.records = json.load(fo)
+            self.path_of_loaded = path
+        return self.records
+
+    """
+    change one record of the file, under the lock (the pool workers of
+    create_dataset.py add slides and artifacts at the same time)
+
+    param : name (string) of the slide
+            update (function) record in the file now (None if missing) ->
+                new record
+
+    return : new record
+    """
+    def save(self, name, update):
+        path = self.get_path_of_catalog()
+        folder = os.path.dirname(path)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+
+        with lock_of_file(path):
+            records = {}
+            if os.path.isfile(path):
+                with open(path) as fo:
+                    records = json.load(fo)
+            records[name] = update(records.get(name))
+
+            path_of_tmp = "%s.%d.tmp" % (path, os.getpid())
+            with open(path_of_tmp, 'w') as fo:
+                json.dump(records, fo, indent=2, sort_keys=True)
+            os.replace(path_of_tmp, path)
+
+        self.records = records
+        self.path_of_loaded = path
+        return records[name]
+
+    """
+    param : name (string) slide name ex) 'b_1', or path of a slide
+
+    return : name, path of the slide file
+    """
+    def resolve(self, name):
+        if os.path.isfile(name):
+            return (os.path.splitext(os.path.basename(name))[0], name)
+        record = self.load().get(name)
+        if record is not None and os.path.isfile(record['path']):
+            return name, record['path']
+        for folder in get_folders_of_slide():
+            path = os.path.join(folder, name + EXTENSION_OF_SLIDE)
+            if os.path.isfile(path):
+                return name, path
+        raise RuntimeError("slide %s is not in %s"
+                           % (name, ", ".join(get_folders_of_slide())))
+
+    """
+    return : record of the slide, the slide is opened only when the record
+             is missing or the file changed
+    """
+    def get(self, name):
+        name, path = self.resolve(name)
+        record = self.load().get(name)
+        stat = os.stat(path)
+        if is_fresh(record, path, stat):
+            return record
+
+        # opened outside the lock, a record written meanwhile by another
+        # worker is kept (with its artifacts)
+        record = create_record(name, path)
+        return self.save(name, lambda current: current
+                         if is_fresh(current, path, stat) else record)
+
+    def get_path(self, name):
+        return self.get(name)['path']
+
+    """
+    param : key (string) ex) 'stain_params', 'test_grid'
+            path (string) of the cached result
+    """
+    def add_artifact(self, name, key, path):
+        record = self.get(name)
+
+        def update(current):
+            if current is None or current['path'] != record['path']:
+                current = record
+            current['artifacts'][key] = path
+            return current
+        self.save(record['name'], update)
+
+    """
+    return : path of the artifact, None when it is not registered or its
+             file is gone
+    """
+    def get_artifact(self, name, key):
+        path = self.get(name)['artifacts'].get(key)
+        if path is None or not os.path.exists(path):
+            return None
+        return path
+
+    """
+    add every slide of the slide folders not in the catalog yet
+    """
+    def scan(self):
+        list_of_name = []
+        for folder in get_folders_of_slide():
+            if not os.path.isdir(folder):
+                continue
+            for fn in sorted(os.listdir(folder)):
+                if fn.endswith(EXTENSION_OF_SLIDE):
+                    list_of_name.append(self.get(os.path.join(folder, fn))['name'])
+        return list_of_name
+
+
+slide_catalog = SLIDE_CATALOG()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Slide catalog')
+    parser.add_argument('--slides', nargs='+', help='default, every slide')
+    args = parser.parse_args()
+
+    list_of_name = args.slides or slide_catalog.scan()
+    print("%-8s %-10s %14s %8s %8s %-11s %s"
+          % ('name', 'levels', 'level 0', 'mpp', 'GB', 'annotation',
+             'artifacts'))
+    for name in list_of_name:
+        record = slide_catalog.get(name)
+        print("%-8s %-10d %14s %8s %8.2f %-11s %s"
+              % (record['name'], record['level_count'],
+                 "%dx%d" % tuple(record['level_dimensions'][0]),
+                 "%.4f" % record['mpp_x'] if record['mpp_x'] else '-',
+                 record['bytes'] / 1e9,
+                 'yes' if record['annotation'] else 'no',
+                 ", ".join(sorted(record['artifacts']))))
+    print("catalog :", slide_catalog.get_path_of_catalog())
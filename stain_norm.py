@@ -0,0 +1,336 @@
+""" Stain normalization with per-slide parameters (Macenko, Reinhard)
+
+usage :
+    hp.use_stain_normalization = True, then create_dataset.py / train.py /
+    eval.py as usual
+
+    python stain_norm.py --slides b_1 b_2     # estimate and cache only
+
+The parameters of a slide are estimated once from the tissue of the level
+image read for the tissue mask (create_tissue_mask) and cached as json in
+cf.path_of_stain_params. Both methods then reduce to a colour transform of
+every pixel
+
+    x' = post(exp(A @ log(pre(x)) + b))
+
+with A (3 x 3) and b (3) per slide, so a batch is normalized on the device
+with one einsum, whatever slides its patches come from.
+    macenko  : pre/post map RGB to optical density, A re-projects the
+               stains of the slide onto the stains of the reference
+    reinhard : pre is RGB -> LMS, A and b match the mean and std of the
+               l alpha beta channels to the reference
+"""
+from __future__ import print_function
+
+import os
+import re
+import json
+import argparse
+
+import numpy as np
+import torch
+
+# user define variable
+from user_define import Config as cf
+from user_define import Hyperparams as hp
+
+
+LIST_OF_METHOD = ('macenko', 'reinhard')
+
+# H&E stain vectors and max concentrations of Macenko et al., used when
+# the reference slide is not cached
+STAIN_MATRIX_OF_REFERENCE = [[0.5626, 0.2159],
+                             [0.7201, 0.8012],
+                             [0.4062, 0.5581]]
+MAX_CONCENTRATION_OF_REFERENCE = [1.9705, 1.0308]
+
+# Reinhard et al., RGB -> LMS and log LMS -> l alpha beta
+RGB_TO_LMS = np.array([[0.3811, 0.5783, 0.0402],
+                       [0.1967, 0.7244, 0.0782],
+                       [0.0241, 0.1288, 0.8444]])
+LMS_TO_LAB = np.dot(np.diag([1 / np.sqrt(3), 1 / np.sqrt(6), 1 / np.sqrt(2)]),
+                    np.array([[1., 1., 1.], [1., 1., -2.], [1., -1., 0.]]))
+
+# darkest value kept before the log (a pixel of 0 has no optical density)
+MIN_INTENSITY = 1. / 255
+
+
+"""
+param : img (uint8 RGB, H x W x 3)
+        tissue_mask (H x W, > 0 in tissue)
+
+return : tissue pixels (float64, N x 3, in 0 to 1), at most max_of_pixel
+"""
+def get_tissue_pixels(img, tissue_mask, max_of_pixel=500000, seed=0):
+    pixels = img[tissue_mask > 0].reshape(-1, 3)
+    if len(pixels) > max_of_pixel:
+        index = np.random.RandomState(seed).choice(len(pixels), max_of_pixel,
+                                                   replace=False)
+        pixels = pixels[index]
+    return pixels.astype(np.float64) / 255.
+
+
+def _get_od(pixels):
+    # same as pre() of macenko, pixels in 0 to 1
+    return -np.log((pixels * 255 + 1) / 256.)
+
+
+"""
+Macenko et al. 2009
+
+return : dict of stain_matrix (3 x 2, hematoxylin first) and
+         max_concentration (2,)
+"""
+def estimate_macenko(pixels, beta=0.15, alpha=1):
+    od = _get_od(pixels)
+    od = od[np.all(od > beta, axis=1)]
+    if len(od) < 100:
+        raise RuntimeError("too few stained pixels to estimate the stains")
+
+    # plane of the two largest eigen vectors of the optical density
+    _, eigen_vector = np.linalg.eigh(np.cov(od.T))
+    plane = eigen_vector[:, 1:3]
+    plane = plane * np.sign(plane.sum(axis=0))
+
+    projection = np.dot(od, plane)
+    angle = np.arctan2(projection[:, 1], projection[:, 0])
+    min_angle, max_angle = np.percentile(angle, [alpha, 100 - alpha])
+    stain_1 = np.dot(plane, [np.cos(min_angle), np.sin(min_angle)])
+    stain_2 = np.dot(plane, [np.cos(max_angle), np.sin(max_angle)])
+    # hematoxylin absorbs more red than eosin
+    if stain_1[0] < stain_2[0]:
+        stain_1, stain_2 = stain_2, stain_1
+    stain_matrix = np.stack([stain_1, stain_2], axis=1)
+    stain_matrix = stain_matrix / np.linalg.norm(stain_matrix, axis=0)
+
+    concentration = np.linalg.lstsq(stain_matrix, od.T, rcond=None)[0]
+    max_concentration = np.percentile(concentration, 99, axis=1)
+    return {'stain_matrix': stain_matrix.tolist(),
+            'max_concentration': max_concentration.tolist()}
+
+
+"""
+Reinhard et al. 2001
+
+return : dict of mean and std (3,) of l alpha beta
+"""
+def estimate_reinhard(pixels):
+    lab = np.dot(np.log(np.maximum(np.dot(pixels, RGB_TO_LMS.T),
+                                   MIN_INTENSITY)), LMS_TO_LAB.T)
+    return {'mean': lab.mean(axis=0).tolist(),
+            'std': np.maximum(lab.std(axis=0), 1e-6).tolist()}
+
+
+def get_path_of_params(slide_name):
+    return os.path.join(cf.path_of_stain_params, slide_name + '.json')
+
+
+"""
+param : slide_name (string) ex) 'b_1', the name of the cache
+        img, tissue_mask (level image and its tissue mask), needed only
+            when the slide is not cached yet
+
+return : params (dict of method -> params)
+"""
+def get_params_of_slide(slide_name, img=None, tissue_mask=None):
+    path_of_params = get_path_of_params(slide_name)
+    if os.path.isfile(path_of_params):
+        with open(path_of_params) as fo:
+            return json.load(fo)
+    if img is None:
+        raise RuntimeError("stain params of %s are not cached at %s"
+                           % (slide_name, path_of_params))
+
+    pixels = get_tissue_pixels(img, tissue_mask)
+    params = {'macenko': estimate_macenko(pixels),
+              'reinhard': estimate_reinhard(pixels)}
+    if not os.path.isdir(cf.path_of_stain_params):
+        os.makedirs(cf.path_of_stain_params)
+    with open(path_of_params, 'w') as fo:
+        json.dump(params, fo)
+    return params
+
+
+"""
+return : params of the reference slide for a method
+"""
+def get_params_of_reference(method, slide_name=cf.slide_of_stain_reference):
+    if os.path.isfile(get_path_of_params(slide_name)):
+        return get_params_of_slide(slide_name)[method]
+    if method == 'macenko':
+        return {'stain_matrix': STAIN_MATRIX_OF_REFERENCE,
+                'max_concentration': MAX_CONCENTRATION_OF_REFERENCE}
+    raise RuntimeError("reference slide %s is not cached, run create_dataset.py"
+                       " or 'python stain_norm.py --slides %s'"
+                       % (slide_name, slide_name))
+
+
+"""
+param : params, reference (params of one method)
+
+return : A (3 x 3), b (3,) of x' = post(exp(A @ log(pre(x)) + b))
+"""
+def get_transform(method, params, reference):
+    if method == 'macenko':
+        # od' = H_ref diag(max_ref / max) pinv(H) od, and log(pre(x)) = -od
+        stain_matrix = np.asarray(params['stain_matrix'])
+        scale = (np.asarray(reference['max_concentration']) /
+                 np.asarray(params['max_concentration']))
+        A = np.dot(np.asarray(reference['stain_matrix']) * scale,
+                   np.linalg.pinv(stain_matrix))
+        return A, np.zeros(3)
+
+    elif method == 'reinhard':
+        # in l alpha beta : (lab - mean) * std_ref / std + mean_ref
+        scale = np.asarray(reference['std']) / np.asarray(params['std'])
+        shift = (np.asarray(reference['mean']) -
+                 scale * np.asarray(params['mean']))
+        lab_to_lms = np.linalg.inv(LMS_TO_LAB)
+        A = np.dot(lab_to_lms, np.dot(np.diag(scale), LMS_TO_LAB))
+        return A, np.dot(lab_to_lms, shift)
+
+    raise RuntimeError("invalid method of stain normalization : " + method)
+
+
+class STAIN_NORMALIZER(object):
+    """
+    Per-batch stain normalization of N x 3 x H x W tensors in 0 to 1
+
+    Args:
+        list_of_slide (list of string) slides of the dataset, all cached
+        slide_index (array, len(dataset)) index in list_of_slide of every
+            sample, None if the dataset is one slide
+        method (string) 'macenko' or 'reinhard'
+        reference_slide (string) slide whose stain the others are mapped to
+
+    usage :
+        stain = get_normalizer(trainset)
+        inputs = stain(inputs.cuda(), index)   # index of the dataset
+    """
+
+    def __init__(self, list_of_slide, slide_index=None,
+                 method=hp.method_of_stain_normalization,
+                 reference_slide=cf.slide_of_stain_reference):
+        if method not in LIST_OF_METHOD:
+            raise RuntimeError("invalid method of stain normalization : "
+                               + method)
+        reference = get_params_of_reference(method, reference_slide)
+        set_of_A, set_of_b = [], []
+        for slide_name in list_of_slide:
+            A, b = get_transform(method,
+                                 get_params_of_slide(slide_name)[method],
+                                 reference)
+            set_of_A.append(A)
+            set_of_b.append(b)
+
+        self.method = method
+        self.list_of_slide = list(list_of_slide)
+        self.A = torch.from_numpy(np.stack(set_of_A)).float()
+        self.b = torch.from_numpy(np.stack(set_of_b)).float()
+        self.slide_index = None if slide_index is None else \
+            torch.from_numpy(np.asarray(slide_index, dtype=np.int64))
+        self.rgb_to_lms = torch.from_numpy(RGB_TO_LMS).float()
+        self.lms_to_rgb = torch.from_numpy(np.linalg.inv(RGB_TO_LMS)).float()
+
+    def _pre(self, x):
+        if self.method == 'macenko':
+            return (x * 255 + 1) / 256.
+        lms = torch.einsum('ij,njhw->nihw', self.rgb_to_lms.to(x.device), x)
+        return lms.clamp(min=MIN_INTENSITY)
+
+    def _post(self, x):
+        if self.method == 'macenko':
+            return (x * 256 - 1) / 255.
+        return torch.einsum('ij,njhw->nihw', self.lms_to_rgb.to(x.device), x)
+
+    """
+    param : inputs (float tensor, N x 3 x H x W, in 0 to 1)
+            index (dataset index of each sample, None for the first slide)
+
+    return : normalized inputs, same shape and device
+    """
+    def __call__(self, inputs, index=None):
+        if index is None or self.slide_index is None:
+            slide = torch.zeros(inputs.size(0), dtype=torch.int64)
+        else:
+            slide = self.slide_index[torch.as_tensor(index).cpu().long()]
+        A = self.A[slide].to(inputs.device)
+        b = self.b[slide].to(inputs.device)
+
+        y = torch.einsum('nij,njhw->nihw', A, torch.log(self._pre(inputs)))
+        y = torch.exp(y + b.view(-1, 3, 1, 1))
+        return self._post(y).clamp(0, 1)
+
+
+"""
+return : STAIN_NORMALIZER of the slides of a CUSTOM_DATASET, or None if
+         hp.use_stain_normalization is off
+"""
+def get_normalizer(dataset, method=hp.method_of_stain_normalization):
+    if not hp.use_stain_normalization:
+        return None
+    return STAIN_NORMALIZER(dataset.list_of_slide, dataset.slide_index, method)
+
+
+"""
+param : stain (STAIN_NORMALIZER)
+        patches (uint8, N x H x W x 3) as read from the slide
+        index (dataset index of each patch, None for the first slide)
+
+return : normalized patches (uint8, N x H x W x 3), for the exported graphs
+         of export.py, which take the patches as read (rounding is within
+         0.5 / 255 of eval.py)
+"""
+def normalize_patches(stain, patches, index=None, batch_size=64):
+    output = np.empty_like(patches)
+    for i in range(0, len(patches), batch_size):
+        x = torch.from_numpy(np.ascontiguousarray(patches[i:i + batch_size]))
+        x = x.permute(0, 3, 1, 2).float().div(255.)
+        y = stain(x, None if index is None else index[i:i + batch_size])
+        output[i:i + batch_size] = y.mul(255.).round().byte() \
+            .permute(0, 2, 3, 1).numpy()
+    return output
+
+
+"""
+transforms.RandomGrayscale for a batch, applied after the normalization
+(before, the stain transform would colour the gray patches again)
+"""
+def random_grayscale(inputs, p=0.1):
+    is_gray = torch.rand(inputs.size(0), device=inputs.device) < p
+    if not bool(is_gray.any()):
+        return inputs
+    weight = torch.tensor([0.299, 0.587, 0.114], device=inputs.device)
+    gray = torch.einsum('c,nchw->nhw', weight, inputs).unsqueeze(1)
+    return torch.where(is_gray.view(-1, 1, 1, 1), gray.expand_as(inputs),
+                       inputs)
+
+
+"""
+slide name of a dataset pickle, ex) 'b_1_hard_2.pkl' -> 'b_1'
+"""
+def get_slide_name(filename):
+    name = os.path.splitext(os.path.basename(filename))[0]
+    return re.sub(r'_hard_\d+$', '', name)
+
+
+if __name__ == "__main__":
+    import openslide
+    from tissue_grid import create_tissue_mask
+
+    parser = argparse.ArgumentParser(description='Stain params of slides')
+    parser.add_argument('--slides', nargs='+',
+                        default=cf.list_of_slide_for_train +
+                        cf.list_of_slide_for_val)
+    parser.add_argument('--path', default=cf.path_of_slide,
+                        help='directory of the slides')
+    args = parser.parse_args()
+
+    for slide_name in args.slides:
+        slide = openslide.OpenSlide(os.path.join(args.path,
+                                                 slide_name + '.tif'))
+        tissue_mask, img = create_tissue_mask(slide, return_image=True)
+        params = get_params_of_slide(slide_name, img, tissue_mask)
+        print(slide_name, "max concentration (H, E) :",
+              np.round(params['macenko']['max_concentration'], 3))
+    print("stain params are saved at", cf.path_of_stain_params)
@@ -0,0 +1,167 @@
+""" Tiled Otsu tissue detection
+
+usage :
+    tissue_mask = detect_tissue(slide, level)           # COMPACT_MASK
+    tissue_mask, img = detect_tissue(slide, level, return_image=True)
+
+    python tissue_detector.py --slide ./Data/slide/b_1.tif --level 2
+
+The level is read in tiles of size_of_tile pixels (at that level, placed
+with the real level_downsamples of the slide). The first pass adds the
+HSV saturation of every tile to a 256 bin histogram, Otsu is computed on
+it as cv2.THRESH_OTSU does on the whole image, and the second pass
+thresholds tile by tile into a COMPACT_MASK strip. The saturation tiles
+are kept between the passes while they are under cache_bytes, else they
+are read again, so the peak memory is a strip of tiles and not the three
+full-size copies of the level (RGBA, RGB, HSV).
+"""
+from __future__ import print_function
+
+import time
+import argparse
+
+import numpy as np
+import cv2
+import openslide
+
+# user define variable
+from user_define import Config as cf
+
+from mask import COMPACT_MASK
+
+# std::numeric_limits<float>::epsilon, as cv2 Otsu
+FLT_EPSILON = np.finfo(np.float32).eps
+
+
+"""
+yield (x, y, w, h) of the tiles of a level, in rows, at that level
+"""
+def iter_tiles(slide, level, size_of_tile):
+    col, row = slide.level_dimensions[level]
+    for y in range(0, row, size_of_tile):
+        for x in range(0, col, size_of_tile):
+            yield x, y, min(size_of_tile, col - x), min(size_of_tile, row - y)
+
+
+"""
+return : RGB uint8 of the tile, level 0 origin from level_downsamples
+"""
+def read_tile(slide, level, tile):
+    x, y, w, h = tile
+    downsamples = slide.level_downsamples[level]
+    region = slide.read_region((int(round(x * downsamples)),
+                                int(round(y * downsamples))), level, (w, h))
+    return np.asarray(region.convert('RGB'))
+
+
+def get_saturation(rgb):
+    return cv2.cvtColor(np.ascontiguousarray(rgb), cv2.COLOR_RGB2HSV)[:, :, 1]
+
+
+"""
+param : histogram (256,) of an uint8 image
+
+return : threshold, same as cv2.threshold(..., THRESH_OTSU) of the image
+"""
+def get_threshold_of_otsu(histogram):
+    histogram = np.asarray(histogram, dtype=np.float64)
+    scale = 1. / max(1., histogram.sum())
+    mu = float(np.dot(np.arange(256), histogram)) * scale
+
+    q1, mu1, max_sigma, max_val = 0., 0., 0., 0
+    for i in range(256):
+        p_i = histogram[i] * scale
+        mu1 *= q1
+        q1 += p_i
+        q2 = 1. - q1
+        if min(q1, q2) < FLT_EPSILON or max(q1, q2) > 1. - FLT_EPSILON:
+            continue
+        mu1 = (mu1 + i * p_i) / q1
+        mu2 = (mu - q1 * mu1) / q2
+        sigma = q1 * q2 * (mu1 - mu2) * (mu1 - mu2)
+        if sigma > max_sigma:
+            max_sigma = sigma
+            max_val = i
+    return max_val
+
+
+"""
+param : slide (openslide)
+        level (int)
+        size_of_tile (int) side of a tile at the level
+        return_image (bool) also return the RGB of the level (stain_norm.py),
+            only for a level that fits in memory
+        cache_bytes (int) saturation of the level kept between the passes
+            up to this size
+
+return : tissue_mask (COMPACT_MASK, 1 is tissue), or (tissue_mask, img)
+"""
+def detect_tissue(slide, level=cf.level_for_preprocessing, size_of_tile=1024,
+                  return_image=False, cache_bytes=256 * 2 ** 20):
+    col, row = slide.level_dimensions[level]
+    list_of_tile = list(iter_tiles(slide, level, size_of_tile))
+    is_cached = col * row <= cache_bytes
+
+    img = np.empty((row, col, 3), dtype=np.uint8) if return_image else None
+    cache = {}
+    histogram = np.zeros(256, dtype=np.int64)
+    for tile in list_of_tile:
+        rgb = read_tile(slide, level, tile)
+        saturation = get_saturation(rgb)
+        histogram += np.bincount(saturation.reshape(-1), minlength=256)
+        if is_cached:
+            cache[tile] = saturation
+        if return_image:
+            x, y, w, h = tile
+            img[y:y + h, x:x + w] = rgb
+
+    threshold = get_threshold_of_otsu(histogram)
+
+    def iter_strips():
+        for y in range(0, row, size_of_tile):
+            strip = np.zeros((min(size_of_tile, row - y), col), dtype=bool)
+            for tile in list_of_tile:
+                if tile[1] != y:
+                    continue
+                saturation = cache.pop(tile, None)
+                if saturation is None:
+                    saturation = get_saturation(read_tile(slide, level, tile))
+                x, _, w, h = tile
+                strip[:, x:x + w] = saturation > threshold
+            yield y, strip
+
+    tissue_mask = COMPACT_MASK.from_strips((row, col), iter_strips(),
+                                           strip_height=size_of_tile)
+    if return_image:
+        return tissue_mask, img
+    return tissue_mask
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Tiled Otsu tissue detection')
+    parser.add_argument('--slide', required=True)
+    parser.add_argument('--level', type=int, default=cf.level_for_preprocessing)
+    parser.add_argument('--tile', type=int, default=1024)
+    args = parser.parse_args()
+
+    slide = openslide.OpenSlide(args.slide)
+    col, row = slide.level_dimensions[args.level]
+
+    start = time.perf_counter()
+    tissue_mask = detect_tissue(slide, args.level, args.tile)
+    seconds = time.perf_counter() - start
+    print("level %d (%d x %d, downsamples %.3f) : %.2f s, tissue %.3f, "
+          "mask %.1f MB (one read_region of the level : %.1f MB RGBA)"
+          % (args.level, col, row, slide.level_downsamples[args.level],
+             seconds, tissue_mask.count_nonzero() / float(col * row),
+             tissue_mask.nbytes / 1e6, col * row * 4 / 1e6))
+
+    if col * row <= 2 ** 28:
+        # the whole level at once, as before
+        img = np.array(slide.read_region((0, 0), args.level, (col, row)))
+        saturation = cv2.cvtColor(cv2.cvtColor(img, cv2.COLOR_RGBA2RGB),
+                                  cv2.COLOR_RGB2HSV)[:, :, 1]
+        _, dense = cv2.threshold(saturation, 0, 255,
+                                 cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        print("same as one read_region :",
+              bool(np.array_equal(tissue_mask.to_image(), dense)))
@@ -0,0 +1,247 @@
+""" Test grid of a slide : tissue mask, tissue components and the patch
+positions to predict
+
+usage :
+    from tissue_grid import get_pos_of_patch_of_slide
+    set_of_real_pos = get_pos_of_patch_of_slide('t_4')
+
+Only openslide, OpenCV, numpy and the small modules of the pipeline are
+imported (no models/, utils or matplotlib), so the lean CPU runtime of
+infer_cpu.py builds the same grid as eval.py. prepro_for_test2.py imports
+these functions and keeps the visualization of the grid.
+"""
+from __future__ import print_function
+
+import os
+import json
+
+import numpy as np
+import cv2
+import openslide
+
+# user define variable
+from user_define import Config as cf
+from user_define import Hyperparams as hp
+
+from profiler import profiler
+from tissue_detector import detect_tissue
+from slide_catalog import slide_catalog
+from stain_norm import get_params_of_slide, get_path_of_params
+
+
+def clean_tissue_mask(tissue_mask, o_knl=5, c_knl=9):
+    open_knl = np.ones((o_knl, o_knl), dtype=np.uint8)
+    close_knl = np.ones((c_knl, c_knl), dtype=np.uint8)
+
+    tissue_mask = cv2.morphologyEx(tissue_mask, cv2.MORPH_OPEN, open_knl)
+    tissue_mask = cv2.morphologyEx(tissue_mask, cv2.MORPH_CLOSE, close_knl)
+    return tissue_mask
+
+
+"""
+param : tissue_mask (numpy_array, level of preprocessing)
+
+return : list of (x_min, y_min, x_max, y_max), one per tissue component
+         of the cleaned mask
+"""
+def get_regions_of_interest(tissue_mask, o_knl=5, c_knl=9):
+    tissue_mask = clean_tissue_mask(tissue_mask, o_knl, c_knl)
+
+    # [-2] picks contours from both the OpenCV 3 and 4 return values
+    contours = cv2.findContours(tissue_mask,
+                                cv2.RETR_EXTERNAL,
+                                cv2.CHAIN_APPROX_SIMPLE)[-2]
+
+    set_of_region = []
+    for i in contours:
+        x, y, w, h = cv2.boundingRect(i)
+        set_of_region.append((x, y, x + w, y + h))
+    return set_of_region
+
+
+"""
+grid candidates of the global box whose patch overlaps a tissue component,
+same positions and order as the full grid of get_interest_region
+
+param : tissue_mask (numpy_array, level of preprocessing)
+        stride (int) and gap (int, size of a patch) in pixels of the mask
+
+return : set_of_pos (list of (x, y)), report (dict of candidate counts)
+"""
+def get_grid_in_regions(tissue_mask, stride, gap):
+    set_of_region = get_regions_of_interest(tissue_mask)
+    if len(set_of_region) == 0:
+        return [], {'regions': 0, 'candidates_of_box': 0, 'candidates': 0}
+
+    boxes = np.array(set_of_region, dtype=np.int64)
+    x_min, y_min = boxes[:, :2].min(axis=0)
+    x_max, y_max = boxes[:, 2:].max(axis=0)
+    num_of_x = -(-(x_max - x_min) // stride)
+    num_of_y = -(-(y_max - y_min) // stride)
+
+    # coarse occupancy of the grid, a patch [x, x + gap) overlaps a
+    # component [x0, x1) if x0 - gap < x < x1
+    occupancy = np.zeros((num_of_x, num_of_y), dtype=bool)
+    for x0, y0, x1, y1 in boxes:
+        ix_lo = max(0, (x0 - gap - x_min) // stride + 1)
+        iy_lo = max(0, (y0 - gap - y_min) // stride + 1)
+        ix_hi = min(num_of_x, -(-(x1 - x_min) // stride))
+        iy_hi = min(num_of_y, -(-(y1 - y_min) // stride))
+        occupancy[ix_lo:ix_hi, iy_lo:iy_hi] = True
+
+    # x major, like [(x, y) for x in ... for y in ...]
+    index = np.argwhere(occupancy)
+    set_of_pos = [(int(x_min + ix * stride), int(y_min + iy * stride))
+                  for ix, iy in index]
+    report = {'regions': len(boxes),
+              'candidates_of_box': int(num_of_x * num_of_y),
+              'candidates': len(set_of_pos)}
+    return set_of_pos, report
+
+
+"""
+param : slide (openslide)
+        tissue_mask (numpy_array, created if None)
+
+return : level 0 positions of the patches to predict (numpy N x 2)
+"""
+def get_pos_of_patch_in_tissue(slide, tissue_mask=None,
+                               stride=cf.stride_for_heatmap):
+    level = cf.level_for_preprocessing
+    downsamples = slide.level_downsamples[level]
+    if tissue_mask is None:
+        tissue_mask = create_tissue_mask(slide)
+
+    with profiler.timer('roi_planner'):
+        set_of_pos, report = get_grid_in_regions(
+            tissue_mask, int(stride / downsamples),
+            int(hp.patch_size[0] / downsamples))
+    print("grid candidates : %d (bounding box) -> %d (%d tissue components)"
+          % (report['candidates_of_box'], report['candidates'],
+             report['regions']))
+
+    set_of_real_pos = get_pos_of_patch_for_eval(slide, tissue_mask,
+                                                set_of_pos)
+    return np.array(set_of_real_pos).reshape(-1, 2)
+
+
+"""
+return : settings the test grid of a slide depends on, stored with the
+         cached grid and compared when it is loaded
+"""
+def get_params_of_grid(stride=cf.stride_for_heatmap):
+    return {'level': cf.level_for_preprocessing,
+            'stride': stride,
+            'patch_size': list(hp.patch_size),
+            'ratio_of_tissue_area': cf.ratio_of_tissue_area,
+            # tissue detection (saturation Otsu) and its cleaning kernels
+            'tissue_detector': 'otsu_of_saturation',
+            'kernels_of_cleaning': list(get_regions_of_interest.__defaults__)}
+
+
+"""
+param : slide_filename (string) ex) 't_4'
+
+return : level 0 positions of the patches to predict (numpy N x 2), cached
+         as an artifact of the slide catalog, so the slide is opened (tissue
+         pass and stain params) only the first time, or when a setting of
+         get_params_of_grid changes
+"""
+def get_pos_of_patch_of_slide(slide_filename, stride=cf.stride_for_heatmap):
+    key = 'test_grid_%d_%d' % (cf.level_for_preprocessing, stride)
+    params = get_params_of_grid(stride)
+    path_of_grid = slide_catalog.get_artifact(slide_filename, key)
+    # a .npy grid of an older version has no params, it is rebuilt
+    if path_of_grid is not None and path_of_grid.endswith('.npz') and (
+            not hp.use_stain_normalization or
+            os.path.isfile(get_path_of_params(slide_filename))):
+        grid = np.load(path_of_grid)
+        if json.loads(str(grid['params'])) == params:
+            return grid['pos']
+
+    slide = openslide.OpenSlide(slide_catalog.get_path(slide_filename))
+    if hp.use_stain_normalization:
+        # cached once, from the level image already read for the mask
+        tissue_mask, img = create_tissue_mask(slide, return_image=True)
+        get_params_of_slide(slide_filename, img, tissue_mask)
+        slide_catalog.add_artifact(slide_filename, 'stain_params',
+                                   get_path_of_params(slide_filename))
+    else:
+        # mask only, without the RGB copy of the level
+        tissue_mask = create_tissue_mask(slide)
+
+    # grid only inside the tissue components
+    set_of_real_pos = get_pos_of_patch_in_tissue(slide, tissue_mask, stride)
+
+    path_of_grid = os.path.join(cf.path_for_result, slide_filename,
+                                key + '.npz')
+    if not os.path.isdir(os.path.dirname(path_of_grid)):
+        os.makedirs(os.path.dirname(path_of_grid))
+    np.savez(path_of_grid, pos=set_of_real_pos,
+             params=json.dumps(params, sort_keys=True))
+    slide_catalog.add_artifact(slide_filename, key, path_of_grid)
+    return set_of_real_pos
+
+
+"""
+param : slide (openslide)
+        return_image (bool) also return the RGB level image (stain_norm.py)
+
+return : tissue_mask (numpy_array, 0 or 255), or (tissue_mask, img)
+"""
+def create_tissue_mask(slide, return_image=False):
+    level = cf.level_for_preprocessing
+
+    with profiler.timer('tissue_mask'):
+        # read and thresholded in tiles, see tissue_detector.py
+        if return_image:
+            tissue_mask, img = detect_tissue(slide, level, return_image=True)
+            return tissue_mask.to_image(), img
+        return detect_tissue(slide, level).to_image()
+
+
+def get_pos_of_patch_for_eval(slide, mask, set_of_pos):
+    with profiler.timer('grid_filter'):
+        return _get_pos_of_patch_for_eval(slide, mask, set_of_pos)
+
+
+def _get_pos_of_patch_for_eval(slide, mask, set_of_pos):
+    level = cf.level_for_preprocessing
+    downsamples = slide.level_downsamples[level]
+    gap = int(hp.patch_size[0] / downsamples)
+
+    # print(mask.shape)
+    length = len(set_of_pos)
+
+    set_of_real_pos = []
+    set_of_patch = []
+
+    j = 0
+
+    for i in range(length):
+        x, y = set_of_pos[i]
+        x_, y_ = (x + gap), (y + gap)
+        patch = mask[y:y_, x:x_]
+        if determine_is_background(patch):
+            continue
+        else:
+            xreal = int(round(x * downsamples))
+            yreal = int(round(y * downsamples))
+            set_of_real_pos.append((xreal, yreal))
+            j = j + 1
+        print("\r %d/%d correct : %d" % (i, length, j), end="")
+
+    print("\n")
+    return set_of_real_pos
+
+
+def determine_is_background(patch):
+    area = patch.size
+    _sum = np.sum(patch)
+
+    ratio = _sum / area
+
+    if ratio > cf.ratio_of_tissue_area:
+        return False  # is not background
+    else:
+        return True
@@ -11,10 +11,11 @@ import torchvision.transforms as transforms
 import torchvision.datasets as datasets
 
 import os
+import time
 # import argparse
 
 from models import *
-from utils import progress_bar
+from utils import ProgressReporter
 from torch.autograd import Variable
 
 import numpy as np
@@ -24,8 +25,12 @@ import matplotlib.pyplot as plt
 import pylab
 
 from logger import Logger
+from profiler import profiler, enable_from_config
 
 from load_dataset import *
+import models
+from distillation import prepare_teacher, distillation_loss
+from stain_norm import get_normalizer, random_grayscale
 
 # user define variable
 from user_define import Config as cf
@@ -36,6 +41,7 @@ import pdb
 import random
 
 use_cuda = torch.cuda.is_available()
+enable_from_config(sync=torch.cuda.synchronize if use_cuda else None)
 best_auc = 0  # best test accuracy
 start_epoch = 0  # start from epoch 0 or last checkpoint epoch
 
@@ -48,7 +54,8 @@ transform_train = transforms.Compose([
     transforms.RandomHorizontalFlip(),
     transforms.RandomVerticalFlip(),
     transforms.RandomRotation(180),
-    transforms.RandomGrayscale(p=0.1),
+    # with stain normalization, grayscale is applied per batch after it
+    transforms.RandomGrayscale(p=0 if hp.use_stain_normalization else 0.1),
     transforms.ToTensor()
 ])
 
@@ -56,17 +63,34 @@ transform_test = transforms.Compose([
     transforms.ToTensor(),
 ])
 
-trainset = get_train_dataset(transform_train)
-valset = get_val_dataset(transform_test)
+trainset = get_train_dataset(transform_train, return_index=True)
+valset = get_val_dataset(transform_test, return_index=True)
+
+# None unless hp.use_stain_normalization
+train_stain = get_normalizer(trainset)
+val_stain = get_normalizer(valset)
+
+if hp.use_loss_weighted_sampler:
+    train_sampler = LOSS_WEIGHTED_SAMPLER(trainset)
+else:
+    train_sampler = None
 
 trainloader = torch.utils.data.DataLoader(trainset,
                                           hp.batch_size_for_train,
-                                          shuffle=True,
-                                          num_workers=4)
+                                          shuffle=train_sampler is None,
+                                          sampler=train_sampler,
+                                          num_workers=4,
+                                          collate_fn=profiled_collate,
+                                          worker_init_fn=profiler.worker_init_fn)
+if hp.use_distillation:
+    teacher_logits = prepare_teacher(trainset, transform_test, use_cuda)
+
 valloader = torch.utils.data.DataLoader(valset,
                                         hp.batch_size_for_train,
                                         shuffle=True,
-                                        num_workers=4)
+                                        num_workers=4,
+                                        collate_fn=profiled_collate,
+                                        worker_init_fn=profiler.worker_init_fn)
 
 # Model
 if hp.resume:
@@ -79,6 +103,10 @@ if hp.resume:
     best_auc =  checkpoint['AUC']
     start_epoch = checkpoint['epoch']
 
+elif hp.use_distillation:
+    print('==> Building student..', hp.arch_of_student)
+    net = getattr(models, hp.arch_of_student)(pretrained=False)
+
 else:
     print('==> Building model..')
     net = resnet18()
@@ -93,7 +121,9 @@ if use_cuda:
     cudnn.benchmark = True
 
 
-logger = Logger('./logs')
+logger = Logger(cf.path_of_log,
+                histogram_frequency=cf.histogram_frequency,
+                bins=cf.bins_for_histogram)
 
 criterion = nn.BCELoss()
 
@@ -116,21 +146,47 @@ def train(epoch):
     correct = 0
     total = 0
 
-    for batch_idx, (inputs, targets) in enumerate(trainloader):
+    reporter = ProgressReporter(len(trainloader), 'train',
+                                json_path=cf.path_of_job_log,
+                                max_updates_per_sec=cf.max_progress_updates_per_sec,
+                                epoch=epoch)
+
+    for batch_idx, (inputs, targets, index) in enumerate(trainloader):
+        reporter.data_ready()
         if use_cuda:
-            inputs = inputs.type(torch.cuda.FloatTensor)
-            targets = targets.type(torch.cuda.FloatTensor)
+            with profiler.timer('h2d'):
+                inputs = inputs.type(torch.cuda.FloatTensor)
+                targets = targets.type(torch.cuda.FloatTensor)
+
+                inputs, targets = inputs.cuda(), targets.cuda()
 
-            inputs, targets = inputs.cuda(), targets.cuda()
+        if train_stain is not None:
+            with profiler.timer('stain_norm'):
+                inputs = random_grayscale(train_stain(inputs, index), p=0.1)
 
         optimizer.zero_grad()
         inputs, targets = Variable(inputs), Variable(targets)
 
-        outputs = net(inputs)
-        outputs = torch.squeeze(outputs)
-        loss = criterion(outputs, targets)
-        loss.backward()
-        optimizer.step()
+        with profiler.timer('forward'):
+            outputs = net(inputs)
+            outputs = torch.squeeze(outputs)
+            if hp.use_distillation:
+                teacher_logit = teacher_logits[index].type_as(outputs.data)
+                loss = distillation_loss(outputs, targets,
+                                         Variable(teacher_logit))
+            else:
+                loss = criterion(outputs, targets)
+        with profiler.timer('backward'):
+            loss.backward()
+        with profiler.timer('optimizer'):
+            optimizer.step()
+
+        if train_sampler is not None:
+            # per-sample BCE from the outputs we already have, no extra pass
+            prob = outputs.data.clamp(1e-7, 1 - 1e-7)
+            loss_of_sample = -(targets.data * torch.log(prob) +
+                               (1 - targets.data) * torch.log(1 - prob))
+            train_sampler.update(index, loss_of_sample)
 
         thresholding = torch.ones(inputs.size(0)) * (1 - hp.threshold_for_train)
         predicted = outputs + Variable(thresholding.cuda())
@@ -140,12 +196,17 @@ def train(epoch):
         total += targets.size(0)
         correct += predicted.data.eq(targets.data).cpu().sum()
 
-        progress_bar(batch_idx,
-                     len(trainloader),
-                     'Loss: %.3f | Acc: %.3f%% (%d/%d)'
-                     % (train_loss / (batch_idx + 1),
-                        100. * correct / total,
-                        correct, total))
+        reporter.step(targets.size(0),
+                      loss=train_loss / (batch_idx + 1),
+                      acc=100. * correct / total)
+    reporter.close()
+
+    if train_sampler is not None:
+        report = train_sampler.get_report()
+        print('Sampler: %d samples, effective epochs %.2f, saved %.2f, '
+              'coverage %.3f' % (total, report['effective_epochs'],
+                                 report['epochs_saved'], report['coverage']))
+        logger.scalar_summary('epochs_saved', report['epochs_saved'], epoch + 1)
 
 
 def val(epoch):
@@ -176,42 +237,56 @@ def val(epoch):
     best_threshold = hp.threshold_for_train
     best_score_inside = 0
 
-    for batch_idx, (inputs, targets) in enumerate(valloader):
+    reporter = ProgressReporter(len(valloader), 'val',
+                                json_path=cf.path_of_job_log,
+                                max_updates_per_sec=cf.max_progress_updates_per_sec,
+                                epoch=epoch)
+
+    for batch_idx, (inputs, targets, index) in enumerate(valloader):
+        reporter.data_ready()
         if use_cuda:
-            inputs = inputs.type(torch.cuda.FloatTensor)
-            targets = targets.type(torch.cuda.FloatTensor)
+            with profiler.timer('h2d'):
+                inputs = inputs.type(torch.cuda.FloatTensor)
+                targets = targets.type(torch.cuda.FloatTensor)
+
+                inputs, targets = inputs.cuda(), targets.cuda()
 
-            inputs, targets = inputs.cuda(), targets.cuda()
+        if val_stain is not None:
+            with profiler.timer('stain_norm'):
+                inputs = val_stain(inputs, index)
 
         inputs, targets = Variable(inputs, volatile=True), Variable(targets)
 
-        outputs = net(inputs)
-        outputs = torch.squeeze(outputs)
+        with profiler.timer('val_forward'):
+            outputs = net(inputs)
+            outputs = torch.squeeze(outputs)
 
         loss = criterion(outputs, targets)
         val_loss += loss.data[0]
         total += targets.size(0)
 
+        with profiler.timer('metrics_sweep'):
+            for i in range(section):
+                if i!=0 and i!=divisor:
+                    thresholding = torch.ones(inputs.size(0)) * (1 - i / divisor)
 
-        for i in range(section):
-            if i!=0 and i!=divisor:
-                thresholding = torch.ones(inputs.size(0)) * (1 - i / divisor)
+                    predicted = outputs + Variable(thresholding.cuda())
+                    predicted = torch.floor(predicted)
 
-                predicted = outputs + Variable(thresholding.cuda())
-                predicted = torch.floor(predicted)
+                    find_error = (targets - predicted) * 0.5
+                    biased = torch.ones(inputs.size(0)) * 0.5
 
-                find_error = (targets - predicted) * 0.5
-                biased = torch.ones(inputs.size(0)) * 0.5
+                    _false_positive = -find_error + Variable(biased.cuda())
+                    _false_positive = torch.floor(_false_positive)
+                    false_positive[i] += _false_positive.data.cpu().sum()
 
-                _false_positive = -find_error + Variable(biased.cuda())
-                _false_positive = torch.floor(_false_positive)
-                false_positive[i] += _false_positive.data.cpu().sum()
-
-                _false_negative = find_error + Variable(biased.cuda())
-                _false_negative = torch.floor(_false_negative)
-                false_negative[i] += _false_negative.data.cpu().sum()
+                    _false_negative = find_error + Variable(biased.cuda())
+                    _false_negative = torch.floor(_false_negative)
+                    false_negative[i] += _false_negative.data.cpu().sum()
         real_tumor += targets.data.cpu().sum()
         real_normal += (hp.batch_size_for_train - targets.data.cpu().sum())
+        reporter.step(targets.size(0), loss=val_loss / (batch_idx + 1))
+    reporter.close()
 
     false_positive[0] = real_normal
     false_negative[divisor] = real_tumor
@@ -248,6 +323,7 @@ def val(epoch):
     fig.savefig('ROC_curve.png')
     fig = plt.gcf().clear()
     #============ TensorBoard logging ============#
+    log_start_time = time.time()
     acc = 100. * (1 -  (false_negative[best_threshold]+false_positive[best_threshold])/total)
     print('Best score: ', best_score_inside, 'at threshold: ', best_threshold / divisor)
     print('Sensitivity: ', sensitivity[best_threshold], ', Specificity: ', specificity[best_threshold])
@@ -267,11 +343,13 @@ def val(epoch):
         logger.scalar_summary(tag, value, epoch + 1)
 
     # (2) Log values and gradients of the parameters (histogram)
-    for tag, value in net.named_parameters():
-        tag = tag.replace('.', '/')
-        logger.histo_summary(tag, to_np(value), epoch + 1)
-        logger.histo_summary(tag + '/grad', to_np(value.grad), epoch + 1)
-    
+    if logger.should_log_histogram(epoch + 1):
+        for tag, value in net.named_parameters():
+            tag = tag.replace('.', '/')
+            logger.histo_summary(tag, to_np(value), epoch + 1)
+            if value.grad is not None:
+                logger.histo_summary(tag + '/grad', to_np(value.grad), epoch + 1)
+    print('Logging time: %.3f sec' % (time.time() - log_start_time))
     
     # Save checkpoint.
     if best_auc < auc:
@@ -292,3 +370,7 @@ for epoch in range(start_epoch, start_epoch + 10):
     scheduler.step()
     train(epoch)
     val(epoch)
+
+logger.close()
+profiler.print_summary()
+profiler.dump('train')
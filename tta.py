@@ -0,0 +1,134 @@
+""" Test-time augmentation with the dihedral group, expanded on the device
+
+usage :
+    hp.number_of_tta_view = 8       # eval.py averages 8 views
+    python export.py --tta 8        # TTA inside the exported graph
+    python tta.py --views 1 2 4 8   # cost / AUC on val patches
+
+A batch that was read and decoded once is expanded into its rotations and
+flips with tensor ops (no DataLoader work, no copy to the host), the views
+run as one batch, and the probabilities are averaged.
+"""
+from __future__ import print_function
+
+import time
+import argparse
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+# user define variable
+from user_define import Config as cf
+from user_define import Hyperparams as hp
+
+
+# (rotations by 90 degree, horizontal flip), the first n are used
+LIST_OF_VIEW = ((0, False), (0, True), (2, False), (2, True),
+                (1, False), (1, True), (3, False), (3, True))
+
+
+def rot90(x, k):
+    # on the last two dims, counter clockwise
+    k = k % 4
+    if k == 1:
+        return x.transpose(-2, -1).flip(-2)
+    if k == 2:
+        return x.flip(-2).flip(-1)
+    if k == 3:
+        return x.transpose(-2, -1).flip(-1)
+    return x
+
+
+"""
+param : x (N x C x H x W, H == W)
+        number_of_view (int) 1, 2, 4 or 8
+        start (int) first view, to run the views in several batches
+
+return : views (number_of_view - start) * N x C x H x W, view major
+"""
+def dihedral_views(x, number_of_view=8, start=0):
+    views = []
+    for k, flip in LIST_OF_VIEW[start:number_of_view]:
+        view = rot90(x, k)
+        if flip:
+            view = view.flip(-1)
+        views.append(view)
+    return torch.cat(views, 0)
+
+
+class TTA_WRAPPER(nn.Module):
+    """
+    Average the prob of the dihedral views of each patch
+
+    Args:
+        net (nn.Module) N x C x H x W -> N x 1 prob
+        number_of_view (int) 1, 2, 4 or 8
+        views_per_forward (int) views run in one batch, fewer to save memory
+    """
+
+    def __init__(self, net, number_of_view=hp.number_of_tta_view,
+                 views_per_forward=8):
+        super(TTA_WRAPPER, self).__init__()
+        if number_of_view not in (1, 2, 4, 8):
+            raise RuntimeError("number_of_view must be 1, 2, 4 or 8")
+        self.net = net
+        self.number_of_view = number_of_view
+        self.views_per_forward = views_per_forward
+
+    def forward(self, x):
+        n = x.size(0)
+        prob = 0
+        for start in range(0, self.number_of_view, self.views_per_forward):
+            end = min(start + self.views_per_forward, self.number_of_view)
+            output = self.net(dihedral_views(x, end, start))
+            prob = prob + output.view(end - start, n).sum(0)
+        return (prob / self.number_of_view).view(n, 1)
+
+
+"""
+patches/sec and AUC of the val patches for each number of views
+"""
+def benchmark(net, patches, labels, list_of_view, batch_size, use_cuda):
+    from froc import compute_auc
+
+    print("%6s %14s %8s" % ('views', 'patches/sec', 'AUC'))
+    result = []
+    for number_of_view in list_of_view:
+        model = TTA_WRAPPER(net, number_of_view).eval()
+        set_of_prob = []
+        start = time.perf_counter()
+        with torch.no_grad():
+            for i in range(0, len(patches), batch_size):
+                inputs = torch.from_numpy(patches[i:i + batch_size])
+                inputs = inputs.permute(0, 3, 1, 2).float().div(255.)
+                if use_cuda:
+                    inputs = inputs.cuda()
+                set_of_prob.append(model(inputs).view(-1).cpu().numpy())
+        seconds = time.perf_counter() - start
+        auc = compute_auc(np.concatenate(set_of_prob), labels > 0.5)
+        print("%6d %14.1f %8.4f" % (number_of_view, len(patches) / seconds,
+                                     auc))
+        result.append((number_of_view, len(patches) / seconds, auc))
+    return result
+
+
+if __name__ == "__main__":
+    from export import load_net
+    from quantization import load_val_patches
+
+    parser = argparse.ArgumentParser(description='TTA cost / accuracy')
+    parser.add_argument('--checkpoint', default=cf.path_of_checkpoint)
+    parser.add_argument('--arch', default=None)
+    parser.add_argument('--views', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--patches', type=int, default=2000,
+                        help='val patches sampled for the benchmark')
+    parser.add_argument('--batch-size', type=int, default=32)
+    args = parser.parse_args()
+
+    use_cuda = torch.cuda.is_available()
+    net = load_net(args.checkpoint, args.arch)
+    if use_cuda:
+        net.cuda()
+    patches, labels = load_val_patches(args.patches)
+    benchmark(net, patches, labels, args.views, args.batch_size, use_cuda)
@@ -19,8 +19,16 @@ class Config:
     path_of_val_dataset = './Data/dataset/val'
     path_of_test_dataset = './Data/dataset/test'
 
+    # paths, levels, MPP and cached results of the slides (slide_catalog.py)
+    path_of_slide_catalog = './Data/result/slide_catalog.json'
+
     '''select option'''
     level_for_preprocessing = 4
+    # resolution of the tumor labels of the patches (determine_tumor),
+    # the level 0 annotation is rasterized per patch, 0 is exact
+    level_for_label = 0
+    # 'uint8', 'bitpacked' or 'rle' (see mask.py)
+    backing_of_mask = 'bitpacked'
 
     save_tissue_mask_image = True
     save_tumor_mask_image = True
@@ -32,6 +40,21 @@ class Config:
     key_of_data = 'data'
     key_of_informs = 'informations'
 
+    # for patch index (see patch_index.py), a row per patch in sqlite and
+    # the pixels in npy shards, the pickles then keep only the informations
+    # and the path of their shard (key_of_store)
+    use_patch_index = True
+    key_of_store = 'store'
+    path_of_patch_index = './Data/dataset/patch_index.sqlite'
+    path_of_patch_store = './Data/dataset/store'
+    # SQL condition on the index choosing the train / val patches
+    # ex) "label = 1 OR source = 'hard_fp'", None loads every pickle
+    query_of_train_patch = None
+    query_of_val_patch = None
+
+    # threads decoding the task_1 images (image_ingest.py)
+    number_of_ingest_thread = 8
+
     list_of_slide_for_train = ['b_1',
                                'b_3',
                                'b_4',
@@ -55,49 +78,91 @@ class Config:
                                't_5',
                                't_6']
 
+    # for export and CPU inference (export.py, infer_cpu.py)
+    path_of_checkpoint = './checkpoint/ckpt.pth.tar'
+    path_of_export = './checkpoint/export'
+    # val patches to calibrate int8 quantization (quantization.py)
+    number_of_patch_for_calibration = 1024
+
+    # for distillation (hp.use_distillation)
+    path_of_teacher_checkpoint = './checkpoint/teacher.pth.tar'
+    path_of_teacher_logits = './checkpoint/teacher_logits.npy'
+
+    # for feature embedding cache (embedding_cache.py)
+    path_of_embedding = './checkpoint/embedding'
+
+    # for stain normalization (hp.use_stain_normalization, stain_norm.py)
+    path_of_stain_params = './Data/result/stain'
+    slide_of_stain_reference = 'b_1'
+
+    # for hard example mining (top-k of FP and of FN per slide)
+    number_of_hard_example_per_slide = 200
+
     # for determine is background
     ratio_of_tissue_area = 0.5
     stride_for_heatmap = 304
 
+    # for tensorboard logging
+    path_of_log = './logs'
+    histogram_frequency = 5
+    bins_for_histogram = 100
+
+    # for progress report (JSON lines, one record per update)
+    path_of_job_log = './logs/job_log.jsonl'
+    max_progress_updates_per_sec = 2
+
+    # for profiling (or set CAMELYON_PROFILE=1)
+    enable_profiling = False
+    save_chrome_trace = False
+    path_of_profile = './logs/profile'
+
 class Hyperparams:
     '''Hyper parameters'''
     # for data preprocess
     patch_size = (304, 304)
 
     # for dataset
-<<<<<<< HEAD
-<<<<<<< HEAD
     number_of_patch_per_slide = 7000
-    ratio_of_tumor_patch      = 0.5
-=======
-    number_of_patch_per_slide = 2500
-    ratio_of_tumor_patch      = 0.75
->>>>>>> model
-    threshold_of_tumor_rate   = 0.4
-=======
-    number_of_patch_per_slide = 2000
     ratio_of_tumor_patch = 0.5
     threshold_of_tumor_rate = 0.4
->>>>>>> cleaningCode
+    # min distance between sampled patch centres in level 0 pixels,
+    # 0 is uniform sampling (152 : two patches overlap at most half,
+    # a small tissue can then give fewer patches than asked)
+    min_distance_of_patch = 0
+
+    # for patch quality filter (see patch_filter.py), a rejected patch is
+    # replaced by one of ratio_of_reserve_patch extra samples
+    use_patch_filter = True
+    ratio_of_reserve_patch = 0.2
+    threshold_of_saturation = 20
+    min_tissue_of_patch = 0.2
+    min_std_of_patch = 3.
+    min_blur_of_patch = 10.
+
+    # for loss weighted sampler (see load_dataset.LOSS_WEIGHTED_SAMPLER)
+    # samples per epoch = ratio * number of train patches, drawn by loss
+    # with replacement from 1, under 1 the epochs of train.py are shorter
+    # (its schedule is per epoch)
+    use_loss_weighted_sampler = False
+    ratio_of_sampled_patch = 1.0
+    floor_of_sampling_prob = 0.2
+    momentum_of_sample_loss = 0.5
+
+    # for distillation (see distillation.py)
+    # train arch_of_student on the soft targets of the teacher checkpoint
+    use_distillation = False
+    arch_of_student = 'resnet18_narrow'
+    temperature_of_distillation = 2.0
+    ratio_of_distillation_loss = 0.7
+
+    # for stain normalization (see stain_norm.py), 'macenko' or 'reinhard'
+    use_stain_normalization = False
+    method_of_stain_normalization = 'macenko'
 
     # for run model
     # resume from checkpoint
     resume = False
 
-<<<<<<< HEAD
-    ## for optimizer
-<<<<<<< HEAD
-    learning_rate = 0.01
-=======
-    learning_rate = 0.001
->>>>>>> model
-    momentum      = 0.9
-    weight_decay  = 9e-4
-
-    ## for epoch
-    ### for train step
-<<<<<<< HEAD
-=======
     # for optimizer
     learning_rate = 0.01
     momentum = 0.9
@@ -105,14 +170,14 @@ class Hyperparams:
 
     # for epoch
     # for train step
->>>>>>> cleaningCode
     batch_size_for_train = 200
     threshold_for_train = 0.2
-=======
-    batch_size_for_train = 250
-    threshold_for_train = 0.1
->>>>>>> model
 
     # for eval step
     batch_size_for_eval = 250
     threshold_for_eval = 0.065
+    # test patches are read by regions of n x n patches (region_reader.py),
+    # 1 reads every patch alone
+    patches_per_side_of_region = 4
+    # test-time augmentation, 1 (off), 2, 4 or 8 dihedral views (see tta.py)
+    number_of_tta_view = 1
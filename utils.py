@@ -1,31 +1,147 @@
 '''Some helper functions for PyTorch, including:
     - get_mean_and_std: calculate the mean and std value of dataset.
+    - get_mean_and_std_of_array: same, over a (memory-mapped) patch array.
+    - get_mean_and_std_per_slide: per-slide colour stats of dataset pickles.
     - msr_init: net parameter initialization.
     - progress_bar: progress bar mimic xlua.progress.
+    - ProgressReporter: rate-limited throughput reporter with JSON lines.
 '''
 import os
 import sys
 import time
 import math
+import json
+import shutil
+import multiprocessing
 
+import numpy as np
+import torch
+import torch.utils.data
 import torch.nn as nn
 import torch.nn.init as init
 
+from patch_index import load_dataset_pickle
 
-def get_mean_and_std(dataset):
-    '''Compute the mean and std value of dataset.'''
+
+class ChannelStats(object):
+    '''Running per-channel count, mean and sum of squared deviations.
+
+    Partial results are combined with the parallel (Chan et al.) form of
+    Welford's update in float64, so batches, workers and slides can be
+    reduced in any order without losing precision.
+    '''
+
+    def __init__(self, channels=3):
+        self.count = 0
+        self.mean = np.zeros(channels, dtype=np.float64)
+        self.m2 = np.zeros(channels, dtype=np.float64)
+
+    def merge_moments(self, count, mean, m2):
+        if count == 0:
+            return self
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean = self.mean + delta * (count / total)
+        self.m2 = self.m2 + m2 + delta ** 2 * (self.count * count / total)
+        self.count = total
+        return self
+
+    def merge(self, other):
+        return self.merge_moments(other.count, other.mean, other.m2)
+
+    def update(self, batch, channel_axis=1, scale=1.):
+        '''Add a batch (array or tensor) with channels on channel_axis.'''
+        if torch.is_tensor(batch):
+            batch = batch.cpu().numpy()
+        batch = np.moveaxis(np.asarray(batch), channel_axis, 0)
+        count = batch[0].size
+        if count == 0:
+            return self
+        mean = np.empty(len(batch), dtype=np.float64)
+        m2 = np.empty(len(batch), dtype=np.float64)
+        # one channel at a time keeps the float64 copy small
+        for c, values in enumerate(batch):
+            values = values.astype(np.float64).ravel() * scale
+            mean[c] = values.mean()
+            m2[c] = np.dot(values - mean[c], values - mean[c])
+        return self.merge_moments(count, mean, m2)
+
+    @property
+    def std(self):
+        return np.sqrt(self.m2 / max(self.count, 1))
+
+
+def get_mean_and_std(dataset, batch_size=256, num_workers=4):
+    '''Compute the exact per-channel mean and std value of dataset.'''
     dataloader = torch.utils.data.DataLoader(
-        dataset, batch_size=1, shuffle=True, num_workers=2)
-    mean = torch.zeros(3)
-    std = torch.zeros(3)
+        dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+    stats = ChannelStats(3)
     print('==> Computing mean and std..')
-    for inputs, targets in dataloader:
-        for i in range(3):
-            mean[i] += inputs[:, i, :, :].mean()
-            std[i] += inputs[:, i, :, :].std()
-    mean.div_(len(dataset))
-    std.div_(len(dataset))
-    return mean, std
+    for batch in dataloader:
+        stats.update(batch[0], channel_axis=1)
+    return torch.from_numpy(stats.mean), torch.from_numpy(stats.std)
+
+
+_array_for_stats = None
+
+
+def _init_stats_worker(data):
+    global _array_for_stats
+    _array_for_stats = data
+
+
+def _get_stats_of_chunk(bounds):
+    start, end = bounds
+    data = _array_for_stats
+    return ChannelStats(data.shape[-1]).update(data[start:end],
+                                               channel_axis=-1,
+                                               scale=1. / 255)
+
+
+def get_mean_and_std_of_array(data, chunk_size=64, num_workers=4):
+    '''Compute the mean and std value of a (N, H, W, C) uint8 patch store.
+
+    data may be a numpy memmap (np.load(fn, mmap_mode='r')); chunks are
+    reduced in a worker pool and merged, and values are scaled to [0, 1]
+    to match transforms.ToTensor().
+    '''
+    chunks = [(start, min(start + chunk_size, len(data)))
+              for start in range(0, len(data), chunk_size)]
+    stats = ChannelStats(data.shape[-1])
+    if num_workers > 1 and len(chunks) > 1:
+        with multiprocessing.Pool(num_workers,
+                                  initializer=_init_stats_worker,
+                                  initargs=(data,)) as pool:
+            for partial in pool.imap_unordered(_get_stats_of_chunk, chunks):
+                stats.merge(partial)
+    else:
+        _init_stats_worker(data)
+        for chunk in chunks:
+            stats.merge(_get_stats_of_chunk(chunk))
+    return stats.mean, stats.std
+
+
+def get_mean_and_std_per_slide(path_of_dataset, key_of_data='data',
+                               chunk_size=64):
+    '''Compute colour statistics of every slide pickle in path_of_dataset.
+
+    return : {slide_name: (mean, std)} and the dataset (mean, std)
+    '''
+    per_slide = {}
+    total = ChannelStats(3)
+    for fn in sorted(os.listdir(path_of_dataset)):
+        name, ext = os.path.splitext(fn)
+        if ext != '.pkl':
+            continue
+        data = load_dataset_pickle(os.path.join(path_of_dataset,
+                                                fn))[key_of_data]
+        stats = ChannelStats(data.shape[-1])
+        for start in range(0, len(data), chunk_size):
+            stats.update(data[start:start + chunk_size],
+                         channel_axis=-1, scale=1. / 255)
+        per_slide[name] = (stats.mean, stats.std)
+        total.merge(stats)
+    return per_slide, (total.mean, total.std)
 
 
 def init_params(net):
@@ -44,58 +160,162 @@ def init_params(net):
                 init.constant(m.bias, 0)
 
 
-_, term_width = os.popen('stty size', 'r').read().split()
-term_width = int(term_width)
-
-TOTAL_BAR_LENGTH = 65.
+TOTAL_BAR_LENGTH = 65
+MAX_UPDATES_PER_SEC = 4.
 last_time = time.time()
 begin_time = last_time
+last_draw_time = 0.
 
 
-def progress_bar(current, total, msg=None):
-    global last_time, begin_time
-    if current == 0:
-        begin_time = time.time()  # Reset for new bar.
+def get_term_width():
+    '''Terminal width, or 80 when stdout is not a terminal.'''
+    return shutil.get_terminal_size((80, 24)).columns
 
-    cur_len = int(TOTAL_BAR_LENGTH * current / total)
-    rest_len = int(TOTAL_BAR_LENGTH - cur_len) - 1
-
-    sys.stdout.write(' [')
-    for i in range(cur_len):
-        sys.stdout.write('=')
-    sys.stdout.write('>')
-    for i in range(rest_len):
-        sys.stdout.write('.')
-    sys.stdout.write(']')
 
+def progress_bar(current, total, msg=None):
+    global last_time, begin_time, last_draw_time
     cur_time = time.time()
+    if current == 0:
+        begin_time = cur_time  # Reset for new bar.
     step_time = cur_time - last_time
     last_time = cur_time
-    tot_time = cur_time - begin_time
 
-    L = []
-    L.append('  Step: %s' % format_time(step_time))
-    L.append(' | Tot: %s' % format_time(tot_time))
-    if msg:
-        L.append(' | ' + msg)
+    is_last = current >= total - 1
+    if not is_last and cur_time - last_draw_time < 1. / MAX_UPDATES_PER_SEC:
+        return
+    last_draw_time = cur_time
 
-    msg = ''.join(L)
-    sys.stdout.write(msg)
-    for i in range(term_width - int(TOTAL_BAR_LENGTH) - len(msg) - 3):
-        sys.stdout.write(' ')
+    cur_len = int(TOTAL_BAR_LENGTH * current / total)
+    rest_len = int(TOTAL_BAR_LENGTH - cur_len) - 1
 
-    # Go back to the center of the bar.
-    for i in range(term_width - int(TOTAL_BAR_LENGTH / 2) + 2):
-        sys.stdout.write('\b')
-    sys.stdout.write(' %d/%d ' % (current + 1, total))
+    L = [' [', '=' * cur_len, '>', '.' * rest_len, ']']
+    L.append(' %d/%d ' % (current + 1, total))
+    L.append(' Step: %s' % format_time(step_time))
+    L.append(' | Tot: %s' % format_time(cur_time - begin_time))
+    if msg:
+        L.append(' | ' + msg)
+    line = ''.join(L)
 
-    if current < total - 1:
-        sys.stdout.write('\r')
+    if sys.stdout.isatty():
+        line = '\r' + line[:get_term_width() - 1].ljust(get_term_width() - 1)
+        if is_last:
+            line += '\n'
     else:
-        sys.stdout.write('\n')
+        line += '\n'
+    sys.stdout.write(line)
     sys.stdout.flush()
 
 
+class ProgressReporter(object):
+    '''Rate-limited progress and throughput reporter.
+
+    Call data_ready() when a batch comes out of the loader and step() when
+    the work on it is done; the time in between is compute, the rest is
+    data wait. Updates are printed at most max_updates_per_sec times per
+    second (one line per update when stdout is not a terminal) and, if
+    json_path is given, appended there as JSON lines.
+
+    Args:
+        total (int): number of steps
+        name (string): ex) 'train', 'val', 'eval'
+        **fields: extra keys written to every JSON line, ex) epoch=3
+    '''
+
+    def __init__(self, total, name, json_path=None,
+                 max_updates_per_sec=MAX_UPDATES_PER_SEC, **fields):
+        self.total = total
+        self.name = name
+        self.fields = fields
+        self.min_interval = 1. / max_updates_per_sec
+        self.is_tty = sys.stdout.isatty()
+
+        self.json_file = None
+        if json_path is not None:
+            dir_name = os.path.dirname(json_path)
+            if dir_name and not os.path.isdir(dir_name):
+                os.makedirs(dir_name)
+            self.json_file = open(json_path, 'a')
+
+        self.current = 0
+        self.samples = 0
+        self.data_wait = 0.
+        self.compute = 0.
+        self.metrics = {}
+        self.begin_time = time.time()
+        self.last_mark = self.begin_time
+        self.last_report = 0.
+
+    def data_ready(self):
+        now = time.time()
+        self.data_wait += now - self.last_mark
+        self.last_mark = now
+
+    def step(self, batch_size, **metrics):
+        now = time.time()
+        self.compute += now - self.last_mark
+        self.last_mark = now
+
+        self.current += 1
+        self.samples += batch_size
+        self.metrics = dict((k, float(v)) for k, v in metrics.items())
+
+        if (self.current >= self.total or
+                now - self.last_report >= self.min_interval):
+            self.last_report = now
+            self.report('progress')
+
+    def get_record(self, event):
+        elapsed = max(time.time() - self.begin_time, 1e-12)
+        rate = self.current / elapsed
+        record = {'event': event,
+                  'name': self.name,
+                  'time': time.time(),
+                  'step': self.current,
+                  'total': self.total,
+                  'samples': self.samples,
+                  'samples_per_sec': self.samples / elapsed,
+                  'data_wait_sec': self.data_wait,
+                  'compute_sec': self.compute,
+                  'elapsed_sec': elapsed,
+                  'eta_sec': (self.total - self.current) / rate if rate else None}
+        record.update(self.fields)
+        record.update(self.metrics)
+        return record
+
+    def report(self, event):
+        record = self.get_record(event)
+
+        L = [' %s %d/%d' % (self.name, self.current, self.total),
+             ' | %.1f samples/s' % record['samples_per_sec'],
+             ' | data %s / compute %s' % (format_time(self.data_wait),
+                                          format_time(self.compute))]
+        if record['eta_sec'] is not None and self.current < self.total:
+            L.append(' | ETA %s' % format_time(record['eta_sec']))
+        for key, value in self.metrics.items():
+            L.append(' | %s: %.4g' % (key, value))
+        line = ''.join(L)
+
+        if self.is_tty and event == 'progress':
+            end = '\n' if self.current >= self.total else ''
+            width = get_term_width() - 1
+            sys.stdout.write('\r' + line[:width].ljust(width) + end)
+        else:
+            sys.stdout.write(line + '\n')
+        sys.stdout.flush()
+
+        if self.json_file is not None:
+            self.json_file.write(json.dumps(record) + '\n')
+            self.json_file.flush()
+
+    def close(self):
+        '''Write the summary line and close the JSON log.'''
+        if self.json_file is not None:
+            record = self.get_record('summary')
+            self.json_file.write(json.dumps(record) + '\n')
+            self.json_file.close()
+            self.json_file = None
+
+
 def format_time(seconds):
     days = int(seconds / 3600 / 24)
     seconds = seconds - days * 3600 * 24